@@ -0,0 +1,70 @@
+import asyncio
+import hmac
+import os
+import time
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
+
+import profiler
+import tracing
+
+
+# 运维接口的访问令牌（可通过环境变量设置）；为空时只允许本机直连访问
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+def check_token(request: Request, x_admin_token: str = Header(None)):
+    if ADMIN_TOKEN:
+        if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+            raise HTTPException(status_code=403, detail="无效的管理令牌")
+        return
+    # 未配置令牌：采样分析和慢请求日志（含用户问题）只对本机开放，经反向代理转发的请求一律拒绝
+    client_host = request.client.host if request.client else None
+    forwarded = request.headers.get("x-forwarded-for") or request.headers.get("x-real-ip")
+    if client_host not in LOOPBACK_HOSTS or forwarded:
+        raise HTTPException(status_code=403, detail="未配置 ADMIN_TOKEN，运维接口只允许本机访问")
+
+
+router = APIRouter(prefix="/api/admin", tags=["admin"], dependencies=[Depends(check_token)])
+
+
+# 慢请求日志：按时间倒序，min_duration_ms 可进一步筛选
+@router.get("/slow-requests")
+async def list_slow_requests(
+    limit: int = Query(50, ge=1, le=500),
+    min_duration_ms: float = Query(0, ge=0),
+):
+    return {"threshold_ms": tracing.SLOW_REQUEST_THRESHOLD_MS, "requests": await tracing.list_slow(limit, min_duration_ms)}
+
+
+# 单个慢请求的各阶段耗时
+@router.get("/slow-requests/{trace_id}")
+async def get_slow_request(trace_id: str):
+    row = await tracing.get_slow(trace_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="慢请求记录不存在")
+    return row
+
+
+# 最近的事件循环阻塞记录：阻塞时长和阻塞时事件循环线程的调用栈
+@router.get("/loop-stalls")
+async def list_loop_stalls(limit: int = Query(50, ge=1, le=500)):
+    return {"threshold_ms": profiler.LOOP_LAG_THRESHOLD_MS, "stalls": profiler.recent_stalls(limit)}
+
+
+# 对运行中的进程采样分析，返回折叠栈文件（flamegraph.pl / speedscope 可直接打开）
+# threads=loop 只看事件循环线程（定位阻塞调用），threads=all 包括数据库线程和线程池
+@router.get("/profile")
+async def run_profile(
+    seconds: float = Query(10, gt=0, le=profiler.PROFILE_MAX_SECONDS),
+    interval_ms: float = Query(5, ge=1, le=1000),
+    threads: str = Query("loop", pattern="^(loop|all)$"),
+):
+    try:
+        collapsed = await asyncio.to_thread(profiler.profile, seconds, interval_ms, threads)
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    filename = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.collapsed"
+    return PlainTextResponse(collapsed, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
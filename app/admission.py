@@ -0,0 +1,184 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+# 请求优先级：数值越小越优先
+INTERACTIVE = 0     # 在线聊天
+BATCH = 1           # 后台任务（会话摘要、批量索引等）
+
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", 30))    # 排队最长等待时间（秒），超时视为拒绝
+ADMISSION_WAIT_WINDOW = 200                                         # 统计排队耗时分位数的最近请求数
+
+
+class AdmissionRejected(Exception):
+    """上游并发和排队都已满（或排队超时），请求被拒绝"""
+
+    def __init__(self, upstream: str, queue_position: int, retry_after: int):
+        super().__init__(f"{upstream} 上游繁忙，当前排队 {queue_position} 个请求，请 {retry_after} 秒后重试")
+        self.upstream = upstream
+        self.queue_position = queue_position
+        self.retry_after = retry_after
+
+
+class Slot:
+    """已获得的上游调用名额，release() 可重复调用"""
+
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._limiter._release(time.monotonic() - self._acquired_at)
+
+
+class Limiter:
+    """
+    单个上游的准入控制：并发上限 + 令牌桶限速 + 有界优先级排队。
+    名额释放时直接交给排在最前面（优先级最高、最早到达）的等待者。
+    """
+
+    def __init__(self, name: str, max_concurrency: int, rate: float, max_queue: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.rate = rate                    # 每秒允许的请求数，0 表示不限速
+        self.burst = max(1.0, rate)         # 令牌桶容量
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters = []                  # [(优先级, 序号, future)]
+        self._seq = itertools.count()
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._hold_time = 1.0               # 每个请求占用名额时间的滑动平均（秒），用于估算 Retry-After
+        self.admitted = 0
+        self.rejected = 0
+        self._waits = deque(maxlen=ADMISSION_WAIT_WINDOW)
+
+    def _retry_after(self, position: int) -> int:
+        return max(1, math.ceil(self._hold_time * position / self.max_concurrency))
+
+    def _take_token(self) -> float:
+        # 取一个令牌，返回 0；令牌不足时返回需要等待的秒数
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self, priority: int = INTERACTIVE) -> Slot:
+        start = time.monotonic()
+        if self.in_flight < self.max_concurrency and not self._waiters:
+            self.in_flight += 1
+        else:
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise AdmissionRejected(self.name, len(self._waiters) + 1, self._retry_after(len(self._waiters) + 1))
+            future = asyncio.get_running_loop().create_future()
+            entry = (priority, next(self._seq), future)
+            heapq.heappush(self._waiters, entry)
+            try:
+                await asyncio.wait_for(future, ADMISSION_MAX_WAIT)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if future.done() and not future.cancelled():
+                    # 名额已经交接过来，交还给下一个等待者
+                    self._release(0)
+                elif entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.rejected += 1
+                raise AdmissionRejected(self.name, len(self._waiters) + 1, self._retry_after(len(self._waiters) + 1))
+
+        slot = Slot(self)
+        try:
+            while (delay := self._take_token()) > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            slot.release()
+            raise
+        self.admitted += 1
+        self._waits.append(time.monotonic() - start)
+        return slot
+
+    def _release(self, hold_time: float):
+        if hold_time:
+            self._hold_time = self._hold_time * 0.9 + hold_time * 0.1
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # 名额直接交给下一个等待者，in_flight 不变
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = INTERACTIVE):
+        slot = await self.acquire(priority)
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    @contextmanager
+    def thread_slot(self, loop: asyncio.AbstractEventLoop, priority: int = INTERACTIVE):
+        """在工作线程中占用名额（阻塞等待），排队和交接仍在事件循环 loop 中进行"""
+        slot = asyncio.run_coroutine_threadsafe(self.acquire(priority), loop).result()
+        try:
+            yield slot
+        finally:
+            loop.call_soon_threadsafe(slot.release)
+
+    def snapshot(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "rate_limit": self.rate,
+            "queue_depth": len(self._waiters),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_avg_ms": round(sum(waits) / len(waits) * 1000, 1) if waits else None,
+            "wait_p95_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else None,
+            "wait_max_ms": round(waits[-1] * 1000, 1) if waits else None,
+        }
+
+
+def _from_env(name: str, max_concurrency: int, max_queue: int) -> Limiter:
+    # 环境变量：<NAME>_MAX_CONCURRENCY / <NAME>_RATE_LIMIT（每秒请求数，0 不限速）/ <NAME>_MAX_QUEUE
+    prefix = name.upper()
+    return Limiter(
+        name,
+        int(os.getenv(f"{prefix}_MAX_CONCURRENCY", max_concurrency)),
+        float(os.getenv(f"{prefix}_RATE_LIMIT", 0)),
+        int(os.getenv(f"{prefix}_MAX_QUEUE", max_queue)),
+    )
+
+
+limiters = {
+    "llm": _from_env("llm", 8, 32),
+    "web_search": _from_env("web_search", 4, 16),
+    "embedding": _from_env("embedding", 2, 32),
+    "mcp": _from_env("mcp", 8, 32),
+}
+
+
+def limiter(name: str) -> Limiter:
+    return limiters[name]
+
+
+def snapshot() -> dict:
+    return {name: item.snapshot() for name, item in limiters.items()}
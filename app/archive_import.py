@@ -0,0 +1,135 @@
+import os
+import tarfile
+import zipfile
+
+
+# 批量导入限制（可通过环境变量覆盖）
+IMPORT_MAX_FILES = int(os.getenv("IMPORT_MAX_FILES", 5000))                                 # 单个压缩包最多解压的文件数
+IMPORT_MAX_TOTAL_SIZE = int(os.getenv("IMPORT_MAX_TOTAL_SIZE", 2 * 1024 * 1024 * 1024))     # 解压后总大小上限（字节）
+IMPORT_MAX_FILE_SIZE = int(os.getenv("IMPORT_MAX_FILE_SIZE", 512 * 1024 * 1024))            # 单个文件解压后大小上限（字节）
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# 压缩工具附带的元数据目录和文件，不导入
+IGNORED_PARTS = ("__MACOSX", ".DS_Store", "Thumbs.db")
+
+
+class ImportLimitExceeded(Exception):
+    pass
+
+
+def _zip_name(info: zipfile.ZipInfo) -> str:
+    # Windows 下打包的中文文件名通常是 GBK 编码且没有 UTF-8 标记，zipfile 会按 cp437 解码
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode("cp437").decode("gbk")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+
+def _iter_zip(fileobj):
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            yield _zip_name(info), info.file_size, lambda info=info: archive.open(info)
+
+
+def _iter_tar(fileobj):
+    # 流式模式（r|*）按顺序读取，自动识别 gzip / bz2 / xz 压缩
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        for member in archive:
+            if member.isdir():
+                continue
+            if not member.isfile():
+                # 符号链接、硬链接、设备文件等不导入
+                yield member.name, member.size, None
+                continue
+            yield member.name, member.size, lambda member=member: archive.extractfile(member)
+
+
+def _copy(src, dest_path: str, limit: int) -> int:
+    # 分块复制并统计实际写入的字节数（不信任压缩包头部记录的大小），超过 limit 时中止
+    part_path = os.path.join(os.path.dirname(dest_path), f".{os.path.basename(dest_path)}.part")
+    written = 0
+    try:
+        with open(part_path, "wb") as f:
+            while block := src.read(COPY_BLOCK_SIZE):
+                written += len(block)
+                if written > limit:
+                    raise ImportLimitExceeded("解压后大小超过上限")
+                f.write(block)
+        os.replace(part_path, dest_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return written
+
+
+def extract(fileobj, filename: str, target_dir: str, join) -> dict:
+    """
+    把 zip / tar 压缩包逐个文件解压到 target_dir，内存占用与压缩包大小无关。
+    join 为校验目录穿越的路径拼接函数（flie_api.safe_join），非法路径抛异常。
+    返回 {"files": [每个文件的结果], "extracted": [解压出的完整路径], "total_size": 字节数, "error": 中止原因}
+    """
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        members = _iter_zip(fileobj)
+    else:
+        fileobj.seek(0)
+        members = _iter_tar(fileobj)
+
+    result = {"files": [], "extracted": [], "total_size": 0, "error": None}
+    try:
+        for name, size, open_member in members:
+            name = name.replace("\\", "/")
+            parts = [part for part in name.split("/") if part and part != "."]
+            if not parts:
+                continue
+            # 含 ".." 的条目、绝对路径（/xxx、C:xxx）都可能写到文档目录之外，直接跳过
+            if ".." in parts or name.startswith("/") or ":" in parts[0]:
+                result["files"].append({"name": name, "size": size, "status": "skipped", "reason": "非法路径"})
+                continue
+            if any(part in IGNORED_PARTS or part.startswith((".", "~$")) for part in parts):
+                continue
+            item = {"name": "/".join(parts), "size": size}
+            result["files"].append(item)
+            if open_member is None:
+                item.update(status="skipped", reason="不是普通文件")
+                continue
+            try:
+                dest_path = join(target_dir, *parts)
+            except Exception:
+                item.update(status="skipped", reason="非法路径")
+                continue
+            if len(result["extracted"]) >= IMPORT_MAX_FILES:
+                item.update(status="skipped", reason="文件数超过上限")
+                raise ImportLimitExceeded(f"文件数超过上限 {IMPORT_MAX_FILES}")
+            if size > IMPORT_MAX_FILE_SIZE:
+                item.update(status="skipped", reason="文件过大")
+                continue
+            remaining = IMPORT_MAX_TOTAL_SIZE - result["total_size"]
+            try:
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                with open_member() as src:
+                    written = _copy(src, dest_path, min(IMPORT_MAX_FILE_SIZE, remaining))
+            except ImportLimitExceeded:
+                if remaining < IMPORT_MAX_FILE_SIZE:
+                    item.update(status="skipped", reason="总大小超过上限")
+                    raise ImportLimitExceeded(f"解压后总大小超过上限 {IMPORT_MAX_TOTAL_SIZE} 字节")
+                item.update(status="skipped", reason="文件过大")
+                continue
+            except (OSError, zipfile.BadZipFile, tarfile.TarError, RuntimeError) as e:
+                # RuntimeError：加密的 zip 条目
+                item.update(status="failed", reason=str(e))
+                continue
+            result["total_size"] += written
+            result["extracted"].append(dest_path)
+            item.update(status="extracted", size=written)
+    except ImportLimitExceeded as e:
+        result["error"] = str(e)
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        if not result["files"]:
+            raise ValueError(f"无法识别的压缩包 {filename}: {str(e)}")
+        result["error"] = f"压缩包已损坏: {str(e)}"
+    return result
@@ -0,0 +1,146 @@
+"""
+合成中文语料：按行业主题生成带数字、机构名的段落，写成 TXT 或 PDF 文件。
+同一个 seed 生成的语料完全相同，不同版本的基准结果可以直接对比。
+"""
+import os
+import random
+
+
+TOPICS = {
+    "金融": (["银行", "证券", "基金", "保险", "信托"], ["净利润", "不良贷款率", "资本充足率", "管理规模", "保费收入"],
+            ["信用风险", "流动性风险", "利率波动", "监管政策", "资产质量"]),
+    "医疗": (["医院", "药业", "医疗器械", "生物科技", "健康"], ["门诊量", "研发投入", "药品销售额", "床位使用率", "临床试验数量"],
+            ["集采降价", "审批周期", "医保控费", "研发失败", "人才流失"]),
+    "教育": (["学校", "教育科技", "培训", "出版", "学院"], ["在校学生数", "课程完成率", "续费率", "教师人数", "线上用户数"],
+            ["政策调整", "招生下滑", "内容合规", "师资不足", "获客成本"]),
+    "制造": (["重工", "机械", "电子", "汽车", "材料"], ["产能利用率", "良品率", "订单交付量", "单位能耗", "库存周转天数"],
+            ["原材料涨价", "供应链中断", "设备老化", "安全生产", "汇率波动"]),
+    "能源": (["电力", "新能源", "石化", "燃气", "储能"], ["发电量", "装机容量", "碳排放强度", "输送量", "储能规模"],
+            ["电价改革", "极端天气", "补贴退坡", "并网消纳", "安全事故"]),
+    "零售": (["商贸", "超市", "电商", "百货", "连锁"], ["销售额", "客单价", "坪效", "会员复购率", "线上渗透率"],
+            ["消费疲软", "租金上涨", "价格战", "库存积压", "渠道冲突"]),
+}
+CITIES = ["北京", "上海", "广州", "深圳", "杭州", "成都", "武汉", "南京", "西安", "重庆", "苏州", "天津", "长沙", "郑州", "青岛"]
+NAME_PARTS = ["华", "信", "中", "科", "盛", "达", "恒", "远", "新", "泰", "安", "宏", "瑞", "博", "创", "嘉", "融", "通", "鼎", "凯"]
+UNITS = ["亿元", "万元", "万人次", "万吨", "亿千瓦时", "个百分点"]
+
+SENTENCES = [
+    "{org}{year}年第{quarter}季度{metric}为{num}{unit}，同比{trend}{pct}%。",
+    "报告期内，{org}在{city}新设{count}个业务网点，{metric}较上年{trend}{pct}%。",
+    "管理层认为，{risk}是{org}未来{count}年面临的主要挑战之一。",
+    "{city}地区贡献了{org}约{pct}%的{metric}，是公司第{count}大区域市场。",
+    "截至{year}年末，{org}累计{metric}达到{num}{unit}，高于行业平均水平。",
+    "针对{risk}，{org}计划在{year}年投入{num}{unit}用于系统建设和人员培训。",
+    "与同业相比，{org}的{metric}排名第{count}位，{trend}幅度位居前列。",
+    "{org}与{org2}在{city}签署战略合作协议，合作期限为{count}年。",
+]
+
+
+def _org(rng: random.Random, topic: str) -> str:
+    suffixes = TOPICS[topic][0]
+    return rng.choice(CITIES) + "".join(rng.sample(NAME_PARTS, 2)) + rng.choice(suffixes)
+
+
+def _sentence(rng: random.Random, topic: str) -> str:
+    _, metrics, risks = TOPICS[topic]
+    return rng.choice(SENTENCES).format(
+        org=_org(rng, topic), org2=_org(rng, topic), city=rng.choice(CITIES),
+        year=rng.randint(2015, 2025), quarter=rng.randint(1, 4), metric=rng.choice(metrics), risk=rng.choice(risks),
+        num=round(rng.uniform(1, 9999), 2), unit=rng.choice(UNITS), trend=rng.choice(["增长", "下降"]),
+        pct=round(rng.uniform(0.1, 60), 1), count=rng.randint(2, 30),
+    )
+
+
+def generate_pages(rng: random.Random, topic: str, pages: int, page_chars: int) -> list:
+    """每页由若干段落组成，段落之间换行，每页约 page_chars 个字符"""
+    result = []
+    for _ in range(pages):
+        paragraphs, size = [], 0
+        while size < page_chars:
+            paragraph = "".join(_sentence(rng, topic) for _ in range(rng.randint(3, 6)))
+            paragraphs.append(paragraph)
+            size += len(paragraph)
+        result.append("\n".join(paragraphs))
+    return result
+
+
+def _wrap(text: str, width: int) -> list:
+    lines = []
+    for paragraph in text.split("\n"):
+        lines.extend(paragraph[i:i + width] for i in range(0, len(paragraph), width))
+    return lines
+
+
+def write_pdf(path: str, pages: list, line_chars: int = 38, lines_per_page: int = 46):
+    """
+    写出只含文本的 PDF：使用 PDF 阅读器内置的 STSong-Light 字体和 UniGB-UCS2-H 编码，
+    不需要嵌入字体文件，pypdf 可以直接提取出原文。页面放不下的内容顺延到下一页。
+    """
+    page_lines = []
+    for text in pages:
+        lines = _wrap(text, line_chars)
+        page_lines.extend(lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page))
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,       # 页面树，页面对象生成后再填
+        b"<< /Type /Font /Subtype /Type0 /BaseFont /STSong-Light /Encoding /UniGB-UCS2-H /DescendantFonts [4 0 R] >>",
+        b"<< /Type /Font /Subtype /CIDFontType0 /BaseFont /STSong-Light "
+        b"/CIDSystemInfo << /Registry (Adobe) /Ordering (GB1) /Supplement 4 >> /FontDescriptor 5 0 R /DW 1000 >>",
+        b"<< /Type /FontDescriptor /FontName /STSong-Light /Flags 6 /FontBBox [-25 -254 1000 880] "
+        b"/ItalicAngle 0 /Ascent 880 /Descent -120 /CapHeight 880 /StemV 93 >>",
+    ]
+    kids = []
+    for lines in page_lines:
+        content = "\n".join(
+            ["BT /F1 12 Tf 16 TL 50 790 Td"] + [f"<{line.encode('utf-16-be').hex()}> Tj T*" for line in lines] + ["ET"]
+        ).encode("ascii")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects))
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        " ".join(f"{kid} 0 R" for kid in kids).encode("ascii"), len(kids)
+    )
+
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def generate(target_dir: str, docs: int, pages: int = 5, page_chars: int = 1200, pdf_ratio: float = 0.5,
+             seed: int = 42) -> dict:
+    """在 target_dir 下按主题分目录生成 docs 个文档，返回语料统计"""
+    rng = random.Random(seed)
+    stats = {"docs": 0, "pdf": 0, "txt": 0, "pages": 0, "chars": 0, "bytes": 0}
+    topics = list(TOPICS)
+    for i in range(docs):
+        topic = topics[i % len(topics)]
+        doc_pages = generate_pages(rng, topic, max(1, rng.randint(pages // 2, pages * 3 // 2)), page_chars)
+        title = f"{topic}行业{rng.randint(2015, 2025)}年度报告（第{i + 1}号）"
+        doc_pages[0] = f"{title}\n{doc_pages[0]}"
+        os.makedirs(os.path.join(target_dir, topic), exist_ok=True)
+        if rng.random() < pdf_ratio:
+            path = os.path.join(target_dir, topic, f"{title}.pdf")
+            write_pdf(path, doc_pages)
+            stats["pdf"] += 1
+        else:
+            path = os.path.join(target_dir, topic, f"{title}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\n".join(doc_pages))
+            stats["txt"] += 1
+        stats["docs"] += 1
+        stats["pages"] += len(doc_pages)
+        stats["chars"] += sum(len(page) for page in doc_pages)
+        stats["bytes"] += os.path.getsize(path)
+    return stats
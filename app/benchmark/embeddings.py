@@ -0,0 +1,39 @@
+"""
+基准测试用的向量模型替身：对文本中出现过的相邻两字做特征哈希，不需要下载模型，CPU 上很快，
+适合在 CI 中跑完整的导入和检索流程。检索质量不代表真实模型，只用于对比不同版本和索引类型。
+"""
+import zlib
+
+import numpy as np
+
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:
+    Embeddings = object
+
+
+class HashingEmbeddings(Embeddings):
+
+    def __init__(self, dim: int = 768):       # 与 m3e-base 的维度相同，索引大小和检索耗时有可比性
+        self.dim = dim
+
+    def _embed(self, text: str) -> list:
+        chars = [ch for ch in text if not ch.isspace()]
+        # 只看是否出现、不计次数，模板化的高频短语不会压过机构名、数字等区分性内容
+        grams = list({a + b for a, b in zip(chars, chars[1:])})
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if grams:
+            hashes = np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint32, count=len(grams))
+            # 最高位决定符号，降低哈希冲突带来的偏差
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+            np.add.at(vector, hashes % self.dim, signs)
+            norm = np.linalg.norm(vector)
+            if norm:
+                vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: list) -> list:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self._embed(text)
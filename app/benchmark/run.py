@@ -0,0 +1,312 @@
+"""
+导入与检索基准：生成合成中文语料（PDF / TXT），按生产流程逐阶段计时
+（解析、切分、向量化、建索引），再在不同文本块数量下对比各类 FAISS 索引的
+构建耗时、查询延迟和 recall@k，全程记录峰值内存，结果写入 JSON 报告。
+在 app 目录下运行：
+    python -m benchmark.run --docs 150 --scales 1000,2000 --report benchmark_report.json         # CI：哈希向量替身
+    python -m benchmark.run --docs 2000 --model m3e --scales 10000,50000,100000 --report m3e.json  # 真实模型
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import faiss
+import numpy as np
+
+import indexer
+from benchmark import corpus
+from benchmark.embeddings import HashingEmbeddings
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_TYPES = ("flat", "hnsw", "ivf")
+
+
+class RssMonitor:
+    """后台线程定时采样常驻内存，记录每个阶段内的峰值（MB）"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.stage_peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-monitor", daemon=True)
+
+    @staticmethod
+    def current() -> float:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+        except OSError:
+            return RssMonitor.peak()
+
+    @staticmethod
+    def peak() -> float:
+        # Linux 下 ru_maxrss 单位为 KB，macOS 为字节
+        scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.stage_peak = max(self.stage_peak, self.current())
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @contextmanager
+    def stage(self, results: dict, name: str):
+        """记录一个阶段的耗时和阶段内的峰值内存，写入 results[name]"""
+        self.stage_peak = self.current()
+        started_at = time.perf_counter()
+        entry = results.setdefault(name, {})
+        try:
+            yield entry
+        finally:
+            entry["seconds"] = round(time.perf_counter() - started_at, 4)
+            entry["peak_rss_mb"] = round(max(self.stage_peak, self.current()), 1)
+
+
+def load_embeddings(model: str, dim: int):
+    if model == "hash":
+        return HashingEmbeddings(dim)
+    if model == "m3e":
+        # 与线上相同：本地没有模型时从网络下载并保存到 LOCAL_MODEL_PATH
+        return indexer.get_embeddings()
+    return indexer.HuggingFaceEmbeddings(model_name=model)
+
+
+def ingest(corpus_dir: str, embeddings, batch_size: int, monitor: RssMonitor, workdir: str):
+    """按 indexer 的流程导入语料，返回 (阶段统计, 文本块, 向量矩阵)"""
+    stages = {}
+    files = sorted(
+        os.path.join(root, name) for root, _, names in os.walk(corpus_dir) for name in names if indexer.is_supported(name)
+    )
+    with monitor.stage(stages, "parse") as entry:
+        parsed = [(path, indexer.load_texts(path)) for path in files]
+        entry["files"] = len(parsed)
+        entry["pages"] = sum(len(texts) for _, texts in parsed)
+        entry["chars"] = sum(len(text) for _, texts in parsed for text in texts)
+
+    chunks, sources = [], []
+    with monitor.stage(stages, "split") as entry:
+        for path, texts in parsed:
+            for chunk in indexer.split_texts(texts):
+                chunks.append(chunk)
+                sources.append(os.path.relpath(path, corpus_dir))
+        entry["chunks"] = len(chunks)
+        entry["avg_chunk_chars"] = round(sum(map(len, chunks)) / len(chunks), 1) if chunks else 0
+
+    vectors = []
+    with monitor.stage(stages, "embed") as entry:
+        for i in range(0, len(chunks), batch_size):
+            vectors.extend(embeddings.embed_documents(chunks[i:i + batch_size]))
+        entry["batch_size"] = batch_size
+
+    with monitor.stage(stages, "index_build"):
+        vectorstore = indexer.FAISS.from_embeddings(
+            list(zip(chunks, vectors)), embeddings, metadatas=[{"source": source} for source in sources]
+        )
+    with monitor.stage(stages, "index_save") as entry:
+        index_dir = os.path.join(workdir, "faiss_index")
+        vectorstore.save_local(index_dir)
+        entry["bytes"] = sum(os.path.getsize(os.path.join(index_dir, name)) for name in os.listdir(index_dir))
+    del vectorstore
+
+    # 吞吐按阶段耗时计算（上下文退出后才有 seconds）
+    stages["parse"]["files_per_second"] = _rate(stages["parse"]["files"], stages["parse"]["seconds"])
+    stages["parse"]["pages_per_second"] = _rate(stages["parse"]["pages"], stages["parse"]["seconds"])
+    stages["split"]["chunks_per_second"] = _rate(len(chunks), stages["split"]["seconds"])
+    stages["embed"]["chunks_per_second"] = _rate(len(chunks), stages["embed"]["seconds"])
+    stages["index_build"]["chunks_per_second"] = _rate(len(chunks), stages["index_build"]["seconds"])
+    return stages, chunks, np.asarray(vectors, dtype=np.float32)
+
+
+def _rate(count: int, seconds: float):
+    return round(count / seconds, 2) if seconds else None
+
+
+def build_index(index_type: str, vectors: np.ndarray, args):
+    dim = vectors.shape[1]
+    if index_type == "flat":
+        # 与线上一致：langchain 的 FAISS 默认使用 IndexFlatL2
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, args.hnsw_m)
+        index.hnsw.efConstruction = args.hnsw_ef_construction
+        index.hnsw.efSearch = args.hnsw_ef_search
+    elif index_type == "ivf":
+        nlist = max(1, min(args.ivf_nlist or int(4 * np.sqrt(len(vectors))), len(vectors) // 39 or 1))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, nlist)
+        index.train(vectors)
+        index.nprobe = min(args.ivf_nprobe, nlist)
+    else:
+        raise ValueError(f"未知的索引类型: {index_type}")
+    index.add(vectors)
+    return index
+
+
+def make_queries(chunks: list, count: int, rng: random.Random) -> list:
+    """
+    从文本块中截取一段文字并随机删去约 10% 的字作为查询，
+    包含该段原文的所有文本块（相邻块有重叠）都算作相关结果。
+    """
+    queries = []
+    for source in rng.sample(range(len(chunks)), min(count, len(chunks))):
+        text = chunks[source].replace("\n", "")
+        length = min(len(text), rng.randint(24, 40))
+        start = rng.randint(0, len(text) - length)
+        window = text[start:start + length]
+        query = "".join(ch for ch in window if rng.random() > 0.1)
+        relevant = {i for i, chunk in enumerate(chunks) if window in chunk.replace("\n", "")}
+        queries.append((query, relevant))
+    return queries
+
+
+def percentiles(values: list) -> dict:
+    values = sorted(values)
+    return {f"p{p}": round(values[max(0, int(np.ceil(p / 100 * len(values))) - 1)] * 1000, 3) for p in (50, 95, 99)}
+
+
+def bench_retrieval(chunks: list, vectors: np.ndarray, embeddings, args, monitor: RssMonitor) -> list:
+    results = []
+    ks = sorted(args.k)
+    rng = random.Random(args.seed)
+    for scale in args.scales:
+        if scale > len(chunks):
+            results.append({"chunks": scale, "skipped": f"语料只有 {len(chunks)} 个文本块，请增大 --docs"})
+            continue
+        subset = vectors[:scale]
+        queries = make_queries(chunks[:scale], args.queries, rng)
+        started_at = time.perf_counter()
+        query_vectors = np.asarray([embeddings.embed_query(query) for query, _ in queries], dtype=np.float32)
+        embed_ms = (time.perf_counter() - started_at) * 1000 / len(queries)
+
+        exact = None
+        for index_type in args.index_types:
+            stages = {}
+            with monitor.stage(stages, "build"):
+                index = build_index(index_type, subset, args)
+            latencies, found = [], []
+            with monitor.stage(stages, "search"):
+                for vector in query_vectors:
+                    started_at = time.perf_counter()
+                    _, ids = index.search(vector.reshape(1, -1), ks[-1])
+                    latencies.append(time.perf_counter() - started_at)
+                    found.append([i for i in ids[0] if i >= 0])
+            entry = {
+                "chunks": scale,
+                "index_type": index_type,
+                "build_seconds": stages["build"]["seconds"],
+                "build_peak_rss_mb": stages["build"]["peak_rss_mb"],
+                "index_bytes": int(faiss.serialize_index(index).size),
+                "queries": len(queries),
+                "query_embed_ms": round(embed_ms, 3),
+                "search_ms": percentiles(latencies),
+                "qps": _rate(len(queries), sum(latencies)),
+                # 相关文本块出现在前 k 个结果中的查询比例
+                "recall_at_k": {
+                    str(k): round(np.mean([bool(relevant & set(ids[:k])) for (_, relevant), ids in zip(queries, found)]), 4)
+                    for k in ks
+                },
+            }
+            if index_type == "flat":
+                exact = found
+            elif exact is not None:
+                # 近似索引相对精确检索的召回：前 k 个结果与 flat 的重合比例
+                entry["ann_recall_at_k"] = {
+                    str(k): round(np.mean([len(set(a[:k]) & set(e[:k])) / k for a, e in zip(found, exact)]), 4)
+                    for k in ks
+                }
+            results.append(entry)
+            del index
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=APP_DIR, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args) -> dict:
+    monitor = RssMonitor()
+    monitor.start()
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        corpus_dir = args.corpus_dir or os.path.join(workdir, "corpus")
+        report = {"config": {key: value for key, value in vars(args).items() if key != "report"},
+                  "revision": git_revision(), "environment": {
+                      "python": platform.python_version(), "platform": platform.platform(),
+                      "cpus": os.cpu_count(), "faiss": faiss.__version__,
+                  }, "stages": {}}
+        if not (args.corpus_dir and os.path.isdir(args.corpus_dir) and os.listdir(args.corpus_dir)):
+            with monitor.stage(report["stages"], "generate_corpus") as entry:
+                entry.update(corpus.generate(corpus_dir, args.docs, args.pages, args.page_chars, args.pdf_ratio, args.seed))
+        with monitor.stage(report["stages"], "model_load"):
+            embeddings = load_embeddings(args.model, args.dim)
+        stages, chunks, vectors = ingest(corpus_dir, embeddings, args.batch_size, monitor, workdir)
+        report["stages"].update(stages)
+        report["retrieval"] = bench_retrieval(chunks, vectors, embeddings, args, monitor)
+        report["peak_rss_mb"] = round(RssMonitor.peak(), 1)
+        return report
+    finally:
+        monitor.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _int_list(value: str) -> list:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文档导入与向量检索基准测试")
+    parser.add_argument("--docs", type=int, default=150, help="生成的文档数")
+    parser.add_argument("--pages", type=int, default=5, help="每个文档的平均页数")
+    parser.add_argument("--page-chars", type=int, default=1200, help="每页的字符数")
+    parser.add_argument("--pdf-ratio", type=float, default=0.5, help="PDF 文档所占比例，其余为 TXT")
+    parser.add_argument("--corpus-dir", default="", help="语料目录：已存在且非空时直接使用，否则在此生成（默认临时目录）")
+    parser.add_argument("--model", default="hash",
+                        help="向量模型：hash（哈希替身，CI 用）、m3e（线上模型）或 HuggingFace 模型名 / 本地路径")
+    parser.add_argument("--dim", type=int, default=768, help="hash 替身的向量维度")
+    parser.add_argument("--batch-size", type=int, default=64, help="向量化的批大小")
+    parser.add_argument("--scales", type=_int_list, default=[1000, 2000], help="逗号分隔的检索规模（文本块数）")
+    parser.add_argument("--index-types", type=lambda v: [t for t in v.split(",") if t], default=list(INDEX_TYPES),
+                        help=f"逗号分隔的索引类型，可选 {', '.join(INDEX_TYPES)}")
+    parser.add_argument("--queries", type=int, default=200, help="每个规模的查询数")
+    parser.add_argument("--k", type=_int_list, default=[1, 3, 10], help="逗号分隔的 recall@k")
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--hnsw-ef-construction", type=int, default=80)
+    parser.add_argument("--hnsw-ef-search", type=int, default=64)
+    parser.add_argument("--ivf-nlist", type=int, default=0, help="IVF 聚类数，0 表示按 4·√N 自动选择")
+    parser.add_argument("--ivf-nprobe", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--report", default="", help="JSON 报告的输出路径，默认打印到标准输出")
+    args = parser.parse_args()
+    unknown = [t for t in args.index_types if t not in INDEX_TYPES]
+    if unknown:
+        parser.error(f"未知的索引类型：{', '.join(unknown)}")
+
+    text = json.dumps(run(args), ensure_ascii=False, indent=2)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import zlib
+from datetime import datetime, timedelta
+
+import storage
+from storage import ARCHIVE_TABLE
+
+logger = logging.getLogger(__name__)
+
+
+# 保留策略配置（可通过环境变量覆盖）
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 90))                   # 会话多少天未更新后归档，0 表示不归档
+ARCHIVE_PURGE_AFTER_DAYS = int(os.getenv("ARCHIVE_PURGE_AFTER_DAYS", 0))        # 归档会话多少天未更新后彻底删除，0 表示永久保留
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", 3600))                   # 后台维护间隔（秒），0 表示关闭
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 50))                   # 每个事务归档的会话数
+VACUUM_PAGES_PER_STEP = int(os.getenv("VACUUM_PAGES_PER_STEP", 500))            # 每次增量回收的页数
+ARCHIVE_BATCH_PAUSE = 0.1               # 批次之间让出写锁的时间（秒）
+
+# 热表与归档表合并后的会话列表，按 (updated_at, id) 排序时两边都能走索引
+SESSIONS_UNION = f'''
+    SELECT id, summary, created_at, updated_at, 0 AS archived FROM chat_sessions
+    UNION ALL
+    SELECT id, summary, created_at, updated_at, 1 AS archived FROM {ARCHIVE_TABLE}
+'''
+
+_maintenance_task = None
+_vacuum_warned = set()
+
+
+async def fetch_sessions(conditions: list, params: list, order: str, limit: int) -> list:
+    """
+    按条件分页查询热表和归档表中的会话。两边各自按索引取 limit 条再合并排序，
+    避免对合并结果整体排序。order 为 "ASC" 或 "DESC"，按 (updated_at, id) 排序。
+    """
+    where = " AND ".join(conditions) or "1"
+    order_by = f"ORDER BY updated_at {order}, id {order}"
+    sides = [
+        f"SELECT * FROM (SELECT id, summary, created_at, updated_at, {archived} AS archived FROM {table} "
+        f"WHERE {where} {order_by} LIMIT ?)"
+        for table, archived in (("chat_sessions", 0), (ARCHIVE_TABLE, 1))
+    ]
+    return await storage.fetch_all(
+        f"{sides[0]} UNION ALL {sides[1]} {order_by} LIMIT ?",
+        (*params, limit, *params, limit, limit)
+    )
+
+
+def _cutoff(days: int) -> str:
+    return (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _archive_batch(conn, cutoff: str) -> int:
+    """把一批最后更新时间早于 cutoff 的会话移到归档表，返回归档的会话数"""
+    with storage.transaction(conn):
+        sessions = conn.execute(
+            "SELECT id, summary, created_at, updated_at, memory_summary, memory_upto FROM chat_sessions "
+            "WHERE updated_at < ? ORDER BY updated_at LIMIT ?",
+            (cutoff, ARCHIVE_BATCH_SIZE)
+        ).fetchall()
+        archived_at = storage.now()
+        for session in sessions:
+            messages = [
+                dict(row) for row in conn.execute(
+                    "SELECT id, role, content, created_at FROM messages WHERE session_id = ? ORDER BY id",
+                    (session["id"],)
+                ).fetchall()
+            ]
+            payload = zlib.compress(json.dumps({
+                "memory_summary": session["memory_summary"],
+                "memory_upto": session["memory_upto"],
+                "messages": messages,
+            }, ensure_ascii=False).encode("utf-8"))
+            conn.execute(
+                f"INSERT OR REPLACE INTO {ARCHIVE_TABLE} "
+                "(id, summary, created_at, updated_at, archived_at, message_count, payload) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session["id"], session["summary"], session["created_at"], session["updated_at"],
+                 archived_at, len(messages), payload)
+            )
+            # 删除消息时全文索引由触发器同步删除
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session["id"],))
+            conn.execute("DELETE FROM chat_sessions WHERE id = ?", (session["id"],))
+        return len(sessions)
+
+
+def _purge_batch(conn, cutoff: str) -> int:
+    with storage.transaction(conn):
+        return conn.execute(
+            f"DELETE FROM {ARCHIVE_TABLE} WHERE id IN "
+            f"(SELECT id FROM {ARCHIVE_TABLE} WHERE updated_at < ? LIMIT ?)",
+            (cutoff, ARCHIVE_BATCH_SIZE)
+        ).rowcount
+
+
+def _vacuum(conn, schema: str) -> int:
+    """回收空闲页，返回回收前的空闲页数"""
+    free_pages = conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+    if conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] != 2:
+        # 已有的库需要完整 VACUUM 一次才能切换到增量模式，VACUUM 独占整个库，
+        # 不在后台自动执行，只提示一次，由运维在停服后手动执行
+        if schema not in _vacuum_warned:
+            _vacuum_warned.add(schema)
+            logger.warning(
+                "数据库 %s 未启用增量回收，跳过空闲页回收（%d 页）；停服后执行 python -m chat_archive --enable-incremental-vacuum 启用",
+                schema, free_pages
+            )
+    elif free_pages:
+        conn.execute(f"PRAGMA {schema}.incremental_vacuum({VACUUM_PAGES_PER_STEP})")
+    return free_pages
+
+
+def _enable_incremental_vacuum(conn, schema: str) -> bool:
+    """把已有的库切换到增量回收模式（完整 VACUUM 一次），已启用时返回 False"""
+    if conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] == 2:
+        return False
+    logger.info("数据库 %s 执行 VACUUM 以启用增量回收", schema)
+    conn.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+    conn.execute(f"VACUUM {schema}")
+    return True
+
+
+async def run_maintenance() -> dict:
+    """执行一轮维护：归档过期会话、清理过期归档、回收空闲页"""
+    result = {"archived": 0, "purged": 0, "free_pages": 0}
+    if ARCHIVE_AFTER_DAYS > 0:
+        cutoff = _cutoff(ARCHIVE_AFTER_DAYS)
+        while True:
+            count = await storage.run(_archive_batch, cutoff)
+            result["archived"] += count
+            if count < ARCHIVE_BATCH_SIZE:
+                break
+            await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+    if ARCHIVE_PURGE_AFTER_DAYS > 0:
+        cutoff = _cutoff(ARCHIVE_PURGE_AFTER_DAYS)
+        while True:
+            count = await storage.run(_purge_batch, cutoff)
+            result["purged"] += count
+            if count < ARCHIVE_BATCH_SIZE:
+                break
+            await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+    for schema in _schemas():
+        result["free_pages"] += await storage.run(_vacuum, schema)
+    return result
+
+
+async def _maintenance_loop():
+    while True:
+        try:
+            result = await run_maintenance()
+            if result["archived"] or result["purged"]:
+                logger.info("聊天记录维护完成: 归档 %d 个会话，清理 %d 个归档", result["archived"], result["purged"])
+        except Exception as e:
+            logger.exception("聊天记录维护失败: %s", e)
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+
+def start_maintenance():
+    global _maintenance_task
+    if ARCHIVE_INTERVAL <= 0:
+        return
+    if _maintenance_task is None or _maintenance_task.done():
+        _maintenance_task = asyncio.create_task(_maintenance_loop())
+
+
+async def stop_maintenance():
+    global _maintenance_task
+    if _maintenance_task is not None:
+        _maintenance_task.cancel()
+        try:
+            await _maintenance_task
+        except asyncio.CancelledError:
+            pass
+        _maintenance_task = None
+
+
+async def get_session(session_id: str):
+    """读取归档会话，返回会话信息和解压后的全部消息（按 id 正序），不存在返回 None"""
+    row = await storage.fetch_one(
+        f"SELECT id, summary, created_at, updated_at, payload FROM {ARCHIVE_TABLE} WHERE id = ?",
+        (session_id,)
+    )
+    if not row:
+        return None
+    data = json.loads(zlib.decompress(row.pop("payload")))
+    row.update(data, archived=1)
+    return row
+
+
+def _restore(conn, session_id: str) -> bool:
+    with storage.transaction(conn):
+        row = conn.execute(
+            f"SELECT id, summary, created_at, updated_at, payload FROM {ARCHIVE_TABLE} WHERE id = ?",
+            (session_id,)
+        ).fetchone()
+        if not row:
+            return False
+        data = json.loads(zlib.decompress(row["payload"]))
+        # updated_at 记为恢复时间，否则马上又满足归档条件，下一轮归档会把刚恢复的会话再移走
+        conn.execute(
+            "INSERT INTO chat_sessions (id, summary, created_at, updated_at, memory_summary, memory_upto) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (row["id"], row["summary"], row["created_at"], storage.now(),
+             data.get("memory_summary"), data.get("memory_upto") or 0)
+        )
+        # 保留原消息 id，触发器会重新写入全文索引
+        conn.executemany(
+            "INSERT INTO messages (id, session_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(m["id"], session_id, m["role"], m["content"], m["created_at"]) for m in data["messages"]]
+        )
+        conn.execute(f"DELETE FROM {ARCHIVE_TABLE} WHERE id = ?", (session_id,))
+        return True
+
+
+async def restore_session(session_id: str) -> bool:
+    """归档会话收到新消息时移回热表，返回是否恢复成功"""
+    return await storage.run(_restore, session_id)
+
+
+def _schemas() -> list:
+    return ["main", "archive"] if storage.ARCHIVE_DB_PATH else ["main"]
+
+
+async def enable_incremental_vacuum() -> dict:
+    """对每个库执行一次完整 VACUUM 以启用增量回收，返回 {库名: 是否执行了 VACUUM}"""
+    result = {}
+    for schema in _schemas():
+        result[schema] = await storage.run(_enable_incremental_vacuum, schema)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天记录维护")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="完整 VACUUM 一次，把已有的库切换到增量回收模式（独占整个库，请在停服后执行）")
+    args = parser.parse_args()
+    if not args.enable_incremental_vacuum:
+        parser.print_help()
+        return
+    logging.basicConfig(level=logging.INFO)
+    try:
+        for schema, vacuumed in asyncio.run(enable_incremental_vacuum()).items():
+            print(f"{schema}: {'已启用增量回收' if vacuumed else '已是增量回收模式，无需处理'}")
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    main()
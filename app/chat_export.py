@@ -0,0 +1,117 @@
+import json
+import zipfile
+
+import chat_archive
+import storage
+
+
+# 每次从数据库读取的行数，导出过程中内存占用只与这个批大小有关
+EXPORT_BATCH_SIZE = 200
+
+
+async def iter_session_messages(session_id: str):
+    # 按消息 id 分批读取（走 (session_id, id) 索引），不会一次性加载整个会话
+    last_id = 0
+    while True:
+        rows = await storage.fetch_all(
+            "SELECT id, role, content, created_at FROM messages WHERE session_id = ? AND id > ? ORDER BY id LIMIT ?",
+            (session_id, last_id, EXPORT_BATCH_SIZE)
+        )
+        for row in rows:
+            yield row
+        if len(rows) < EXPORT_BATCH_SIZE:
+            return
+        last_id = rows[-1]["id"]
+
+
+async def iter_archived_messages(session_id: str):
+    # 归档会话的消息整体压缩存储，解压后逐条输出
+    session = await chat_archive.get_session(session_id)
+    for message in (session["messages"] if session else []):
+        yield message
+
+
+def session_messages(session: dict):
+    if session.get("archived"):
+        return iter_archived_messages(session["id"])
+    return iter_session_messages(session["id"])
+
+
+async def iter_sessions(start: str = None, end: str = None):
+    # 按 (updated_at, id) 顺序分批遍历会话（包括已归档的会话），可按最后更新时间过滤
+    last = ("", "")
+    while True:
+        conditions, params = ["(updated_at, id) > (?, ?)"], list(last)
+        if start:
+            conditions.append("updated_at >= ?")
+            params.append(start)
+        if end:
+            conditions.append("updated_at < ?")
+            params.append(end)
+        rows = await chat_archive.fetch_sessions(conditions, params, "ASC", EXPORT_BATCH_SIZE)
+        for row in rows:
+            yield row
+        if len(rows) < EXPORT_BATCH_SIZE:
+            return
+        last = (rows[-1]["updated_at"], rows[-1]["id"])
+
+
+async def session_markdown(session: dict):
+    """逐段生成单个会话的 markdown 内容"""
+    yield f"# 会话历史记录\n\n"
+    yield f"## 会话ID: {session['id']}\n\n"
+    yield f"## 会话总结: {session['summary']}\n\n"
+    async for message in session_messages(session):
+        yield f"### {message['role']}\n\n{message['content']}\n\n"
+
+
+async def sessions_ndjson(start: str = None, end: str = None):
+    """每行一条消息的 NDJSON，附带所属会话信息"""
+    async for session in iter_sessions(start, end):
+        async for message in session_messages(session):
+            yield json.dumps({
+                "session_id": session["id"],
+                "summary": session["summary"],
+                "session_created_at": session["created_at"],
+                "session_updated_at": session["updated_at"],
+                "message_id": message["id"],
+                "role": message["role"],
+                "content": message["content"],
+                "created_at": message["created_at"],
+            }, ensure_ascii=False) + "\n"
+
+
+class _StreamBuffer:
+    # zipfile 的输出目标：只追加写入，由生成器在每次写入后取走数据
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+async def sessions_zip(start: str = None, end: str = None):
+    """边生成边输出的 zip，每个会话一个 markdown 文件"""
+    buffer = _StreamBuffer()
+    # 输出流不可 seek，zipfile 会自动使用数据描述符写入每个文件的大小和 CRC
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        async for session in iter_sessions(start, end):
+            with archive.open(f"session_{session['id']}.md", mode="w", force_zip64=True) as entry:
+                async for part in session_markdown(session):
+                    entry.write(part.encode("utf-8"))
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    yield buffer.drain()
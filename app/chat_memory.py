@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+
+import admission
+import storage
+from write_queue import write_queue
+
+logger = logging.getLogger(__name__)
+
+
+# 会话记忆配置（可通过环境变量覆盖）
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", 6))                 # 原文保留最近多少轮对话
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", 2000))              # 最近对话原文的 token 上限
+MEMORY_SUMMARY_MAX_TOKENS = int(os.getenv("MEMORY_SUMMARY_MAX_TOKENS", 500))   # 滚动摘要的 token 上限
+MEMORY_FOLD_BATCH = 20                  # 单次合并进摘要的最多消息数
+MEMORY_FOLD_MESSAGE_CHARS = 1000        # 合并时每条消息最多取多少字符
+MEMORY_FOLD_MAX_ROUNDS = int(os.getenv("MEMORY_FOLD_MAX_ROUNDS", 3))           # 每次调度最多调用几轮大模型合并摘要，剩余的留到下一轮对话后
+
+_updating = {}
+
+
+def estimate_tokens(text: str) -> int:
+    # 粗略估算：中日韩字符约 1 token/字，其他字符约 4 字符/token
+    cjk = sum(1 for ch in text if ch >= "⺀")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 按估算比例截断，保留开头部分
+    keep = max(1, len(text) * max_tokens // estimate_tokens(text))
+    return text[:keep] + "..."
+
+
+async def build_history(session_id: str) -> list:
+    """
+    返回拼接在本轮问题之前的对话消息：滚动摘要（如有）+ 最近若干轮原文。
+    总长度受 MEMORY_SUMMARY_MAX_TOKENS 和 MEMORY_TOKEN_BUDGET 限制，不随会话变长而增长。
+    """
+    session = await storage.fetch_one(
+        "SELECT memory_summary, memory_upto FROM chat_sessions WHERE id = ?",
+        (session_id,)
+    )
+    if not session:
+        return []
+
+    rows = await storage.fetch_all(
+        "SELECT role, content FROM messages WHERE session_id = ? AND id > ? ORDER BY id DESC LIMIT ?",
+        (session_id, session["memory_upto"], MEMORY_RECENT_TURNS * 2)
+    )
+    # 从最新的消息往前取，直到用完 token 预算
+    recent, budget = [], MEMORY_TOKEN_BUDGET
+    for row in rows:
+        content = row["content"] or ""
+        tokens = estimate_tokens(content)
+        if tokens > budget:
+            if not recent:
+                recent.append({"role": row["role"], "content": _truncate(content, budget)})
+            break
+        recent.append({"role": row["role"], "content": content})
+        budget -= tokens
+    recent.reverse()
+
+    history = []
+    if session["memory_summary"]:
+        history.append({"role": "system", "content": f"此前对话的摘要：\n{session['memory_summary']}"})
+    return history + recent
+
+
+def _summary_prompt(summary: str, messages: list) -> str:
+    dialogue = "\n".join(
+        f"{'用户' if message['role'] == 'user' else '助手'}: {message['content'][:MEMORY_FOLD_MESSAGE_CHARS]}"
+        for message in messages
+    )
+    return (
+        f"已有摘要:\n{summary or '无'}\n\n"
+        f"新增对话:\n{dialogue}\n\n"
+        f"请把新增对话合并进已有摘要，保留用户的目标、关键事实、结论和未解决的问题，"
+        f"不超过 {MEMORY_SUMMARY_MAX_TOKENS} 字，只输出摘要内容。"
+    )
+
+
+async def update_summary(session_id: str, ai_client, model_name: str):
+    """
+    把滑出最近窗口的消息合并进滚动摘要，每轮最多合并 MEMORY_FOLD_BATCH 条，
+    直到窗口外没有未合并的消息或达到 MEMORY_FOLD_MAX_ROUNDS 轮
+    """
+    window = MEMORY_RECENT_TURNS * 2
+    for _ in range(MEMORY_FOLD_MAX_ROUNDS):
+        session = await storage.fetch_one(
+            "SELECT memory_summary, memory_upto FROM chat_sessions WHERE id = ?",
+            (session_id,)
+        )
+        if not session:
+            return
+        # 只取一批待合并的消息加上最近窗口，长会话积压很多未合并消息时也不会整段读出
+        rows = await storage.fetch_all(
+            "SELECT id, role, content FROM messages WHERE session_id = ? AND id > ? ORDER BY id LIMIT ?",
+            (session_id, session["memory_upto"], MEMORY_FOLD_BATCH + window)
+        )
+        overflow = rows[:max(0, len(rows) - window)]
+        if not overflow:
+            return
+
+        prompt = _summary_prompt(session["memory_summary"], overflow)
+        # 后台任务以低优先级排队，不与在线聊天抢大模型并发
+        async with admission.limiter("llm").slot(admission.BATCH):
+            response = await asyncio.to_thread(
+                ai_client.chat.completions.create,
+                model=model_name,
+                messages=[
+                    {"role": "system", "content": "你负责压缩对话历史，输出简洁准确的摘要。"},
+                    {"role": "user", "content": prompt}
+                ],
+                stream=False
+            )
+        summary = _truncate(response.choices[0].message.content.strip(), MEMORY_SUMMARY_MAX_TOKENS)
+        # memory_upto 作为版本号，避免覆盖并发写入的新摘要
+        await write_queue.submit([(
+            "UPDATE chat_sessions SET memory_summary = ?, memory_upto = ? WHERE id = ? AND memory_upto = ?",
+            (summary, overflow[-1]["id"], session_id, session["memory_upto"])
+        )], wait=True)
+
+
+def schedule_update(session_id: str, ai_client, model_name: str, after=None):
+    """
+    在后台更新会话摘要，不阻塞本轮回答。after 为本轮消息的写入 future，写入完成后再更新；
+    同一会话已有更新在进行时跳过，由进行中的任务循环处理新消息。
+    """
+    task = _updating.get(session_id)
+    if task is not None and not task.done():
+        return
+
+    async def _run():
+        try:
+            if after is not None:
+                await after
+            await update_summary(session_id, ai_client, model_name)
+        except Exception as e:
+            logger.warning("更新会话摘要失败: %s", e)
+        finally:
+            _updating.pop(session_id, None)
+
+    _updating[session_id] = asyncio.create_task(_run())
+
+
+def compose_messages(system_prompt: str, history: list, user_content: str) -> list:
+    """拼接发给大模型的消息列表，摘要并入开头的 system 消息（部分模型只接受一条 system 消息）"""
+    system_parts = [system_prompt] if system_prompt else []
+    turns = []
+    for message in history:
+        if message["role"] == "system":
+            system_parts.append(message["content"])
+        else:
+            turns.append(message)
+    messages = [{"role": "system", "content": "\n\n".join(system_parts)}] if system_parts else []
+    return messages + turns + [{"role": "user", "content": user_content}]
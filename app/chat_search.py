@@ -0,0 +1,172 @@
+import asyncio
+import html
+import logging
+import os
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+# 历史消息回填配置：每批条数和批次间隔，避免长时间占用写锁影响在线请求
+SEARCH_BACKFILL_BATCH = int(os.getenv("SEARCH_BACKFILL_BATCH", 500))
+SEARCH_BACKFILL_INTERVAL = float(os.getenv("SEARCH_BACKFILL_INTERVAL", 0.2))
+
+# trigram 分词要求检索词至少 3 个字符，更短的词退化为 LIKE 扫描
+TRIGRAM_MIN_LENGTH = 3
+# 短关键词每次请求最多扫描的消息数（按 id 从新到旧），超出部分通过 next_before 游标继续
+SEARCH_SHORT_SCAN_ROWS = int(os.getenv("SEARCH_SHORT_SCAN_ROWS", 20000))
+SNIPPET_CONTEXT = 20
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+# snippet() 不会转义 HTML，先用控制字符标记高亮位置，转义后再替换成 <mark>
+_MARK_START = "\x02"
+_MARK_END = "\x03"
+
+_backfill_task = None
+
+
+def _backfill_batch(conn) -> bool:
+    """回填一批历史消息到全文索引，返回是否还有剩余"""
+    with storage.transaction(conn):
+        state = dict(conn.execute("SELECT name, value FROM search_index_state").fetchall())
+        done, upto = state.get("backfill_done", 0), state.get("backfill_upto", 0)
+        if done >= upto:
+            return False
+        batch_end = conn.execute(
+            "SELECT MAX(id) FROM (SELECT id FROM messages WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)",
+            (done, upto, SEARCH_BACKFILL_BATCH)
+        ).fetchone()[0] or upto
+        # 已被触发器索引过的消息（例如回填前被修改过）跳过
+        conn.execute(
+            '''
+            INSERT INTO messages_fts (rowid, content, session_id)
+            SELECT m.id, m.content, m.session_id FROM messages m
+            WHERE m.id > ? AND m.id <= ?
+              AND NOT EXISTS (SELECT 1 FROM messages_fts f WHERE f.rowid = m.id)
+            ''',
+            (done, batch_end)
+        )
+        conn.execute("UPDATE search_index_state SET value = ? WHERE name = 'backfill_done'", (batch_end,))
+        return batch_end < upto
+
+
+async def _backfill_loop():
+    try:
+        while await storage.run(_backfill_batch):
+            await asyncio.sleep(SEARCH_BACKFILL_INTERVAL)
+        logger.info("聊天记录全文索引回填完成")
+    except Exception as e:
+        logger.exception("聊天记录全文索引回填失败: %s", e)
+
+
+def start_backfill():
+    global _backfill_task
+    if _backfill_task is None or _backfill_task.done():
+        _backfill_task = asyncio.create_task(_backfill_loop())
+
+
+async def stop_backfill():
+    global _backfill_task
+    if _backfill_task is not None:
+        _backfill_task.cancel()
+        try:
+            await _backfill_task
+        except asyncio.CancelledError:
+            pass
+        _backfill_task = None
+
+
+def _make_snippet(content: str, keyword: str) -> str:
+    # LIKE 退化检索时没有 snippet()，手动截取关键词附近的文本并高亮
+    index = content.lower().find(keyword.lower())
+    if index < 0:
+        return html.escape(content[:SNIPPET_CONTEXT * 2])
+    start = max(0, index - SNIPPET_CONTEXT)
+    end = index + len(keyword) + SNIPPET_CONTEXT
+    return (
+        ("..." if start > 0 else "")
+        + html.escape(content[start:index])
+        + HIGHLIGHT_START + html.escape(content[index:index + len(keyword)]) + HIGHLIGHT_END
+        + html.escape(content[index + len(keyword):end])
+        + ("..." if end < len(content) else "")
+    )
+
+
+def _scan_messages(conn, keyword: str, limit: int, before: int):
+    """
+    短关键词的 LIKE 扫描：只扫描 id < before 的最近 SEARCH_SHORT_SCAN_ROWS 条消息（主键范围扫描），
+    返回 (结果, next_before)。结果超过 limit 条时游标指向最后一条结果，
+    扫描窗口用完时游标指向窗口的下边界，扫描到最早的消息时为 None。
+    """
+    bound, scanned = conn.execute(
+        "SELECT MIN(id), COUNT(*) FROM (SELECT id FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?)",
+        (before, SEARCH_SHORT_SCAN_ROWS)
+    ).fetchone()
+    if not scanned:
+        return [], None
+    escaped = keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    rows = [
+        dict(row) for row in conn.execute(
+            '''
+            SELECT m.id AS message_id, m.session_id, m.role, m.created_at, s.summary, m.content
+            FROM messages m
+            LEFT JOIN chat_sessions s ON s.id = m.session_id
+            WHERE m.id < ? AND m.id >= ? AND m.content LIKE ? ESCAPE '\\'
+            ORDER BY m.id DESC
+            LIMIT ?
+            ''',
+            (before, bound, f"%{escaped}%", limit + 1)
+        ).fetchall()
+    ]
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1]["message_id"]
+    return rows, bound if scanned >= SEARCH_SHORT_SCAN_ROWS else None
+
+
+async def search_messages(keyword: str, limit: int = 20, offset: int = 0, before: int = None) -> dict:
+    """
+    检索历史消息，按相关度（bm25）排序，返回带高亮片段的结果。
+    结果包含 session_id，前端可直接跳转到对应会话。
+    3 个字符及以上的关键词走全文索引，用 offset / next_offset 翻页；
+    更短的关键词按时间倒序分段扫描，用 before / next_before 翻页（offset 不生效），
+    一页结果可能少于 limit 条，next_before 不为空时仍有更早的消息未扫描。
+    """
+    keyword = keyword.strip()
+    if not keyword:
+        # 空白关键词会匹配所有消息
+        return {"results": [], "next_offset": None, "next_before": None}
+    if len(keyword) >= TRIGRAM_MIN_LENGTH:
+        # 整体作为一个短语匹配，避免用户输入被解析成 FTS 语法
+        phrase = '"' + keyword.replace('"', '""') + '"'
+        rows = await storage.fetch_all(
+            '''
+            SELECT messages_fts.rowid AS message_id, messages_fts.session_id, m.role, m.created_at, s.summary,
+                   snippet(messages_fts, 0, char(2), char(3), '...', 32) AS snippet
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            LEFT JOIN chat_sessions s ON s.id = messages_fts.session_id
+            WHERE messages_fts MATCH ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+            ''',
+            (phrase, limit + 1, offset)
+        )
+        for row in rows:
+            row["snippet"] = (
+                html.escape(row["snippet"] or "")
+                .replace(_MARK_START, HIGHLIGHT_START)
+                .replace(_MARK_END, HIGHLIGHT_END)
+            )
+        has_more = len(rows) > limit
+        return {
+            "results": rows[:limit],
+            "next_offset": offset + limit if has_more else None,
+            "next_before": None,
+        }
+
+    # 短关键词无法使用 trigram 索引，每次只扫描有限条消息，避免对整张表做 LIKE
+    rows, next_before = await storage.run(_scan_messages, keyword, limit, before or 2 ** 63 - 1)
+    for row in rows:
+        row["snippet"] = _make_snippet(row.pop("content") or "", keyword)
+    return {"results": rows, "next_offset": None, "next_before": next_before}
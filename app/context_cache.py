@@ -0,0 +1,156 @@
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+# 会话级检索上下文缓存配置（可通过环境变量覆盖）
+CONTEXT_CACHE_MAX_BYTES = int(os.getenv("CONTEXT_CACHE_MAX_BYTES", 64 * 1024 * 1024))   # 所有会话缓存的总内存上限
+CONTEXT_CACHE_IDLE_TTL = float(os.getenv("CONTEXT_CACHE_IDLE_TTL", 1800))               # 会话空闲多久后清除缓存（秒）
+CONTEXT_CACHE_QUERY_THRESHOLD = float(os.getenv("CONTEXT_CACHE_QUERY_THRESHOLD", 0.9))  # 问题相似度达到该值时直接复用联网搜索结果
+CONTEXT_CACHE_CHUNK_THRESHOLD = float(os.getenv("CONTEXT_CACHE_CHUNK_THRESHOLD", 0.6))  # 缓存片段与问题相似度达到该值时视为已覆盖
+CONTEXT_CACHE_MAX_CHUNKS = 50           # 每个会话最多缓存的文档片段数
+CONTEXT_CACHE_MAX_WEB_RESULTS = 5       # 每个会话最多缓存的联网搜索结果数
+
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SessionContext:
+    """单个会话最近检索到的文档片段和联网搜索结果，连同它们的向量"""
+
+    def __init__(self):
+        self.chunks = OrderedDict()     # 片段文本 -> 向量
+        self.generation = None          # 缓存片段来自的索引版本号
+        self.web_results = []           # [(问题向量, 搜索结果)]
+        self.size = 0
+        self.last_used = time.monotonic()
+
+    def _entry_size(self, text: str, vector: np.ndarray) -> int:
+        return len(text.encode("utf-8")) + vector.nbytes
+
+    def add_chunk(self, text: str, vector: np.ndarray):
+        if text in self.chunks:
+            self.chunks.move_to_end(text)
+            return
+        self.chunks[text] = vector
+        self.size += self._entry_size(text, vector)
+        while len(self.chunks) > CONTEXT_CACHE_MAX_CHUNKS:
+            old_text, old_vector = self.chunks.popitem(last=False)
+            self.size -= self._entry_size(old_text, old_vector)
+
+    def check_generation(self, generation: int):
+        # 文档重新索引、修改或删除后，旧索引中检索到的片段全部作废
+        if self.generation != generation:
+            for text, vector in self.chunks.items():
+                self.size -= self._entry_size(text, vector)
+            self.chunks.clear()
+            self.generation = generation
+
+    def add_web_result(self, vector: np.ndarray, content: str):
+        self.web_results.append((vector, content))
+        self.size += self._entry_size(content, vector)
+        while len(self.web_results) > CONTEXT_CACHE_MAX_WEB_RESULTS:
+            old_vector, old_content = self.web_results.pop(0)
+            self.size -= self._entry_size(old_content, old_vector)
+
+
+_sessions = OrderedDict()
+_total_size = 0
+
+
+def _get(session_id: str, create: bool = False):
+    _evict_idle()
+    context = _sessions.get(session_id)
+    if context is None and create:
+        context = _sessions[session_id] = SessionContext()
+    if context is not None:
+        context.last_used = time.monotonic()
+        _sessions.move_to_end(session_id)
+    return context
+
+
+def _update_size(context: SessionContext, before: int):
+    global _total_size
+    _total_size += context.size - before
+    # 超出总内存上限时按最近最少使用淘汰整个会话
+    while _total_size > CONTEXT_CACHE_MAX_BYTES and len(_sessions) > 1:
+        _, evicted = _sessions.popitem(last=False)
+        _total_size -= evicted.size
+
+
+def _evict_idle():
+    global _total_size
+    expire_before = time.monotonic() - CONTEXT_CACHE_IDLE_TTL
+    while _sessions:
+        session_id, context = next(iter(_sessions.items()))
+        if context.last_used >= expire_before:
+            break
+        del _sessions[session_id]
+        _total_size -= context.size
+
+
+def has_web_results(session_id: str) -> bool:
+    """本会话是否缓存了联网搜索结果，没有时不必为匹配缓存计算问题向量"""
+    context = _sessions.get(session_id)
+    return context is not None and bool(context.web_results)
+
+
+def find_web_result(session_id: str, query_vector):
+    """本会话有足够相似的问题搜索过时，返回当时的搜索结果"""
+    context = _get(session_id)
+    if context is None or query_vector is None or not context.web_results:
+        return None
+    query_vector = _normalize(query_vector)
+    scores = [float(np.dot(query_vector, vector)) for vector, _ in context.web_results]
+    best = int(np.argmax(scores))
+    return context.web_results[best][1] if scores[best] >= CONTEXT_CACHE_QUERY_THRESHOLD else None
+
+
+def add_web_result(session_id: str, query_vector, content: str):
+    if query_vector is None:
+        return
+    context = _get(session_id, create=True)
+    before = context.size
+    context.add_web_result(_normalize(query_vector), content)
+    _update_size(context, before)
+
+
+def find_chunks(session_id: str, query_vector, k: int, generation: int) -> list:
+    """返回与问题足够相似的缓存片段（最多 k 个，按相似度排序），generation 为当前索引版本号"""
+    context = _get(session_id)
+    if context is None or query_vector is None:
+        return []
+    before = context.size
+    context.check_generation(generation)
+    _update_size(context, before)
+    if not context.chunks:
+        return []
+    query_vector = _normalize(query_vector)
+    texts = list(context.chunks)
+    scores = np.stack(list(context.chunks.values())) @ query_vector
+    order = np.argsort(-scores)[:k]
+    return [texts[i] for i in order if scores[i] >= CONTEXT_CACHE_CHUNK_THRESHOLD]
+
+
+def add_chunks(session_id: str, texts: list, vectors: list, generation: int):
+    if not texts:
+        return
+    context = _get(session_id, create=True)
+    before = context.size
+    context.check_generation(generation)
+    for text, vector in zip(texts, vectors):
+        context.add_chunk(text, _normalize(vector))
+    _update_size(context, before)
+
+
+def forget(session_id: str):
+    # 会话删除后清理其缓存
+    global _total_size
+    context = _sessions.pop(session_id, None)
+    if context is not None:
+        _total_size -= context.size
@@ -0,0 +1,51 @@
+import json
+import os
+
+from file_tree import file_sha256
+
+
+# 预览缓存配置（可通过环境变量覆盖）
+PREVIEW_CACHE_DIR = os.getenv("PREVIEW_CACHE_DIR", "./preview_cache")     # 按内容哈希存放的预览文本
+PREVIEW_MAX_CHARS = int(os.getenv("PREVIEW_MAX_CHARS", 3000))              # 预览保留的最大字符数
+
+
+def _cache_path(sha256: str) -> str:
+    return os.path.join(PREVIEW_CACHE_DIR, sha256[:2], f"{sha256}.json")
+
+
+def load(sha256: str):
+    try:
+        with open(_cache_path(sha256), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(sha256: str, pages: list) -> dict:
+    """
+    记录文档的首页文本和页数。缓存按内容哈希存放，
+    重命名、移动或复制的文件直接复用，内容变化后自然失效。
+    """
+    preview = {"text": (pages[0] if pages else "")[:PREVIEW_MAX_CHARS], "pages": len(pages)}
+    path = _cache_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(preview, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return preview
+
+
+def get_preview(full_path: str, sha256: str = None) -> dict:
+    """
+    返回文档预览，sha256 为已知的内容哈希（例如索引清单中记录的）。
+    索引时已写入缓存的文档不再解析；缓存未命中时才读取文档并写入缓存。
+    """
+    import indexer
+
+    sha256 = sha256 or file_sha256(full_path)
+    preview = load(sha256)
+    cached = preview is not None
+    if not cached:
+        preview = save(sha256, indexer.load_texts(full_path))
+    return {"sha256": sha256, "cached": cached, **preview}
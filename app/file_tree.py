@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+FILE_TREE_RESCAN_INTERVAL = float(os.getenv("FILE_TREE_RESCAN_INTERVAL", 300))   # 定期全量扫描校正的间隔（秒）
+SUPPORTED_EXTS = (".pdf", ".docx", ".doc", ".txt")                                # 参与 RAG 索引的文件类型
+FAISS_INDEX_FILE = "./local_faiss_index/index.faiss"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# 索引状态
+INDEXED = "indexed"
+PENDING = "pending"
+UNSUPPORTED = "unsupported"
+
+SORT_KEYS = {
+    "name": lambda node: node.name.lower(),
+    "size": lambda node: node.size,
+    "mtime": lambda node: node.mtime,
+}
+
+
+class Node:
+    __slots__ = ("name", "is_dir", "size", "mtime", "children", "_sorted")
+
+    def __init__(self, name: str, is_dir: bool, size: int = 0, mtime: float = 0):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.children = {} if is_dir else None
+        self._sorted = {}       # (sort, order) -> 排好序的子节点列表，子节点变化时清空
+
+    def changed(self):
+        self._sorted = {}
+
+
+def file_sha256(path: str) -> str:
+    # 分块读取计算内容哈希，上传校验和预览缓存共用
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _scan(path: str, name: str) -> Node:
+    # 用 os.scandir 递归构建子树，DirEntry 自带类型信息，stat 在大多数平台上也有缓存
+    root = Node(name, True, mtime=os.stat(path).st_mtime)
+    stack = [(root, path)]
+    while stack:
+        node, dir_path = stack.pop()
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    child = Node(entry.name, True, mtime=entry.stat(follow_symlinks=False).st_mtime)
+                    stack.append((child, entry.path))
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    child = Node(entry.name, False, stat.st_size, stat.st_mtime)
+                else:
+                    continue
+            except OSError:
+                continue
+            node.children[entry.name] = child
+    return root
+
+
+class FileTree:
+    """
+    文档目录的内存索引：目录列表、全部子目录和文件的大小、修改时间、索引状态都从内存返回。
+    通过文件管理接口的增删改即时更新，后台定期全量扫描校正外部改动。
+    """
+
+    def __init__(self, base_dir: str):
+        self.base_dir = os.path.abspath(base_dir)
+        self.root = None
+        self._lock = threading.Lock()
+        self._dirs = None               # 全部子目录相对路径的缓存
+        self.index_built_at = 0         # 最近一次全量重建索引的时间
+        self.indexed = {}               # 相对路径 -> 单独索引该文件的时间（增量索引）
+
+    def rescan(self):
+        os.makedirs(self.base_dir, exist_ok=True)
+        root = _scan(self.base_dir, "")
+        with self._lock:
+            self.root = root
+            self._dirs = None
+        if not self.index_built_at and os.path.exists(FAISS_INDEX_FILE):
+            self.index_built_at = os.path.getmtime(FAISS_INDEX_FILE)
+
+    def _ensure(self):
+        if self.root is None:
+            self.rescan()
+
+    def _split(self, rel_path: str) -> list:
+        return [part for part in rel_path.replace("\\", "/").split("/") if part and part != "."]
+
+    def _find(self, parts: list):
+        node = self.root
+        for part in parts:
+            if node is None or not node.is_dir:
+                return None
+            node = node.children.get(part)
+        return node
+
+    def refresh(self, rel_path: str):
+        """重新读取某个路径（文件或目录子树）的状态并更新到内存，路径不存在时从树中移除"""
+        self._ensure()
+        parts = self._split(rel_path)
+        if not parts:
+            self.rescan()
+            return
+        full_path = os.path.join(self.base_dir, *parts)
+        try:
+            if os.path.isdir(full_path):
+                node = _scan(full_path, parts[-1])
+            else:
+                stat = os.stat(full_path)
+                node = Node(parts[-1], False, stat.st_size, stat.st_mtime)
+        except OSError:
+            node = None
+        with self._lock:
+            # 补齐中间目录
+            parent = self.root
+            for part in parts[:-1]:
+                child = parent.children.get(part)
+                if child is None or not child.is_dir:
+                    if node is None:
+                        return
+                    child = parent.children[part] = Node(part, True, mtime=time.time())
+                    parent.changed()
+                    self._dirs = None
+                parent = child
+            old = parent.children.get(parts[-1])
+            if node is None:
+                parent.children.pop(parts[-1], None)
+            else:
+                parent.children[parts[-1]] = node
+            parent.changed()
+            if (old is not None and old.is_dir) or (node is not None and node.is_dir):
+                self._dirs = None
+
+    def remove(self, rel_path: str):
+        self._ensure()
+        parts = self._split(rel_path)
+        with self._lock:
+            parent = self._find(parts[:-1])
+            if parent is not None and parent.is_dir and parent.children.pop(parts[-1], None) is not None:
+                parent.changed()
+                self._dirs = None
+        prefix = "/".join(parts)
+        for path in [p for p in self.indexed if p == prefix or p.startswith(prefix + "/")]:
+            self.indexed.pop(path, None)
+
+    def index_status(self, rel_path: str, node: Node) -> str:
+        if os.path.splitext(node.name)[1].lower() not in SUPPORTED_EXTS:
+            return UNSUPPORTED
+        indexed_at = self.indexed.get(rel_path, self.index_built_at)
+        return INDEXED if indexed_at and node.mtime <= indexed_at else PENDING
+
+    def mark_indexed(self, rel_paths: list = None, at: float = None):
+        """记录索引完成：rel_paths 为空表示全量重建"""
+        at = at or time.time()
+        if rel_paths is None:
+            self.index_built_at = at
+            self.indexed = {}
+        else:
+            for path in rel_paths:
+                self.indexed["/".join(self._split(path))] = at
+
+    def list_dir(self, rel_path: str, offset: int = 0, limit: int = 200, sort: str = "name", order: str = "asc"):
+        """返回目录下一页的条目（目录在前），目录不存在返回 None"""
+        self._ensure()
+        parts = self._split(rel_path)
+        node = self._find(parts)
+        if node is None or not node.is_dir:
+            return None
+        key = (sort, order)
+        items = node._sorted.get(key)
+        if items is None:
+            children = list(node.children.values())
+            children.sort(key=SORT_KEYS[sort], reverse=(order == "desc"))
+            # 目录始终排在文件前面（sort 是稳定排序）
+            children.sort(key=lambda child: not child.is_dir)
+            items = node._sorted[key] = children
+        prefix = "/".join(parts)
+        page = []
+        for child in items[offset:offset + limit]:
+            item = {
+                "name": child.name,
+                "type": "folder" if child.is_dir else "file",
+                "size": child.size,
+                "mtime": child.mtime,
+            }
+            if not child.is_dir:
+                item["index_status"] = self.index_status(f"{prefix}/{child.name}" if prefix else child.name, child)
+            page.append(item)
+        return {"items": page, "total": len(items)}
+
+    def all_dirs(self) -> list:
+        self._ensure()
+        dirs = self._dirs
+        if dirs is None:
+            dirs = []
+            stack = [(self.root, "")]
+            while stack:
+                node, path = stack.pop()
+                for child in node.children.values():
+                    if child.is_dir:
+                        child_path = f"{path}/{child.name}" if path else child.name
+                        dirs.append(child_path)
+                        stack.append((child, child_path))
+            dirs.sort()
+            self._dirs = dirs
+        return dirs
+
+    def iter_files(self, rel_path: str = ""):
+        """遍历某个目录下的全部文件，返回 (相对路径, 节点)"""
+        self._ensure()
+        parts = self._split(rel_path)
+        node = self._find(parts)
+        if node is None:
+            return
+        if not node.is_dir:
+            yield "/".join(parts), node
+            return
+        stack = [(node, "/".join(parts))]
+        while stack:
+            node, path = stack.pop()
+            for child in list(node.children.values()):
+                child_path = f"{path}/{child.name}" if path else child.name
+                if child.is_dir:
+                    stack.append((child, child_path))
+                else:
+                    yield child_path, child
+
+
+_rescan_task = None
+
+
+async def _rescan_loop(tree: FileTree):
+    while True:
+        try:
+            await asyncio.to_thread(tree.rescan)
+        except Exception as e:
+            logger.warning("扫描文档目录失败: %s", e)
+        await asyncio.sleep(FILE_TREE_RESCAN_INTERVAL)
+
+
+def start_rescan(tree: FileTree):
+    global _rescan_task
+    if _rescan_task is None or _rescan_task.done():
+        _rescan_task = asyncio.create_task(_rescan_loop(tree))
+
+
+async def stop_rescan():
+    global _rescan_task
+    if _rescan_task is not None:
+        _rescan_task.cancel()
+        try:
+            await _rescan_task
+        except asyncio.CancelledError:
+            pass
+        _rescan_task = None
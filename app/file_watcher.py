@@ -0,0 +1,194 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+
+import admission
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+logger = logging.getLogger(__name__)
+
+
+# 文档目录监听配置（可通过环境变量覆盖）
+FILE_WATCH_MODE = os.getenv("FILE_WATCH_MODE", "auto")                          # auto / inotify / polling / off
+FILE_WATCH_POLL_INTERVAL = float(os.getenv("FILE_WATCH_POLL_INTERVAL", 5))      # 轮询模式的扫描间隔（秒）
+FILE_WATCH_DEBOUNCE = float(os.getenv("FILE_WATCH_DEBOUNCE", 2))                # 变化停止多久后开始索引（秒）
+FILE_WATCH_MAX_DELAY = float(os.getenv("FILE_WATCH_MAX_DELAY", 30))             # 持续变化时最多推迟多久（秒）
+
+
+def _ignored(rel_path: str) -> bool:
+    # 隐藏文件、Office 临时文件和上传中的临时文件不处理
+    name = os.path.basename(rel_path)
+    return name.startswith((".", "~$")) or name.endswith(".part")
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory and event.event_type == "modified":
+            return
+        paths = [event.src_path]
+        if getattr(event, "dest_path", None):
+            # 移动 / 重命名：旧路径删除，新路径新增
+            paths.append(event.dest_path)
+        self.watcher.enqueue_threadsafe([self.watcher.relative(path) for path in paths])
+
+
+class FileWatcher:
+    """
+    监听文档目录的增删改和移动，防抖后只把受影响的文件交给增量索引。
+    优先使用 watchdog（inotify 等），不可用或被关闭时退化为定期扫描比对（适用于 Docker 挂载卷）。
+    文件管理接口的上传和删除也直接调用 enqueue（需 await）。
+    """
+
+    def __init__(self, tree, base_dir: str):
+        self.tree = tree
+        self.base_dir = os.path.abspath(base_dir)
+        self._pending = set()
+        self._last_event = 0
+        self._wakeup = None
+        self._loop = None
+        self._tasks = []
+        self._observer = None
+        self.mode = None
+        self.last_result = None
+
+    def relative(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), self.base_dir).replace("\\", "/")
+
+    def _filter(self, rel_paths: list) -> list:
+        return [
+            "" if path == "." else path for path in rel_paths
+            if not path.startswith("..") and not _ignored(path)
+        ]
+
+    def _refresh(self, rel_paths: list):
+        # 读取文件状态（os.stat / 目录扫描），不在事件循环线程中执行
+        for rel_path in rel_paths:
+            self.tree.refresh(rel_path)
+
+    def _queue(self, rel_paths: list):
+        # 登记待索引的路径并唤醒后台任务，只在事件循环线程中调用
+        if not rel_paths or self._wakeup is None:
+            return
+        self._pending.update(rel_paths)
+        self._last_event = self._loop.time()
+        self._wakeup.set()
+
+    async def enqueue(self, rel_paths: list):
+        """登记变化的路径（文件或目录）：在线程中更新目录树，再由后台任务防抖后增量索引"""
+        rel_paths = self._filter(rel_paths)
+        if not rel_paths or self._wakeup is None:
+            return
+        await asyncio.to_thread(self._refresh, rel_paths)
+        self._queue(rel_paths)
+
+    def enqueue_threadsafe(self, rel_paths: list):
+        # watchdog 线程中调用：在本线程更新目录树，再切回事件循环登记
+        rel_paths = self._filter(rel_paths)
+        if self._loop is None or not rel_paths:
+            return
+        try:
+            self._refresh(rel_paths)
+        except Exception as e:
+            logger.warning("更新目录树失败 %s: %s", rel_paths, e)
+        self._loop.call_soon_threadsafe(self._queue, rel_paths)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._tasks.append(asyncio.create_task(self._index_loop()))
+        if FILE_WATCH_MODE == "off":
+            self.mode = "off"
+            return
+        if FILE_WATCH_MODE in ("auto", "inotify") and Observer is not None:
+            try:
+                os.makedirs(self.base_dir, exist_ok=True)
+                self._observer = Observer()
+                self._observer.schedule(_EventHandler(self), self.base_dir, recursive=True)
+                self._observer.start()
+                self.mode = "inotify"
+            except Exception as e:
+                # 例如 inotify 监听数达到上限
+                logger.warning("文件监听启动失败，改用轮询: %s", e)
+                self._observer = None
+        if self._observer is None:
+            self.mode = "polling"
+            self._tasks.append(asyncio.create_task(self._poll_loop()))
+        logger.info("文档目录监听已启动（%s）", self.mode)
+        # 启动时校正一次：服务停止期间的改动（按修改时间和大小判断，未变化的文件不会重新索引）
+        await asyncio.to_thread(self.tree.rescan)
+        self._queue([""])
+
+    async def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            await asyncio.to_thread(self._observer.join)
+            self._observer = None
+        for task in self._tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def _snapshot(self) -> dict:
+        return {path: (node.size, node.mtime) for path, node in self.tree.iter_files()}
+
+    async def _poll_loop(self):
+        # 轮询模式：重新扫描目录树并与上一次的快照比对
+        previous = self._snapshot()
+        while True:
+            await asyncio.sleep(FILE_WATCH_POLL_INTERVAL)
+            try:
+                await asyncio.to_thread(self.tree.rescan)
+                current = self._snapshot()
+                changed = [path for path, state in current.items() if previous.get(path) != state]
+                changed += [path for path in previous if path not in current]
+                previous = current
+                # 目录树已在上面的线程中重新扫描，直接登记
+                self._queue(self._filter(changed))
+            except Exception as e:
+                logger.warning("轮询文档目录失败: %s", e)
+
+    async def _index_loop(self):
+        import indexer
+
+        while True:
+            await self._wakeup.wait()
+            # 防抖：等到 FILE_WATCH_DEBOUNCE 秒内没有新变化，或累计推迟达到 FILE_WATCH_MAX_DELAY
+            first = self._loop.time()
+            while True:
+                now = self._loop.time()
+                quiet = self._last_event + FILE_WATCH_DEBOUNCE - now
+                if quiet <= 0 or now - first >= FILE_WATCH_MAX_DELAY:
+                    break
+                await asyncio.sleep(min(quiet, first + FILE_WATCH_MAX_DELAY - now))
+            paths, self._pending = sorted(self._pending), set()
+            self._wakeup.clear()
+
+            started_at = time.time()
+            try:
+                # 索引以后台优先级占用向量模型，按批次占用和归还名额，不挤占在线检索
+                embed_slot = functools.partial(admission.limiter("embedding").thread_slot, self._loop, admission.BATCH)
+                result = await asyncio.to_thread(indexer.update, self.base_dir, paths, embed_slot)
+            except Exception as e:
+                logger.exception("增量索引失败: %s", e)
+                continue
+            if result["rebuilt"]:
+                self.tree.mark_indexed(at=started_at)
+            else:
+                self.tree.mark_indexed(result["indexed"], at=started_at)
+            self.last_result = {"paths": paths, "finished_at": time.time(), **result}
+            if result["indexed"] or result["removed"] or result["rebuilt"]:
+                logger.info("增量索引完成: 更新 %d 个文件，移除 %d 个文件", len(result["indexed"]), len(result["removed"]))
@@ -1,23 +1,33 @@
-from fastapi import APIRouter, UploadFile, File, Form, Query, HTTPException, Body
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, UploadFile, File, Form, Query, HTTPException, Body, Request, Header
+from fastapi.responses import JSONResponse, FileResponse, Response
 import os
 import shutil
-import subprocess
-import shutil
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.document_loaders import PyPDFLoader
-from langchain.embeddings import HuggingFaceEmbeddings
-from sentence_transformers import SentenceTransformer
-from langchain.vectorstores import FAISS
+import time
+import asyncio
+import stat
+import indexer
+import doc_preview
+import archive_import
+import upload_sessions
+from upload_sessions import UploadError
+from file_tree import FileTree
+from file_watcher import FileWatcher
 
 
 router = APIRouter(prefix="/api/files", tags=["files"])
 BASE_DIR = "./document"
 
+# 文档目录的内存索引，目录列表直接从内存返回
+file_index = FileTree(BASE_DIR)
+# 监听文档目录，新增、修改、删除的文件防抖后增量索引
+file_watcher = FileWatcher(file_index, BASE_DIR)
+
 def safe_join(base, *paths):
     # 防止目录穿越攻击
-    final_path = os.path.abspath(os.path.join(base, *paths))
-    if not final_path.startswith(os.path.abspath(base)):
+    # 按路径组件比较，避免 ./document_evil 这类同前缀的兄弟目录通过校验
+    base_path = os.path.abspath(base)
+    final_path = os.path.abspath(os.path.join(base_path, *paths))
+    if os.path.commonpath([final_path, base_path]) != base_path:
         raise HTTPException(status_code=400, detail="非法路径")
     return final_path
 
@@ -26,21 +36,37 @@ def frontend_path_to_backend(path):
         return ''
     return path.lstrip('/')
 
+def relative_path(full_path):
+    # 绝对路径转换为相对 BASE_DIR 的路径（"/" 分隔）
+    return os.path.relpath(full_path, os.path.abspath(BASE_DIR)).replace("\\", "/")
+
+# 目录列表：目录在前，支持按名称/大小/修改时间排序和分页
+# files / folders 为当前页的名称列表，items 带大小、修改时间和索引状态
 @router.get("/current")
-async def get_current_files(path: str = Query(...)):
+async def get_current_files(
+    path: str = Query(...),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(200, ge=1, le=1000),
+    sort: str = Query("name", pattern="^(name|size|mtime)$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+):
     try:
         rel_path = frontend_path_to_backend(path)
         current_path = safe_join(BASE_DIR, rel_path) if rel_path else os.path.abspath(BASE_DIR)
-        if not os.path.exists(current_path):
-            return {"files": [], "folders": []}
-        files = []
-        folders = []
-        for item in os.listdir(current_path):
-            if os.path.isfile(os.path.join(current_path, item)):
-                files.append(item)
-            elif os.path.isdir(os.path.join(current_path, item)):
-                folders.append(item)
-        return {"files": files, "folders": folders}
+        listing = file_index.list_dir(relative_path(current_path), offset, limit, sort, order)
+        if listing is None:
+            return {"files": [], "folders": [], "items": [], "total": 0, "offset": offset, "limit": limit}
+        items = listing["items"]
+        return {
+            "files": [item["name"] for item in items if item["type"] == "file"],
+            "folders": [item["name"] for item in items if item["type"] == "folder"],
+            "items": items,
+            "total": listing["total"],
+            "offset": offset,
+            "limit": limit,
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         # 文件拉取失败，返回详细错误信息
         raise HTTPException(status_code=500, detail=f"文件拉取失败: {str(e)}")
@@ -48,23 +74,65 @@ async def get_current_files(path: str = Query(...)):
 @router.get("/paths")
 async def get_paths():
     try:
-        paths = ['']  # 根目录
-        for root, dirs, _ in os.walk(BASE_DIR):
-            for d in dirs:
-                dir_path = os.path.join(root, d)
-                rel_path = os.path.relpath(dir_path, BASE_DIR)
-                rel_path = rel_path.replace("\\", "/")
-                paths.append(rel_path)
-        return paths
+        return [''] + file_index.all_dirs()  # 根目录 + 全部子目录
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"目录路径获取失败: {str(e)}")
 
+def existing_file(name, path):
+    # 返回文档的完整路径和 stat 结果，不存在或不是普通文件时返回 404
+    rel_path = frontend_path_to_backend(path)
+    current_path = safe_join(BASE_DIR, rel_path) if rel_path else os.path.abspath(BASE_DIR)
+    file_path = safe_join(current_path, name)
+    try:
+        stat_result = os.stat(file_path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return file_path, stat_result
+
+# 下载：支持 Range 断点续传 / 分段读取（PDF 阅读器按需取页）和 ETag 协商缓存
+# 文件由 FileResponse 直接从磁盘发送，服务器支持 pathsend 扩展时走零拷贝
+@router.get("/download")
+async def download_file(
+    request: Request,
+    name: str = Query(...),
+    path: str = Query(''),
+    inline: bool = Query(False)
+):
+    file_path, stat_result = existing_file(name, path)
+    etag = f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag})
+    return FileResponse(
+        file_path,
+        filename=name,
+        stat_result=stat_result,
+        content_disposition_type="inline" if inline else "attachment",
+        headers={"ETag": etag, "Cache-Control": "private, no-cache"},
+    )
+
+# 预览：首页文本和页数，按内容哈希缓存在磁盘；已索引的文档直接使用索引时提取的文本
+@router.get("/preview")
+async def preview_file(name: str = Query(...), path: str = Query('')):
+    file_path, stat_result = existing_file(name, path)
+    if not indexer.is_supported(name):
+        raise HTTPException(status_code=415, detail="该文件类型不支持预览")
+    try:
+        sha256 = indexer.indexed_sha256(relative_path(file_path), stat_result)
+        return await asyncio.to_thread(doc_preview.get_preview, file_path, sha256)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"预览失败: {str(e)}")
+
 @router.post("/folders")
 async def create_folder(name: str = Form(...), path: str = Form(...)):
     try:
         rel_path = frontend_path_to_backend(path)
         current_path = safe_join(BASE_DIR, rel_path) if rel_path else os.path.abspath(BASE_DIR)
-        os.makedirs(os.path.join(current_path, name), exist_ok=True)
+        folder_path = safe_join(current_path, name)
+        os.makedirs(folder_path, exist_ok=True)
+        await asyncio.to_thread(file_index.refresh, relative_path(folder_path))
         return {"message": "文件夹创建成功"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"文件夹创建失败: {str(e)}")
@@ -75,18 +143,116 @@ async def upload_file(file: UploadFile = File(...), path: str = Form(...)):
         rel_path = frontend_path_to_backend(path)
         current_path = safe_join(BASE_DIR, rel_path) if rel_path else os.path.abspath(BASE_DIR)
         os.makedirs(current_path, exist_ok=True)
-        file_path = os.path.join(current_path, file.filename)
-        with open(file_path, "wb") as f:
-            while True:
-                chunk = await file.read(1024 * 1024)
-                if not chunk:
-                    break
-                f.write(chunk)
+        file_path = safe_join(current_path, file.filename)
+        # 先写入隐藏的临时文件，写完再原子替换，索引不会读到写了一半的文件
+        part_path = os.path.join(current_path, f".{file.filename}.part")
+        try:
+            with open(part_path, "wb") as f:
+                while True:
+                    chunk = await file.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            os.replace(part_path, file_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        await file_watcher.enqueue([relative_path(file_path)])
         return {"message": "文件上传成功"}
     except Exception as e:
         # 详细错误信息返回给前端，便于调试
         raise HTTPException(status_code=500, detail=f"文件上传失败: {str(e)}")
 
+# 批量导入：上传 zip / tar 压缩包，逐个文件解压到目标目录，解压出的文件作为一批交给增量索引
+@router.post("/import")
+async def import_archive(file: UploadFile = File(...), path: str = Form(...)):
+    rel_path = frontend_path_to_backend(path)
+    current_path = safe_join(BASE_DIR, rel_path) if rel_path else os.path.abspath(BASE_DIR)
+    try:
+        # 上传的压缩包超过 1MB 时已落盘到临时文件，这里按文件流读取
+        result = await asyncio.to_thread(archive_import.extract, file.file, file.filename, current_path, safe_join)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"导入失败: {str(e)}")
+    extracted = [relative_path(full_path) for full_path in result["extracted"]]
+    await file_watcher.enqueue(extracted)
+    await asyncio.to_thread(file_index.refresh, relative_path(current_path))
+    return {
+        "message": f"已导入 {len(extracted)} 个文件" + (f"，{result['error']}" if result["error"] else ""),
+        "imported": len(extracted),
+        "total_size": result["total_size"],
+        "error": result["error"],
+        "files": result["files"],
+    }
+
+# 分片上传：新建会话 -> 并行上传分片（可重试、可断点续传）-> 查询已收到的分片 -> 完成
+# 临时文件在 UPLOAD_TMP_DIR，完成时校验后原子移动到文档目录
+def upload_target(name, path):
+    rel_path = frontend_path_to_backend(path)
+    current_path = safe_join(BASE_DIR, rel_path) if rel_path else os.path.abspath(BASE_DIR)
+    if not name or name != os.path.basename(name) or name.startswith("."):
+        raise HTTPException(status_code=400, detail="非法文件名")
+    return safe_join(current_path, name)
+
+def get_upload(upload_id):
+    try:
+        return upload_sessions.get(upload_id)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+@router.post("/uploads")
+async def create_upload(
+    name: str = Body(...),
+    path: str = Body(...),
+    size: int = Body(...),
+    chunk_size: int = Body(None),
+    sha256: str = Body(None)
+):
+    upload_target(name, path)
+    try:
+        session = await asyncio.to_thread(upload_sessions.create, name, path, size, chunk_size, sha256)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return session.status()
+
+@router.get("/uploads/{upload_id}")
+async def get_upload_status(upload_id: str):
+    return get_upload(upload_id).status()
+
+@router.put("/uploads/{upload_id}/chunks/{index}")
+async def upload_chunk(
+    upload_id: str,
+    index: int,
+    request: Request,
+    x_chunk_sha256: str = Header(None)
+):
+    # 请求体为分片的原始字节，X-Chunk-Sha256 为该分片的 SHA-256（十六进制）
+    session = get_upload(upload_id)
+    try:
+        return await upload_sessions.write_chunk(session, index, request.stream(), x_chunk_sha256)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+@router.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str):
+    session = get_upload(upload_id)
+    file_path = upload_target(session.meta["name"], session.meta["path"])
+    try:
+        checksum = await upload_sessions.complete(session, file_path)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    await file_watcher.enqueue([relative_path(file_path)])
+    return {"message": "文件上传成功", "sha256": checksum}
+
+@router.delete("/uploads/{upload_id}")
+async def abort_upload(upload_id: str):
+    try:
+        await upload_sessions.abort(get_upload(upload_id))
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return {"message": "已取消上传"}
+
 @router.delete("/del")
 async def delete_file(
     name: str = Body(...),
@@ -96,17 +262,25 @@ async def delete_file(
     try:
         rel_path = frontend_path_to_backend(path)
         current_path = safe_join(BASE_DIR, rel_path) if rel_path else os.path.abspath(BASE_DIR)
-        target_path = os.path.join(current_path, name)
+        target_path = safe_join(current_path, name)
+        if target_path == os.path.abspath(BASE_DIR):
+            raise HTTPException(status_code=400, detail="不能删除文档根目录")
         if not os.path.exists(target_path):
             raise HTTPException(status_code=404, detail="目标不存在")
         if type == "file":
             os.remove(target_path)
+            file_index.remove(relative_path(target_path))
+            await file_watcher.enqueue([relative_path(target_path)])
             return {"message": "文件删除成功"}
         elif type == "folder":
             shutil.rmtree(target_path)
+            file_index.remove(relative_path(target_path))
+            await file_watcher.enqueue([relative_path(target_path)])
             return {"message": "文件夹删除成功"}
         else:
             raise HTTPException(status_code=400, detail="无效类型")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除失败: {str(e)}")
 
@@ -114,78 +288,17 @@ async def delete_file(
 
 @router.post("/reIndex")
 async def reIndex():
-    # 1. 删除原有索引
-    faiss_index_dir = "./local_faiss_index"
-    if os.path.exists(faiss_index_dir):
-        for f in os.listdir(faiss_index_dir):
-            file_path = os.path.join(faiss_index_dir, f)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-
-    # 2. 遍历所有PDF，切分文本
-    document_dir = BASE_DIR
-    text_splitter = CharacterTextSplitter(separator="\n", chunk_size=500, chunk_overlap=100)
-    split_texts = [] 
-    supported_exts = [".pdf", ".docx", ".doc", ".txt"]
-    all_files = []
-    for root, dirs, files in os.walk(document_dir):
-        for file in files:
-            ext = os.path.splitext(file)[1].lower()
-            if ext in supported_exts:
-                all_files.append(os.path.join(root, file))
-
-    for file_path in all_files:
-        print(f"正在处理文件: {file_path}")
-        ext = os.path.splitext(file_path)[1].lower()
-        if ext == ".pdf":
-            loader = PyPDFLoader(file_path)
-            pages = loader.load_and_split()
-            for page in pages:
-                docs = text_splitter.create_documents([page.page_content])
-                for doc in docs:
-                    split_texts.append(doc.page_content)
-                    print('--------------------------------')
-        elif ext in [".docx", ".doc", ".txt"]:
-            # 使用 UnstructuredFileLoader 处理 Word 和 TXT 文件
-            loader = UnstructuredFileLoader(file_path)
-            docs = loader.load()
-            for doc in docs:
-                # 对每个文档内容进行切分
-                split_docs = text_splitter.create_documents([doc.page_content])
-                for split_doc in split_docs:
-                    split_texts.append(split_doc.page_content)
-                    print('--------------------------------')
-
-    # 3. 构建嵌入模型
-    local_model_path = './local_m3e_model'
-    # 检查本地是否已存在模型，如果存在则直接加载，否则从网络下载并保存到本地
-    if os.path.exists(local_model_path):
-        print(f"从本地加载模型: {local_model_path}")
-        model = SentenceTransformer(local_model_path)
-    else:
-        print(f"本地模型不存在，从网络加载: moka-ai/m3e-base")
-        model = SentenceTransformer('moka-ai/m3e-base')
-        # 保存模型到本地，以便下次使用
-        print(f"保存模型到本地: {local_model_path}")
-        model.save(local_model_path)
-
-    embeddings = HuggingFaceEmbeddings(model_name=local_model_path)
-
-    # 4. 构建faiss索引并保存
-    os.makedirs(faiss_index_dir, exist_ok=True)
-    if split_texts:
-        vectorstore = FAISS.from_texts(split_texts, embedding=embeddings)
-        vectorstore.save_local(faiss_index_dir)
-        return {"message": "索引重建完成", "text_chunks": len(split_texts)}
+    # 全量重建索引；日常的新增、修改、删除由 file_watcher 增量索引，无需手动重建
+    started_at = time.time()
+    text_chunks = await asyncio.to_thread(indexer.rebuild, BASE_DIR)
+    if text_chunks:
+        # 重建开始前已存在的文件都已进入索引
+        file_index.mark_indexed(at=started_at)
+        return {"message": "索引重建完成", "text_chunks": text_chunks}
     else:
         return {"message": "未找到PDF文件，未重建索引"}
 
-
-
-
-
-
-
-
-
-
+@router.get("/indexStatus")
+async def index_status():
+    # 文档监听方式和最近一次增量索引的结果
+    return {"watch_mode": file_watcher.mode, "last_update": file_watcher.last_result}
@@ -0,0 +1,288 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from contextlib import nullcontext
+
+import numpy as np
+from langchain.text_splitter import CharacterTextSplitter
+from langchain.document_loaders import PyPDFLoader, UnstructuredFileLoader
+from langchain.embeddings import HuggingFaceEmbeddings
+from sentence_transformers import SentenceTransformer
+from langchain.vectorstores import FAISS
+
+import doc_preview
+from file_tree import SUPPORTED_EXTS, file_sha256
+
+logger = logging.getLogger(__name__)
+
+
+FAISS_INDEX_DIR = "./local_faiss_index"
+MANIFEST_FILE = os.path.join(FAISS_INDEX_DIR, "manifest.json")     # 每个文件对应的向量 id，用于增量更新
+LOCAL_MODEL_PATH = "./local_m3e_model"
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
+EMBED_BATCH_SIZE = int(os.getenv("INDEX_EMBED_BATCH_SIZE", 64))     # 索引时每次送入向量模型的文本块数
+
+# 向量库和清单只在持有锁时修改；检索同样持锁，但只在内存中查询，耗时很短
+_lock = threading.Lock()
+# 同一时间只运行一个索引任务（全量或增量），避免互相覆盖
+_build_lock = threading.Lock()
+_embeddings = None
+_vectorstore = None
+_manifest = None
+# 索引版本号：向量库内容每变化一次加一，会话上下文缓存据此丢弃旧索引中检索到的片段
+_generation = 0
+
+
+def get_embeddings():
+    # 向量模型只加载一次，RAG 检索、会话上下文缓存和索引共用
+    global _embeddings
+    if _embeddings is None:
+        # 检查本地是否已存在模型，不存在则从网络下载并保存到本地
+        if not os.path.exists(LOCAL_MODEL_PATH):
+            logger.info("本地模型不存在，从网络加载: moka-ai/m3e-base")
+            model = SentenceTransformer('moka-ai/m3e-base')
+            # 保存模型到本地，以便下次使用
+            logger.info("保存模型到本地: %s", LOCAL_MODEL_PATH)
+            model.save(LOCAL_MODEL_PATH)
+        logger.info("从本地加载模型: %s", LOCAL_MODEL_PATH)
+        _embeddings = HuggingFaceEmbeddings(model_name=LOCAL_MODEL_PATH)
+    return _embeddings
+
+
+def is_supported(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in SUPPORTED_EXTS
+
+
+def load_texts(file_path: str) -> list:
+    """读取文档内容，PDF 按页返回，Word / TXT 返回整篇"""
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == ".pdf":
+        return [page.page_content for page in PyPDFLoader(file_path).load_and_split()]
+    # 使用 UnstructuredFileLoader 处理 Word 和 TXT 文件
+    return [doc.page_content for doc in UnstructuredFileLoader(file_path).load()]
+
+
+def split_texts(texts: list) -> list:
+    text_splitter = CharacterTextSplitter(separator="\n", chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    chunks = []
+    for text in texts:
+        chunks.extend(doc.page_content for doc in text_splitter.create_documents([text]))
+    return chunks
+
+
+def _load_manifest():
+    global _manifest
+    if _manifest is None:
+        if os.path.exists(MANIFEST_FILE):
+            with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+                _manifest = json.load(f)
+        else:
+            _manifest = {}
+    return _manifest
+
+
+def indexed_sha256(rel_path: str, stat) -> str:
+    """索引清单中记录的内容哈希，文件在索引后被修改过则返回 None"""
+    with _lock:
+        info = _load_manifest().get("files", {}).get(rel_path)
+    if info and info["mtime"] == stat.st_mtime and info["size"] == stat.st_size:
+        return info.get("sha256")
+    return None
+
+
+def get_generation() -> int:
+    return _generation
+
+
+def get_vectorstore():
+    """返回内存中的向量库，首次调用时从磁盘加载，索引不存在返回 None"""
+    global _vectorstore
+    if _vectorstore is None and os.path.exists(os.path.join(FAISS_INDEX_DIR, "index.faiss")):
+        with _lock:
+            if _vectorstore is None:
+                logger.info("检测到已存在的FAISS索引，加载: %s", FAISS_INDEX_DIR)
+                _vectorstore = FAISS.load_local(FAISS_INDEX_DIR, get_embeddings(), allow_dangerous_deserialization=True)
+    return _vectorstore
+
+
+def search(query: str, k: int, query_vector: list = None) -> tuple:
+    """
+    检索最相关的 k 个文本块，返回 (索引版本号, [(文本, 向量)])；
+    query_vector 为已计算好的查询向量，可省去一次向量计算。
+    """
+    vectorstore = get_vectorstore()
+    if vectorstore is None:
+        return _generation, []
+    if query_vector is None:
+        query_vector = get_embeddings().embed_query(query)
+    with _lock:
+        if _vectorstore is None:
+            return _generation, []
+        # 直接查询 FAISS 索引（与 similarity_search_by_vector 相同），顺便取出命中文本块的向量，
+        # 调用方缓存片段时不必重新计算
+        _, positions = _vectorstore.index.search(np.asarray([query_vector], dtype=np.float32), k)
+        results = []
+        for position in positions[0]:
+            if position < 0:
+                continue
+            doc = _vectorstore.docstore.search(_vectorstore.index_to_docstore_id[int(position)])
+            results.append((doc.page_content, _vectorstore.index.reconstruct(int(position))))
+        return _generation, results
+
+
+def _save():
+    # 先写到临时目录再替换，检索进程（或重启后）不会读到写了一半的索引文件
+    tmp_dir = f"{FAISS_INDEX_DIR}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    _vectorstore.save_local(tmp_dir)
+    with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(_manifest, f, ensure_ascii=False)
+    os.makedirs(FAISS_INDEX_DIR, exist_ok=True)
+    for name in os.listdir(tmp_dir):
+        os.replace(os.path.join(tmp_dir, name), os.path.join(FAISS_INDEX_DIR, name))
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _embed_chunks(chunks: list, embed_slot) -> list:
+    # 分批计算向量，每批单独占用一次向量模型名额，大文件不会长时间占住模型
+    vectors = []
+    for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+        with embed_slot():
+            vectors.extend(get_embeddings().embed_documents(chunks[start:start + EMBED_BATCH_SIZE]))
+    return vectors
+
+
+def _embed_file(base_dir: str, rel_path: str, embed_slot=nullcontext):
+    # 在锁外完成读取、切分和向量计算（耗时部分），返回 (文件信息, [(文本, 向量)], ids)
+    # embed_slot() 返回包住每批向量计算的上下文管理器，用于向量模型的准入控制
+    full_path = os.path.join(base_dir, rel_path)
+    stat = os.stat(full_path)
+    texts = load_texts(full_path)
+    # 顺便写入预览缓存，文件管理打开引用的文档时不用再解析
+    sha256 = file_sha256(full_path)
+    doc_preview.save(sha256, texts)
+    chunks = split_texts(texts)
+    vectors = _embed_chunks(chunks, embed_slot)
+    ids = [uuid.uuid4().hex for _ in chunks]
+    info = {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": sha256, "ids": ids}
+    return info, list(zip(chunks, vectors)), ids
+
+
+def _rebuild(base_dir: str, embed_slot=nullcontext) -> int:
+    global _vectorstore, _manifest, _generation
+    files, text_embeddings, metadatas, ids = {}, [], [], []
+    for root, _, names in os.walk(base_dir):
+        for name in names:
+            full_path = os.path.join(root, name)
+            if not is_supported(name):
+                continue
+            rel_path = os.path.relpath(full_path, base_dir).replace("\\", "/")
+            logger.debug("正在处理文件: %s", rel_path)
+            try:
+                info, pairs, file_ids = _embed_file(base_dir, rel_path, embed_slot)
+            except Exception as e:
+                logger.warning("索引文件失败 %s: %s", rel_path, e)
+                continue
+            files[rel_path] = info
+            text_embeddings.extend(pairs)
+            metadatas.extend({"source": rel_path} for _ in pairs)
+            ids.extend(file_ids)
+    if not text_embeddings:
+        # 没有可索引的文档，清空旧索引
+        with _lock:
+            _vectorstore = None
+            _manifest = None
+            _generation += 1
+            shutil.rmtree(FAISS_INDEX_DIR, ignore_errors=True)
+        return 0
+    vectorstore = FAISS.from_embeddings(text_embeddings, get_embeddings(), metadatas=metadatas, ids=ids)
+    with _lock:
+        _vectorstore = vectorstore
+        _manifest = {"files": files}
+        _generation += 1
+        _save()
+    return len(text_embeddings)
+
+
+def rebuild(base_dir: str) -> int:
+    """全量重建索引，返回文本块数量"""
+    with _build_lock:
+        return _rebuild(base_dir)
+
+
+def update(base_dir: str, rel_paths: list, embed_slot=nullcontext) -> dict:
+    """
+    增量更新：只处理给定的文件（或目录下的文件）。
+    文件存在则替换它的全部文本块，不存在则从索引中删除。
+    embed_slot 见 _embed_file，只在计算向量时占用，读取和解析文档时不占用。
+    """
+    global _generation
+    with _build_lock:
+        manifest = _load_manifest()
+        if get_vectorstore() is None or "files" not in manifest:
+            # 没有索引，或旧版本构建的索引没有文件清单，无法按文件增量更新，先全量重建一次
+            logger.info("索引缺少文件清单，执行一次全量重建")
+            chunks = _rebuild(base_dir, embed_slot)
+            return {"rebuilt": True, "text_chunks": chunks, "indexed": [], "removed": [], "failed": {}}
+
+        # 目录路径展开为清单中该目录下的全部文件和磁盘上该目录下的文件
+        targets = set()
+        for rel_path in rel_paths:
+            rel_path = rel_path.strip("/")
+            prefix = rel_path + "/" if rel_path else ""
+            targets.update(path for path in manifest["files"] if path == rel_path or path.startswith(prefix))
+            full_path = os.path.join(base_dir, rel_path)
+            if os.path.isdir(full_path):
+                for root, _, names in os.walk(full_path):
+                    targets.update(
+                        os.path.relpath(os.path.join(root, name), base_dir).replace("\\", "/") for name in names
+                    )
+            else:
+                targets.add(rel_path)
+
+        result = {"rebuilt": False, "indexed": [], "removed": [], "failed": {}}
+        prepared = {}
+        for rel_path in sorted(targets):
+            full_path = os.path.join(base_dir, rel_path)
+            if not os.path.isfile(full_path) or not is_supported(rel_path):
+                if rel_path in manifest["files"]:
+                    prepared[rel_path] = None
+                continue
+            old = manifest["files"].get(rel_path)
+            stat = os.stat(full_path)
+            if old and old["mtime"] == stat.st_mtime and old["size"] == stat.st_size:
+                continue
+            try:
+                prepared[rel_path] = _embed_file(base_dir, rel_path, embed_slot)
+            except Exception as e:
+                logger.warning("索引文件失败 %s: %s", rel_path, e)
+                result["failed"][rel_path] = str(e)
+
+        if not prepared:
+            return result
+        with _lock:
+            present = set(_vectorstore.index_to_docstore_id.values())
+            stale_ids = [
+                id_ for rel_path in prepared
+                for id_ in manifest["files"].get(rel_path, {}).get("ids", [])
+                if id_ in present
+            ]
+            if stale_ids:
+                _vectorstore.delete(stale_ids)
+            for rel_path, item in prepared.items():
+                if item is None:
+                    manifest["files"].pop(rel_path, None)
+                    result["removed"].append(rel_path)
+                    continue
+                info, pairs, ids = item
+                if pairs:
+                    _vectorstore.add_embeddings(pairs, metadatas=[{"source": rel_path} for _ in pairs], ids=ids)
+                manifest["files"][rel_path] = info
+                result["indexed"].append(rel_path)
+            _generation += 1
+            _save()
+        return result
@@ -0,0 +1,215 @@
+"""
+/api/stream 压测驱动：用 asyncio 同时维持多个 SSE 会话，按模式组合轮流发起请求，
+统计吞吐、首 token 延迟（TTFT）、总耗时和错误率，输出 JSON 报告。
+可以单独对已部署的服务压测：
+    python -m loadtest.driver --url http://127.0.0.1:8000 --concurrency 20 --requests 200
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import time
+from dataclasses import dataclass, field
+
+import httpx
+
+
+# (web_search, rag_search, agent_mode) 的全部组合
+ALL_MODES = {
+    "chat": (False, False, False),
+    "web": (True, False, False),
+    "rag": (False, True, False),
+    "web_rag": (True, True, False),
+    "agent": (False, False, True),
+    "agent_web": (True, False, True),
+    "agent_rag": (False, True, True),
+    "agent_web_rag": (True, True, True),
+}
+QUERIES = {
+    "chat": ["介绍一下你自己", "如何提高团队的工作效率？", "解释一下什么是向量数据库"],
+    "web": ["今天有哪些科技新闻？", "最近的人工智能行业动态", "新能源汽车的市场情况"],
+    "rag": ["文档中提到的主要结论是什么？", "总结一下文档的核心内容", "文档里有哪些风险提示？"],
+    "agent": ["北京海淀今天天气怎么样？", "消费最高的用户是谁？", "最受欢迎的产品是什么？", "3月份的销售总额是多少？"],
+}
+
+
+@dataclass
+class Result:
+    mode: str
+    status: int = 0
+    ttft: float = None          # 发出请求到收到第一段非空内容（秒）
+    duration: float = None      # 发出请求到收到 done 帧（秒）
+    chars: int = 0
+    error: str = None
+    session_id: str = None
+
+
+@dataclass
+class Stats:
+    results: list = field(default_factory=list)
+    started_at: float = 0
+    finished_at: float = 0
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return round(values[index], 4)
+
+
+def _queries_for(mode: str) -> list:
+    if mode.startswith("agent"):
+        return QUERIES["agent"]
+    return QUERIES.get(mode, QUERIES["chat"])
+
+
+async def _consume(client: httpx.AsyncClient, url: str, params: dict, result: Result, started_at: float):
+    async with client.stream("GET", f"{url}/api/stream", params=params) as response:
+        result.status = response.status_code
+        if response.status_code != 200:
+            await response.aread()
+            result.error = f"http_{response.status_code}"
+            return
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            frame = json.loads(line[5:])
+            content = frame.get("content") or ""
+            result.session_id = frame.get("session_id") or result.session_id
+            if content:
+                if result.ttft is None:
+                    result.ttft = time.perf_counter() - started_at
+                    # 上游异常时服务端以一条 "错误：..." 内容结束流
+                    if content.startswith("错误"):
+                        result.error = "stream_error"
+                result.chars += len(content)
+            if frame.get("done"):
+                result.duration = time.perf_counter() - started_at
+                return
+        result.error = result.error or "incomplete"
+
+
+async def run_one(client: httpx.AsyncClient, url: str, mode: str, query: str, session_id: str, timeout: float) -> Result:
+    web_search, rag_search, agent_mode = ALL_MODES[mode]
+    params = {"query": query, "web_search": web_search, "rag_search": rag_search, "agent_mode": agent_mode}
+    if session_id:
+        params["session_id"] = session_id
+    result = Result(mode, session_id=session_id)
+    started_at = time.perf_counter()
+    try:
+        await asyncio.wait_for(_consume(client, url, params, result, started_at), timeout)
+    except asyncio.TimeoutError:
+        result.error = "timeout"
+    except (httpx.HTTPError, ValueError) as e:
+        result.error = type(e).__name__
+    return result
+
+
+async def run_load(url: str, modes: list, concurrency: int, total: int, turns: int = 3,
+                   timeout: float = 120, warmup: int = 1) -> Stats:
+    """
+    concurrency 个虚拟用户并发发送共 total 个请求，每个用户在同一会话中连续问 turns 轮后换新会话，
+    这样会话记忆、上下文缓存等按会话生效的路径也会被压到。
+    """
+    limits = httpx.Limits(max_connections=concurrency + 10, max_keepalive_connections=concurrency + 10)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(timeout, connect=10), limits=limits) as client:
+        # 预热：加载向量模型、建立 MCP 连接等一次性开销不计入结果
+        for mode in modes:
+            for _ in range(warmup):
+                await run_one(client, url, mode, _queries_for(mode)[0], None, timeout)
+
+        stats = Stats()
+        counter = itertools.count()
+
+        async def user(worker: int):
+            session_id, asked = None, 0
+            while (n := next(counter)) < total:
+                mode = modes[(n + worker) % len(modes)]
+                queries = _queries_for(mode)
+                result = await run_one(client, url, mode, queries[n % len(queries)], session_id, timeout)
+                stats.results.append(result)
+                asked += 1
+                session_id = result.session_id if asked < turns and result.error is None else None
+                asked = asked if session_id else 0
+
+        stats.started_at = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(concurrency)))
+        stats.finished_at = time.perf_counter()
+    return stats
+
+
+def _summary(results: list, elapsed: float) -> dict:
+    ok = [r for r in results if r.error is None]
+    errors = {}
+    for r in results:
+        if r.error is not None:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    ttfts = [r.ttft for r in ok if r.ttft is not None]
+    durations = [r.duration for r in ok if r.duration is not None]
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0,
+        "errors": errors,
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else None,
+        "output_chars_per_second": round(sum(r.chars for r in ok) / elapsed, 1) if elapsed else None,
+        "ttft_seconds": {f"p{p}": percentile(ttfts, p) for p in (50, 95, 99)},
+        "latency_seconds": {f"p{p}": percentile(durations, p) for p in (50, 95, 99)},
+    }
+
+
+def report(stats: Stats, config: dict) -> dict:
+    elapsed = stats.finished_at - stats.started_at
+    by_mode = {}
+    for r in stats.results:
+        by_mode.setdefault(r.mode, []).append(r)
+    return {
+        "config": config,
+        "elapsed_seconds": round(elapsed, 3),
+        "overall": _summary(stats.results, elapsed),
+        "by_mode": {mode: _summary(results, elapsed) for mode, results in sorted(by_mode.items())},
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--concurrency", type=int, default=20, help="并发的虚拟用户数")
+    parser.add_argument("--requests", type=int, default=200, help="总请求数")
+    parser.add_argument("--modes", default=",".join(ALL_MODES), help=f"逗号分隔的模式，可选 {', '.join(ALL_MODES)}")
+    parser.add_argument("--turns", type=int, default=3, help="每个会话连续提问的轮数")
+    parser.add_argument("--timeout", type=float, default=120, help="单个请求的超时（秒）")
+    parser.add_argument("--warmup", type=int, default=1, help="正式压测前每种模式串行预热的请求数（不计入结果）")
+    parser.add_argument("--report", default="", help="JSON 报告的输出路径，默认打印到标准输出")
+
+
+def parse_modes(value: str) -> list:
+    modes = [mode.strip() for mode in value.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in ALL_MODES]
+    if unknown or not modes:
+        raise SystemExit(f"未知的模式：{', '.join(unknown)}，可选：{', '.join(ALL_MODES)}")
+    return modes
+
+
+def write_report(result: dict, path: str):
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对 /api/stream 进行并发压测")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="被测服务地址")
+    add_arguments(parser)
+    args = parser.parse_args()
+    modes = parse_modes(args.modes)
+    stats = asyncio.run(run_load(args.url, modes, args.concurrency, args.requests, args.turns, args.timeout, args.warmup))
+    config = {"url": args.url, "modes": modes, "concurrency": args.concurrency, "requests": args.requests, "turns": args.turns}
+    write_report(report(stats, config), args.report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+压测用的本地模拟上游：OpenAI 兼容的大模型接口、博查搜索接口、天气接口。
+各接口的延迟和生成速度由环境变量配置，启动方式：
+    uvicorn loadtest.fake_upstreams:app --port 9100
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+# 模拟上游的配置（可通过环境变量覆盖）
+FAKE_TTFT_MS = float(os.getenv("FAKE_TTFT_MS", 300))                    # 流式调用的首 token 延迟（毫秒）
+FAKE_TOKENS_PER_SECOND = float(os.getenv("FAKE_TOKENS_PER_SECOND", 50))  # 流式生成速度，0 表示不限速
+FAKE_OUTPUT_TOKENS = int(os.getenv("FAKE_OUTPUT_TOKENS", 200))           # 每次回答的 token 数
+FAKE_COMPLETION_MS = float(os.getenv("FAKE_COMPLETION_MS", 500))         # 非流式调用（Agent 决策、会话摘要）的耗时（毫秒）
+FAKE_SEARCH_LATENCY_MS = float(os.getenv("FAKE_SEARCH_LATENCY_MS", 200)) # 搜索接口耗时（毫秒）
+FAKE_WEATHER_LATENCY_MS = float(os.getenv("FAKE_WEATHER_LATENCY_MS", 50))
+FAKE_ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", 0))                 # 大模型接口随机返回 500 的比例
+FAKE_AGENT_TOOL_RATE = float(os.getenv("FAKE_AGENT_TOOL_RATE", 1))       # Agent 决策中选择调用工具的比例
+
+# 每个 token 取一到两个汉字，回答内容本身不重要，只要长度和节奏接近真实模型
+ANSWER_TOKENS = ["根据", "上下文", "信息", "，", "该", "问题", "的", "答案", "如下", "：", "首先", "需要", "考虑",
+                 "数据", "的", "来源", "，", "其次", "结合", "检索", "到的", "文档", "进行", "分析", "。"]
+TOOL_PATTERN = re.compile(r"server_url: (\S+)\n\ntool_name: (\S+)\nDescription: .*?\ninput_schema: (\{.*?\})\n", re.S)
+# 工具参数的示例值，按参数名匹配，其余按类型给默认值
+SAMPLE_ARGUMENTS = {"province": "北京", "city": "海淀", "locations": ["上海 浦东新区", "北京,海淀"],
+                    "sales_name": "周慧", "month": 3, "group_by": "product_name", "metric": "sum"}
+SAMPLE_BY_TYPE = {"string": "北京", "integer": 1, "number": 1, "boolean": True, "array": []}
+
+app = FastAPI()
+_tool_counter = itertools.count()
+
+
+def _delay(ms: float):
+    return asyncio.sleep(ms / 1000) if ms > 0 else asyncio.sleep(0)
+
+
+def _chunk(completion_id: str, model: str, content: str = None, finish_reason: str = None) -> str:
+    delta = {"content": content} if content is not None else {}
+    return "data: " + json.dumps({
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }, ensure_ascii=False) + "\n\n"
+
+
+async def _stream_answer(model: str):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    await _delay(FAKE_TTFT_MS)
+    interval = 1 / FAKE_TOKENS_PER_SECOND if FAKE_TOKENS_PER_SECOND > 0 else 0
+    started_at = time.monotonic()
+    for i in range(FAKE_OUTPUT_TOKENS):
+        # 按绝对时间对齐，避免 sleep 误差累积导致整体速度偏慢
+        wait = started_at + i * interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        yield _chunk(completion_id, model, ANSWER_TOKENS[i % len(ANSWER_TOKENS)])
+    yield _chunk(completion_id, model, finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+
+def _agent_decision(prompt: str) -> str:
+    # 从 Agent 决策 prompt 中解析可用工具，轮流选择一个并按 input_schema 构造参数
+    tools = TOOL_PATTERN.findall(prompt)
+    if not tools or random.random() >= FAKE_AGENT_TOOL_RATE:
+        return "".join(ANSWER_TOKENS)
+    server_url, tool_name, schema = tools[next(_tool_counter) % len(tools)]
+    try:
+        properties = json.loads(schema).get("properties", {})
+    except ValueError:
+        properties = {}
+    parameters = {
+        name: SAMPLE_ARGUMENTS.get(name, spec.get("default", SAMPLE_BY_TYPE.get(spec.get("type"), "")))
+        for name, spec in properties.items()
+    }
+    return json.dumps({"server_url": server_url, "tool_name": tool_name, "parameters": parameters}, ensure_ascii=False)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake-model")
+    if FAKE_ERROR_RATE and random.random() < FAKE_ERROR_RATE:
+        return JSONResponse({"error": {"message": "模拟的上游错误", "type": "server_error"}}, status_code=500)
+    if body.get("stream"):
+        return StreamingResponse(_stream_answer(model), media_type="text/event-stream")
+
+    await _delay(FAKE_COMPLETION_MS)
+    prompt = body["messages"][-1]["content"] if body.get("messages") else ""
+    if body.get("response_format", {}).get("type") == "json_object":
+        content = _agent_decision(prompt)
+    else:
+        # 会话摘要等后台调用
+        content = "用户询问了若干问题，助手基于检索结果进行了回答。"
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": len(prompt), "completion_tokens": len(content), "total_tokens": len(prompt) + len(content)},
+    }
+
+
+@app.post("/v1/web-search")
+async def web_search(request: Request):
+    body = await request.json()
+    await _delay(FAKE_SEARCH_LATENCY_MS)
+    query = body.get("query", "")
+    pages = [
+        {
+            "id": f"https://example.com/{i}",
+            "name": f"{query} - 搜索结果 {i}",
+            "url": f"https://example.com/{i}",
+            "snippet": f"关于“{query}”的第 {i} 条结果摘要。",
+            "summary": f"关于“{query}”的第 {i} 条结果的详细摘要，" + "".join(ANSWER_TOKENS) * 4,
+            "siteName": "example",
+        }
+        for i in range(body.get("count", 10))
+    ]
+    return {"code": 200, "msg": None, "data": {"_type": "SearchResponse", "queryContext": {"originalQuery": query},
+                                               "webPages": {"value": pages}}}
+
+
+@app.get("/api/weather/city/{city_code}")
+async def weather(city_code: str):
+    await _delay(FAKE_WEATHER_LATENCY_MS)
+    return {
+        "status": 200,
+        "cityInfo": {"citykey": city_code},
+        "data": {"wendu": "21", "shidu": "45%", "quality": "良",
+                 "forecast": [{"week": "星期一", "high": "高温 25℃", "low": "低温 15℃", "type": "晴"}]},
+    }
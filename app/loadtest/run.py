@@ -0,0 +1,255 @@
+"""
+端到端压测：在本机启动模拟上游（大模型、博查搜索、天气接口）、仓库自带的两个 MCP 服务和聊天服务，
+注册 MCP 服务后用 driver 并发压测 /api/stream，结果写入 JSON 报告。全程不访问外网。
+在 app 目录下运行：
+    python -m loadtest.run --concurrency 50 --requests 500 --report loadtest_report.json
+聊天服务在临时工作目录中运行（独立的聊天库、索引和缓存），不影响本地数据。
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from loadtest import driver
+from mcp_server import order_schema
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_TIMEOUT = 120
+
+CUSTOMERS = ["张伟", "王芳", "李娜", "刘洋", "陈静", "杨磊", "赵敏", "黄强"]
+PRODUCTS = ["笔记本电脑", "显示器", "机械键盘", "无线鼠标", "移动硬盘", "路由器"]
+SALES = ["周慧", "李娜", "黄健", "吴刚"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def create_orders_db(path: str, rows: int):
+    """订单 MCP 服务使用的分析库，按 orders 表结构生成随机订单"""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+    CREATE TABLE orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER NOT NULL,
+        customer_name TEXT NOT NULL,
+        product_id TEXT NOT NULL,
+        product_name TEXT NOT NULL,
+        price REAL NOT NULL,
+        sales_id INTEGER NOT NULL,
+        sales_name TEXT NOT NULL,
+        create_time INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
+        pay_time INTEGER,
+        status INTEGER NOT NULL
+    )
+    ''')
+    rng = random.Random(42)
+    now = int(time.time())
+    conn.executemany(
+        "INSERT INTO orders (customer_id, customer_name, product_id, product_name, price, sales_id, sales_name, "
+        "create_time, pay_time, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (c, CUSTOMERS[c], f"P{p:03d}", PRODUCTS[p], round(rng.uniform(50, 8000), 2), s, SALES[s],
+             created, created + 600, rng.randint(0, 2))
+            for c, p, s, created in (
+                (rng.randrange(len(CUSTOMERS)), rng.randrange(len(PRODUCTS)), rng.randrange(len(SALES)),
+                 now - rng.randint(0, 365 * 86400))
+                for _ in range(rows)
+            )
+        ],
+    )
+    conn.commit()
+    conn.close()
+    # 订单服务只读，索引和预聚合表需要先在主库上建好
+    order_schema.migrate(path)
+
+
+def prepare_workdir(workdir: str, documents: str):
+    # 聊天服务启动时要求工作目录下有 .env，配置全部通过环境变量传入
+    open(os.path.join(workdir, ".env"), "w").close()
+    os.symlink(os.path.join(APP_DIR, "static"), os.path.join(workdir, "static"))
+    model_dir = os.path.join(APP_DIR, "local_m3e_model")
+    if os.path.isdir(model_dir):
+        os.symlink(model_dir, os.path.join(workdir, "local_m3e_model"))
+    # 复制文档，RAG 模式的索引在临时目录中重新构建
+    shutil.copytree(documents, os.path.join(workdir, "document"))
+
+
+class Services:
+    """按顺序启动的子进程，退出时统一结束"""
+
+    def __init__(self, log_dir: str):
+        self.log_dir = log_dir
+        self.processes = []
+
+    def start(self, name: str, module: str, port: int, cwd: str, env: dict):
+        log = open(os.path.join(self.log_dir, f"{name}.log"), "w")
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", module, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=cwd,
+            env={**os.environ, "PYTHONPATH": APP_DIR, **env},
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        self.processes.append((name, process, log))
+
+    def check(self):
+        for name, process, _ in self.processes:
+            if process.poll() is not None:
+                raise RuntimeError(f"{name} 已退出（exit code {process.returncode}），日志见 {self.log_dir}/{name}.log")
+
+    def stop(self):
+        for _, process, _ in reversed(self.processes):
+            process.terminate()
+        for _, process, log in reversed(self.processes):
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            log.close()
+
+
+async def wait_until_ready(services: Services, url: str):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    async with httpx.AsyncClient(timeout=2) as client:
+        while time.monotonic() < deadline:
+            services.check()
+            try:
+                # MCP 服务的 /sse 是长连接，只等待响应头
+                async with client.stream("GET", url) as response:
+                    if response.status_code < 500:
+                        return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"等待 {url} 启动超时")
+
+
+async def register_mcp_servers(app_url: str, servers: dict):
+    async with httpx.AsyncClient(timeout=60) as client:
+        for name, url in servers.items():
+            response = await client.post(f"{app_url}/api/mcp/servers", json={"name": name, "url": url})
+            response.raise_for_status()
+        tools = (await client.get(f"{app_url}/api/mcp/tools")).json()
+    if not tools:
+        raise RuntimeError("MCP 服务注册后没有拉取到工具")
+
+
+async def fetch_server_stats(app_url: str) -> dict:
+    # 压测结束时服务端的事件循环阻塞次数和准入控制状态，便于和客户端指标对照
+    async with httpx.AsyncClient(timeout=10) as client:
+        stalls = (await client.get(f"{app_url}/api/admin/loop-stalls", params={"limit": 500})).json()
+        admission = (await client.get(f"{app_url}/api/admission")).json()
+    return {"loop_stalls": len(stalls["stalls"]), "admission": admission}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=APP_DIR, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def run(args, workdir: str) -> dict:
+    ports = {name: free_port() for name in ("upstream", "weather", "order", "app")}
+    upstream = f"http://127.0.0.1:{ports['upstream']}"
+    app_url = f"http://127.0.0.1:{ports['app']}"
+    mcp_servers = {
+        "weather": f"http://127.0.0.1:{ports['weather']}/sse",
+        "order": f"http://127.0.0.1:{ports['order']}/sse",
+    }
+    orders_db = os.path.join(workdir, "orders.db")
+    create_orders_db(orders_db, args.orders)
+    prepare_workdir(workdir, args.documents)
+
+    fake_env = {
+        "FAKE_TTFT_MS": str(args.ttft_ms),
+        "FAKE_TOKENS_PER_SECOND": str(args.tokens_per_second),
+        "FAKE_OUTPUT_TOKENS": str(args.output_tokens),
+        "FAKE_SEARCH_LATENCY_MS": str(args.search_latency_ms),
+        "FAKE_ERROR_RATE": str(args.upstream_error_rate),
+    }
+    app_env = {
+        "API_KEY": "loadtest",
+        "BASE_URL": f"{upstream}/v1",
+        "MODEL_NAME": "fake-model",
+        "BOCHAAI_SEARCH_API_KEY": "loadtest",
+        "BOCHAAI_SEARCH_URL": f"{upstream}/v1/web-search",
+        "CHAT_DB_PATH": os.path.join(workdir, "chat_history.db"),
+        "LOG_LEVEL": "WARNING",
+        "ADMIN_TOKEN": "",
+        **dict(item.split("=", 1) for item in args.app_env),
+    }
+
+    services = Services(workdir)
+    try:
+        services.start("upstream", "loadtest.fake_upstreams:app", ports["upstream"], APP_DIR, fake_env)
+        services.start("weather", "mcp_server.weather_service:app", ports["weather"], APP_DIR,
+                       {"WEATHER_API_URL": f"{upstream}/api/weather/city/"})
+        services.start("order", "mcp_server.order_service:app", ports["order"], APP_DIR, {"ORDER_DB_PATH": orders_db})
+        services.start("app", "main:app", ports["app"], workdir, app_env)
+        for url in (f"{upstream}/docs", *mcp_servers.values(), f"{app_url}/api/health"):
+            await wait_until_ready(services, url)
+        await register_mcp_servers(app_url, mcp_servers)
+
+        modes = driver.parse_modes(args.modes)
+        stats = await driver.run_load(app_url, modes, args.concurrency, args.requests, args.turns, args.timeout, args.warmup)
+        services.check()
+        result = driver.report(stats, {
+            "revision": git_revision(),
+            "modes": modes,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "turns": args.turns,
+            "upstream": fake_env,
+            "app_env": dict(item.split("=", 1) for item in args.app_env),
+        })
+        result["server"] = await fetch_server_stats(app_url)
+        return result
+    finally:
+        services.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动本地模拟上游和全部服务，对 /api/stream 进行端到端压测")
+    driver.add_arguments(parser)
+    parser.add_argument("--ttft-ms", type=float, default=300, help="模拟大模型的首 token 延迟（毫秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="模拟大模型的生成速度")
+    parser.add_argument("--output-tokens", type=int, default=200, help="模拟大模型每次回答的 token 数")
+    parser.add_argument("--search-latency-ms", type=float, default=200, help="模拟搜索接口的耗时（毫秒）")
+    parser.add_argument("--upstream-error-rate", type=float, default=0, help="模拟大模型接口返回 500 的比例")
+    parser.add_argument("--orders", type=int, default=10000, help="订单 MCP 服务的模拟订单数")
+    parser.add_argument("--documents", default=os.path.join(APP_DIR, "document"), help="RAG 模式使用的文档目录")
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="传给聊天服务的额外环境变量，例如 --app-env LLM_MAX_CONCURRENCY=32，可重复")
+    parser.add_argument("--keep-workdir", action="store_true", help="保留临时工作目录（含各服务日志）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    try:
+        result = asyncio.run(run(args, workdir))
+    except Exception:
+        print(f"压测失败，各服务日志见 {workdir}", file=sys.stderr)
+        raise
+    if args.keep_workdir:
+        result["workdir"] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    driver.write_report(result, args.report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from fastapi import FastAPI, Request, HTTPException, Query
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, Response, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from openai import OpenAI
@@ -8,21 +8,32 @@ import json
 import uuid
 from datetime import datetime
 import asyncio
-import sqlite3
+import logging
+import time
+import storage
+import chat_search
+from write_queue import write_queue
+import chat_export
+import admission
+import chat_archive
+import chat_memory
+import context_cache
+import stream_log
+import metrics
+import tracing
+import profiler
 from mcp_api import router as mcp_router
-from flie_api import router as files_router
+import mcp_health
+from flie_api import router as files_router, file_index, file_watcher
+from admin_api import router as admin_router
+import file_tree
+import indexer
 from fastmcp import Client
 from fastmcp.client.transports import SSETransport
 from dotenv import load_dotenv
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.document_loaders import PyPDFLoader
-from langchain.embeddings import HuggingFaceEmbeddings
-from sentence_transformers import SentenceTransformer
-from langchain.vectorstores import FAISS
 from langchain.chains import RetrievalQA
 from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
-from langchain.document_loaders import UnstructuredFileLoader
 
 # 检查 .env文件是否存在
 if not os.path.exists(".env"):
@@ -36,6 +47,16 @@ BASE_URL= os.getenv("BASE_URL")
 MODEL_NAME = os.getenv("MODEL_NAME")
  
 BOCHAAI_SEARCH_API_KEY = os.getenv("BOCHAAI_SEARCH_API_KEY")
+BOCHAAI_SEARCH_URL = os.getenv("BOCHAAI_SEARCH_URL", "https://api.bochaai.com/v1/web-search")    # 压测时指向本地的模拟服务
+
+# 日志级别：默认 INFO，调试时设为 DEBUG 输出 prompt、检索结果等完整内容
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+RAG_TOP_K = 3   # RAG 每次检索的文档片段数
+# perform_web_search 失败时返回的提示前缀，这类结果不进入缓存
+WEB_SEARCH_ERRORS = ("搜索失败", "搜索结果JSON解析失败", "执行网络搜索时出错")
 
 #检查配置是否正确
 if not API_KEY or not BASE_URL or not MODEL_NAME :
@@ -47,6 +68,7 @@ app = FastAPI()
 # 挂载 MCP 路由和文件管理路由
 app.include_router(mcp_router)      # 提供与MCP相关的API接口
 app.include_router(files_router)    # 提供文件管理相关的API接口
+app.include_router(admin_router)    # 运维接口：慢请求日志、事件循环阻塞记录、采样分析
 
 # 配置 CORS 中间件，允许所有来源、方法和头部跨域请求
 app.add_middleware(
@@ -57,6 +79,33 @@ app.add_middleware(
     allow_headers=["*"],        # 允许所有HTTP头
 )
 
+# 启动时开启 MCP 服务器健康探测，关闭时停止
+@app.on_event("startup")
+async def start_background_tasks():
+    profiler.start_monitor()
+    await storage.init_db()
+    write_queue.start()
+    chat_search.start_backfill()
+    mcp_health.start_health_monitor()
+    stream_log.start_cleanup()
+    chat_archive.start_maintenance()
+    file_tree.start_rescan(file_index)
+    await file_watcher.start()
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await mcp_health.stop_health_monitor()
+    await stream_log.stop_cleanup()
+    # 生成结束时写入消息，需在写入队列停止前完成
+    await stream_log.stop_generations()
+    await chat_archive.stop_maintenance()
+    await file_watcher.stop()
+    await file_tree.stop_rescan()
+    await chat_search.stop_backfill()
+    await write_queue.stop()
+    await profiler.stop_monitor()
+    storage.close()
+
 # 挂载静态文件目录，将/static路径映射到本地static文件夹
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -66,64 +115,6 @@ ai_client = OpenAI(
     base_url = BASE_URL
 )
 
-# Initialize SQLite database
-def init_db():
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
-    
-    # Create chat sessions table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS chat_sessions (
-        id TEXT PRIMARY KEY,
-        summary TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create messages table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        session_id TEXT,
-        role TEXT,
-        content TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
-    )
-    ''')
-    
-    # Create MCP servers table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS mcp_servers (
-        id TEXT PRIMARY KEY,
-        name TEXT NOT NULL,
-        url TEXT NOT NULL,
-        description TEXT,
-        auth_type TEXT,
-        auth_value TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create MCP tools table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS mcp_tools (
-        id TEXT PRIMARY KEY,
-        server_id TEXT,
-        name TEXT NOT NULL,
-        description TEXT,
-        input_schema TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (server_id) REFERENCES mcp_servers(id)
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
-    print("数据库初始化完成")
-
 # Perform web search (optional, retained for flexibility)
 # https://open.bochaai.com/overview
 async def perform_web_search(query: str):
@@ -132,7 +123,8 @@ async def perform_web_search(query: str):
         
         headers = {
             'Content-Type': 'application/json',  # Remove space
-            'Authorization': f'Bearer {BOCHAAI_SEARCH_API_KEY}'
+            'Authorization': f'Bearer {BOCHAAI_SEARCH_API_KEY}',
+            **tracing.headers()
         }
      
         payload = json.dumps({
@@ -143,7 +135,10 @@ async def perform_web_search(query: str):
         })
 
         # 使用搜索API, 参考文档 https://bocha-ai.feishu.cn/wiki/RXEOw02rFiwzGSkd9mUcqoeAnNK
-        response = requests.post("https://api.bochaai.com/v1/web-search", headers=headers, data=payload)
+        async with admission.limiter("web_search").slot():
+            response = await asyncio.to_thread(
+                requests.post, BOCHAAI_SEARCH_URL, headers=headers, data=payload
+            )
         
         # Check status code before parsing JSON
         if response.status_code != 200:
@@ -152,156 +147,109 @@ async def perform_web_search(query: str):
         # Only parse JSON if status code is 200
         try:
             json_data = response.json()
-            print(f"bochaai search response: {json_data}")
+            logger.debug("bochaai search response: %s", json_data)
             return str(json_data)
         except json.JSONDecodeError as e:
             return f"搜索结果JSON解析失败: {str(e)}"
             
+    except admission.AdmissionRejected:
+        raise
     except Exception as e:
         return f"执行网络搜索时出错: {str(e)}"
 
-async def perform_rag_search(query: str):
-    # 1. 检索
-    faiss_index_path = "./local_faiss_index"
-    local_model_path = './local_m3e_model'
-    # 检查本地是否已存在模型，如果存在则直接加载，否则从网络下载并保存到本地
-    if os.path.exists(local_model_path):
-        print(f"从本地加载模型: {local_model_path}")
-        model = SentenceTransformer(local_model_path)
-    else:
-        print(f"本地模型不存在，从网络加载: moka-ai/m3e-base")
-        model = SentenceTransformer('moka-ai/m3e-base')
-        # 保存模型到本地，以便下次使用
-        print(f"保存模型到本地: {local_model_path}")
-        model.save(local_model_path)
-    embeddings = HuggingFaceEmbeddings(model_name=local_model_path)
-
-    # 1. 文本切分
-    # 创建一个文本切分器，将长文本分割成较小的片段
-    # 使用换行符作为分隔符，每个片段最大500字符，重叠100字符
-    text_splitter = CharacterTextSplitter(
-        separator="\n",
-        chunk_size=500,
-        chunk_overlap=100
-    )
-
-    # 读取 document 目录下所有 PDF 文件，并对内容进行切分
-    document_dir = "./document"
-
-
-    # 遍历 document 目录下所有子目录，递归查找所有 PDF 文件
-    split_texts = [] 
-    supported_exts = [".pdf", ".docx", ".doc", ".txt"]
-    all_files = []
-    for root, dirs, files in os.walk(document_dir):
-        for file in files:
-            ext = os.path.splitext(file)[1].lower()
-            if ext in supported_exts:
-                all_files.append(os.path.join(root, file))
-
-    for file_path in all_files:
-        print(f"正在处理文件: {file_path}")
-        ext = os.path.splitext(file_path)[1].lower()
-        if ext == ".pdf":
-            loader = PyPDFLoader(file_path)
-            pages = loader.load_and_split()
-            for page in pages:
-                docs = text_splitter.create_documents([page.page_content])
-                for doc in docs:
-                    split_texts.append(doc.page_content)
-                    print('--------------------------------')
-        elif ext in [".docx", ".doc", ".txt"]:
-            # 使用 UnstructuredFileLoader 处理 Word 和 TXT 文件
-            loader = UnstructuredFileLoader(file_path)
-            docs = loader.load()
-            for doc in docs:
-                # 对每个文档内容进行切分
-                split_docs = text_splitter.create_documents([doc.page_content])
-                for split_doc in split_docs:
-                    split_texts.append(split_doc.page_content)
-                    print('--------------------------------')
-
-    # 2. 构建向量数据库（FAISS），并进行索引备份
-    if os.path.exists(faiss_index_path):
-        # 如果已存在索引，则直接加载
-        print(f"检测到已存在的FAISS索引，加载: {faiss_index_path}")
-        vectorstore = FAISS.load_local(faiss_index_path, embeddings, allow_dangerous_deserialization=True)
-    else:
-        # 如果没有索引，则重新构建并保存
-        print("未检测到FAISS索引，重新构建并备份...")
-        vectorstore = FAISS.from_texts(split_texts, embedding=embeddings)
-        vectorstore.save_local(faiss_index_path)
-        print(f"已将FAISS索引备份到: {faiss_index_path}")
-
-    # 3. 进行查找检索，返回3个相关文档
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
-
-    docs = retriever.invoke(query)
-    print(f"RAG检索结果: {docs}")
-    return str(docs)
+async def perform_rag_search(query: str, k: int = RAG_TOP_K, query_vector: list = None):
+    """检索与问题最相关的 k 个文档片段，返回 (索引版本号, [(片段文本, 向量)])"""
+    # 索引由 indexer 维护（文档变化时增量更新），这里只在内存向量库中查找
+    if await asyncio.to_thread(indexer.get_vectorstore) is None:
+        # 还没有索引时先全量构建一次
+        logger.info("未检测到FAISS索引，重新构建并备份...")
+        started_at = time.time()
+        await asyncio.to_thread(indexer.rebuild, file_index.base_dir)
+        file_index.mark_indexed(at=started_at)
+    async with admission.limiter("embedding").slot():
+        generation, results = await asyncio.to_thread(indexer.search, query, k, query_vector)
+    logger.debug("RAG检索结果: %s", [text for text, _ in results])
+    return generation, results
  
 
 # Save new chat session
+# 写入通过后台队列批量提交；新会话需要等待提交完成，保证紧接着的追问能查到该会话
 async def create_new_chat_session(session_id: str, query: str, response: str):
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
     summary = query[:50] + ("..." if len(query) > 50 else "")
-    cursor.execute(
-        '''
-        INSERT INTO chat_sessions (id, summary, created_at, updated_at)
-        VALUES (?, ?, ?, ?)
-        ''',
-        (session_id, summary, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    )
-    cursor.execute(
-        '''
-        INSERT INTO messages (session_id, role, content, created_at)
-        VALUES (?, ?, ?, ?)
-        ''',
-        (session_id, "user", query, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    )
-    cursor.execute(
-        '''
-        INSERT INTO messages (session_id, role, content, created_at)
-        VALUES (?, ?, ?, ?)
-        ''',
-        (session_id, "assistant", response, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    )
-    conn.commit()
-    conn.close()
+    now = storage.now()
+    return await write_queue.submit([
+        (
+            '''
+            INSERT INTO chat_sessions (id, summary, created_at, updated_at)
+            VALUES (?, ?, ?, ?)
+            ''',
+            (session_id, summary, now, now)
+        ),
+        (
+            '''
+            INSERT INTO messages (session_id, role, content, created_at)
+            VALUES (?, ?, ?, ?)
+            ''',
+            (session_id, "user", query, now)
+        ),
+        (
+            '''
+            INSERT INTO messages (session_id, role, content, created_at)
+            VALUES (?, ?, ?, ?)
+            ''',
+            (session_id, "assistant", response, now)
+        ),
+    ], wait=True)
 
 # Add message to existing session
 async def add_message_to_session(session_id: str, query: str, response: str):
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
-    cursor.execute(
-        '''
-        INSERT INTO messages (session_id, role, content, created_at)
-        VALUES (?, ?, ?, ?)
-        ''',
-        (session_id, "user", query, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    )
-    cursor.execute(
-        '''
-        INSERT INTO messages (session_id, role, content, created_at)
-        VALUES (?, ?, ?, ?)
-        ''',
-        (session_id, "assistant", response, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    )
-    cursor.execute(
-        '''
-        UPDATE chat_sessions
-        SET updated_at = ?
-        WHERE id = ?
-        ''',
-        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), session_id)
-    )
-    conn.commit()
-    conn.close()
+    now = storage.now()
+    return await write_queue.submit([
+        (
+            '''
+            INSERT INTO messages (session_id, role, content, created_at)
+            VALUES (?, ?, ?, ?)
+            ''',
+            (session_id, "user", query, now)
+        ),
+        (
+            '''
+            INSERT INTO messages (session_id, role, content, created_at)
+            VALUES (?, ?, ?, ?)
+            ''',
+            (session_id, "assistant", response, now)
+        ),
+        (
+            '''
+            UPDATE chat_sessions
+            SET updated_at = ?
+            WHERE id = ?
+            ''',
+            (now, session_id)
+        ),
+    ])
 
 # Process stream request (updated to use openai for GLM, requests for tools)
 # 这段代码定义了一个异步函数 process_stream_request，用于处理前端发来的流式对话请求，支持普通问答、联网搜索和智能Agent工具调用三种模式。下面逐步解释其主要逻辑：
 
+async def iterate_in_thread(stream):
+    # 同步的 OpenAI 流每读一块都可能等待网络，放到线程中读取，不阻塞事件循环
+    iterator = iter(stream)
+    while True:
+        chunk = await asyncio.to_thread(next, iterator, None)
+        if chunk is None:
+            return
+        yield chunk
+
+async def embed_query(query: str):
+    # 计算问题向量用于匹配会话缓存，模型不可用时不使用缓存
+    try:
+        async with admission.limiter("embedding").slot():
+            return await asyncio.to_thread(indexer.get_embeddings().embed_query, query)
+    except Exception as e:
+        logger.warning("计算问题向量失败，跳过检索缓存: %s", e)
+        return None
+
 async def process_stream_request(query: str, session_id: str = None, web_search: bool = False, rag_search: bool = False, agent_mode: bool = False):
     """
     处理流式对话请求，支持普通问答、联网搜索和Agent工具调用。
@@ -313,41 +261,89 @@ async def process_stream_request(query: str, session_id: str = None, web_search:
         agent_mode: 是否启用Agent工具调用
     """
 
-    print(f"query: {query}, session_id: {session_id}, web_search: {web_search}, rag_search: {rag_search}, agent_mode: {agent_mode}")
+    logger.debug("query: %s, session_id: %s, web_search: %s, rag_search: %s, agent_mode: %s", query, session_id, web_search, rag_search, agent_mode)
     
+    mode = metrics.chat_mode(web_search, rag_search, agent_mode)
+    metrics.chat_requests.inc(mode=mode)
+
     # 1. 检查会话ID是否存在，不存在则新建一个
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM chat_sessions WHERE id = ?", (session_id,))
-    has_session = cursor.fetchone()
+    has_session = await storage.fetch_one("SELECT id FROM chat_sessions WHERE id = ?", (session_id,))
+    if not has_session and session_id and await chat_archive.restore_session(session_id):
+        # 已归档的会话收到追问时先移回热表
+        has_session = {"id": session_id}
     if not has_session:
         session_id = str(uuid.uuid4())
 
+    # 已有会话带上对话记忆：滚动摘要 + 最近几轮原文，长度有上限
+    history = []
+    if has_session:
+        with tracing.stage("load_history", mode):
+            history = await chat_memory.build_history(session_id)
+
     # 2. 构建上下文信息（如启用联网搜索则获取搜索结果）
+    #    同一会话的追问优先复用缓存的检索结果：问题足够相似时跳过联网搜索，
+    #    缓存片段已覆盖问题时跳过或减少 RAG 检索
     context_parts = []
+    query_vector = None
+    # 只有 RAG 检索或匹配已缓存的搜索结果时才需要先算出问题向量
+    if rag_search or (web_search and context_cache.has_web_results(session_id)):
+        with tracing.stage("rag_embed", mode):
+            query_vector = await embed_query(query)
     if web_search:
-        web_results = await perform_web_search(query)
+        web_results = context_cache.find_web_result(session_id, query_vector)
+        if web_results is None:
+            with tracing.stage("web_search", mode):
+                if query_vector is None and not rag_search:
+                    # 会话还没有缓存的搜索结果：向量只用于存入缓存，与联网搜索并行计算，不增加等待时间
+                    web_results, query_vector = await asyncio.gather(perform_web_search(query), embed_query(query))
+                else:
+                    web_results = await perform_web_search(query)
+            if not web_results.startswith(WEB_SEARCH_ERRORS):
+                context_cache.add_web_result(session_id, query_vector, web_results)
+        else:
+            logger.debug("复用会话缓存的联网搜索结果")
         context_parts.append(web_results)
-    context = "\n".join(context_parts) if context_parts else "无上下文信息"
 
     if rag_search:
-        rag_results = await perform_rag_search(query)
-        context_parts.append(rag_results)
+        # 文档重新索引后索引版本号变化，缓存中旧索引的片段会被丢弃
+        chunks = context_cache.find_chunks(session_id, query_vector, RAG_TOP_K, indexer.get_generation())
+        if len(chunks) < RAG_TOP_K:
+            # 多取几个以便去掉已缓存的片段，只补齐缺少的部分
+            with tracing.stage("rag_search", mode):
+                generation, found = await perform_rag_search(query, RAG_TOP_K + len(chunks), query_vector)
+            new_found = [(text, vector) for text, vector in found if text not in chunks][:RAG_TOP_K - len(chunks)]
+            new_chunks = [text for text, _ in new_found]
+            if query_vector is not None and new_found:
+                # 向量直接取自 FAISS 索引，不需要再计算一次
+                context_cache.add_chunks(session_id, new_chunks, [vector for _, vector in new_found], generation)
+            chunks += new_chunks
+        else:
+            logger.debug("复用会话缓存的文档片段")
+        context_parts.append("\n\n".join(chunks))
     context = "\n".join(context_parts) if context_parts else "无上下文信息"
 
     # 3. 定义一个通用的流式响应生成器
-    async def generate(content_stream=None, initial_content=""):
+    async def generate(content_stream=None, initial_content="", slot=None, started_at=None):
         """
         负责将大模型的响应以SSE流式返回给前端，并在结束后写入数据库。
+        slot 为流式调用占用的大模型并发名额，上游流结束后归还。
+        started_at 为发起流式调用的时间（time.perf_counter），用于统计首 token 延迟和生成速度。
         """
         full_response = initial_content
-        
+        trace = tracing.current()
+
         if content_stream:
             # 流式返回大模型内容
+            first_token_at = None
             try:
-                for chunk in content_stream:
+                async for chunk in iterate_in_thread(content_stream):
                     if chunk.choices[0].delta.content:
                         content = chunk.choices[0].delta.content
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                            metrics.chat_stage_seconds.observe(first_token_at - started_at, stage="llm_first_token", mode=mode)
+                            if trace is not None:
+                                trace.record("llm_first_token", started_at, first_token_at)
                         full_response += content
                         yield f"data: {json.dumps({'content': content, 'session_id': session_id})}\n\n"
                         await asyncio.sleep(0.01)
@@ -355,27 +351,40 @@ async def process_stream_request(query: str, session_id: str = None, web_search:
                         yield f"data: {json.dumps({'content': '', 'session_id': session_id, 'done': True})}\n\n"
                         break
             except Exception as e:
+                tracing.finish(trace, "error")
                 yield f"data: {json.dumps({'content': f'错误：GLM API 请求失败 - {str(e)}', 'session_id': session_id, 'done': True})}\n\n"
                 return
+            finally:
+                if slot is not None:
+                    slot.release()
+                finished_at = time.perf_counter()
+                metrics.chat_stage_seconds.observe(finished_at - started_at, stage="llm_generation", mode=mode)
+                if trace is not None:
+                    trace.record("llm_generation", started_at, finished_at)
+                if first_token_at is not None:
+                    tokens = chat_memory.estimate_tokens(full_response[len(initial_content):])
+                    metrics.llm_output_tokens.inc(tokens, mode=mode)
+                    if finished_at > first_token_at:
+                        metrics.llm_tokens_per_second.observe(tokens / (finished_at - first_token_at), mode=mode)
         else:
             # 非流式直接返回
             yield f"data: {json.dumps({'content': full_response, 'session_id': session_id})}\n\n"
             yield f"data: {json.dumps({'content': '', 'session_id': session_id, 'done': True})}\n\n"
         
-        # 结束后写入数据库
+        # 结束后写入数据库，写入完成后在后台更新会话摘要
         if has_session:
-            await add_message_to_session(session_id, query, full_response)
+            written = await add_message_to_session(session_id, query, full_response)
         else:
-            await create_new_chat_session(session_id, query, full_response)
+            written = await create_new_chat_session(session_id, query, full_response)
+        chat_memory.schedule_update(session_id, ai_client, MODEL_NAME, after=written)
+        tracing.finish(trace)
 
     # 4. 如果启用Agent模式，先让大模型判断是否需要调用工具
     if agent_mode:
         # 4.1 查询所有可用工具
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(" SELECT t.*, s.url FROM mcp_tools t LEFT JOIN mcp_servers s ON t.server_id = s.id ")
-        tools = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        tools = await storage.fetch_all(" SELECT t.*, s.url FROM mcp_tools t LEFT JOIN mcp_servers s ON t.server_id = s.id ")
+        # 熔断中的服务器不把工具放进 prompt
+        tools = [tool for tool in tools if tool['url'] and mcp_health.is_available(tool['url'])]
 
         # 4.2 构造工具描述，拼接到prompt里
         tool_descriptions = "\n".join([
@@ -402,16 +411,21 @@ async def process_stream_request(query: str, session_id: str = None, web_search:
 
         # 4.4 调用大模型（非流式），让其决策
         try:
-            response = ai_client.chat.completions.create(
-                model = MODEL_NAME,
-                messages= [
-                    {"role": "system", "content": "你是一个智能助手，擅长选择合适的工具或直接回答问题。"},
-                    {"role": "user", "content": agent_prompt}
-                ],
-                stream=False,
-                response_format={"type": "json_object"} 
-            )
+            async with admission.limiter("llm").slot():
+                with tracing.stage("agent_decision", mode):
+                    response = await asyncio.to_thread(
+                        ai_client.chat.completions.create,
+                        model = MODEL_NAME,
+                        messages=chat_memory.compose_messages(
+                            "你是一个智能助手，擅长选择合适的工具或直接回答问题。", history, agent_prompt
+                        ),
+                        stream=False,
+                        response_format={"type": "json_object"},
+                        extra_headers=tracing.headers()
+                    )
             decision = response.choices[0].message.content.strip()
+        except admission.AdmissionRejected:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"GLM API request failed: {str(e)}")
 
@@ -425,24 +439,35 @@ async def process_stream_request(query: str, session_id: str = None, web_search:
                 parameters = decision_json["parameters"]
                 
                 try:
-                    # 4.6 通过SSE协议调用工具服务器
-                    async with Client(SSETransport(server_url)) as client: 
-                        tool_result = await client.call_tool(tool_name, parameters)
-                        tool_response = f"工具 {tool_name} 执行结果：{tool_result}"
-                        print(f"工具 {tool_name} 执行结果：{tool_result}")
-                        
-                        # 4.7 工具调用结果作为上下文，再次调用大模型（流式返回）
-                        prompt = f"上下文信息:\n{tool_result}\n\n问题: {query}\n请基于上下文信息回答问题:"
-                        stream = ai_client.chat.completions.create(
+                    # 4.6 通过SSE协议调用工具服务器（经过熔断器，熔断中的服务器会快速失败）
+                    async with admission.limiter("mcp").slot():
+                        with tracing.stage("mcp_tool_call", mode):
+                            tool_result = await mcp_health.call_tool(server_url, tool_name, parameters, tracing.headers())
+                    tool_response = f"工具 {tool_name} 执行结果：{tool_result}"
+                    logger.debug("工具 %s 执行结果：%s", tool_name, tool_result)
+
+                    # 4.7 工具调用结果作为上下文，再次调用大模型（流式返回）
+                    prompt = f"上下文信息:\n{tool_result}\n\n问题: {query}\n请基于上下文信息回答问题:"
+                    slot = await admission.limiter("llm").acquire()
+                    started_at = time.perf_counter()
+                    try:
+                        stream = await asyncio.to_thread(
+                            ai_client.chat.completions.create,
                             model=MODEL_NAME,
-                            messages=[{"role": "user", "content": prompt}],
-                            stream=True
-                        )
-                        return StreamingResponse(
-                            generate(stream, tool_response),
-                            media_type="text/event-stream",
-                            headers={"Cache-Control": "no-cache", "Connection": "keep-alive", "Transfer-Encoding": "chunked"}
+                            messages=chat_memory.compose_messages(None, history, prompt),
+                            stream=True,
+                            extra_headers=tracing.headers()
                         )
+                    except BaseException:
+                        slot.release()
+                        raise
+                    return StreamingResponse(
+                        generate(stream, tool_response, slot, started_at),
+                        media_type="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "Connection": "keep-alive", "Transfer-Encoding": "chunked"}
+                    )
+                except admission.AdmissionRejected:
+                    raise
                 except Exception as e:
                     # 工具调用失败，直接返回错误信息
                     return StreamingResponse(
@@ -467,22 +492,29 @@ async def process_stream_request(query: str, session_id: str = None, web_search:
     
     # 5. 非Agent模式，直接流式调用大模型
     prompt = f"上下文信息:\n{context}\n\n问题: {query}\n请基于上下文信息回答问题:"
-    print(f"prompt: {prompt}")
+    logger.debug("prompt: %s", prompt)
     
+    # 流式调用期间一直占用大模型并发名额，上游繁忙时直接拒绝（429）
+    slot = await admission.limiter("llm").acquire()
+    started_at = time.perf_counter()
     try:
-        stream = ai_client.chat.completions.create(
+        stream = await asyncio.to_thread(
+            ai_client.chat.completions.create,
             model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": "你是一个专业的问答助手。"},
-                {"role": "user", "content": prompt}
-            ],
-            stream=True
+            messages=chat_memory.compose_messages("你是一个专业的问答助手。", history, prompt),
+            stream=True,
+            extra_headers=tracing.headers()
         )
+    except asyncio.CancelledError:
+        slot.release()
+        raise
     except Exception as e:
+        slot.release()
+        error_message = f"错误：大模型 API 请求失败 - {e}"
         # 大模型接口异常，流式返回错误
+        tracing.finish(tracing.current(), "error")
         async def generate_error():
-            global e
-            yield f"data: {json.dumps({'content': f'错误：大模型 API 请求失败 - {e}', 'session_id': session_id, 'done': True})}\n\n"
+            yield f"data: {json.dumps({'content': error_message, 'session_id': session_id, 'done': True})}\n\n"
         return StreamingResponse(
             generate_error(),
             media_type="text/event-stream",
@@ -491,102 +523,195 @@ async def process_stream_request(query: str, session_id: str = None, web_search:
     
     # 6. 正常流式返回大模型内容
     return StreamingResponse(
-        generate(stream),
+        generate(stream, slot=slot, started_at=started_at),
         media_type="text/event-stream",
         headers={"Cache-Control": "no-cache", "Connection": "keep-alive", "Transfer-Encoding": "chunked"}
     )
 
 
 # Stream endpoint
+# 每次生成的帧都记录在帧日志里，SSE 事件 id 为 "<generation_id>:<seq>"：
+# 浏览器断线重连时带上 Last-Event-ID 从断点续传；传 generation_id 可以旁观同一次生成（共享上游）
 @app.get("/api/stream")
 async def stream(
-    query: str,
+    request: Request,
+    query: str = Query(None),
     session_id: str = Query(None),
     web_search: bool = Query(False),
     rag_search: bool = Query(False),
     agent_mode: bool = Query(False),
+    generation_id: str = Query(None),
 ):
-    return await process_stream_request(query, session_id, web_search, rag_search, agent_mode)
+    headers = {"Cache-Control": "no-cache", "Connection": "keep-alive", "X-Accel-Buffering": "no"}
+    resume_id, after_seq = stream_log.parse_event_id(request.headers.get("last-event-id"))
+    generation_id = resume_id or generation_id
+    if generation_id:
+        generation = await stream_log.find(generation_id)
+        if generation is not None:
+            if not stream_log.has_pending(generation, after_seq):
+                # 已经全部送达，返回 204 让 EventSource 停止重连
+                return Response(status_code=204)
+            return StreamingResponse(
+                stream_log.subscribe(generation, after_seq),
+                media_type="text/event-stream",
+                headers=headers
+            )
+        # 找不到时不重新生成，避免同一轮对话被重复执行
+        raise HTTPException(status_code=404, detail="生成记录不存在或已过期")
+    if not query:
+        raise HTTPException(status_code=400, detail="缺少查询参数 query")
+
+    # 每次新的生成都开始一次追踪，调用方可以通过 traceparent / X-Trace-Id 传入自己的 trace_id
+    trace = tracing.start(
+        "/api/stream",
+        tracing.parse_trace_id(request.headers),
+        mode=metrics.chat_mode(web_search, rag_search, agent_mode),
+        session_id=session_id or "",
+        query_chars=len(query),
+    )
+    headers[tracing.TRACE_HEADER] = trace.trace_id
+    try:
+        response = await process_stream_request(query, session_id, web_search, rag_search, agent_mode)
+    except admission.AdmissionRejected as e:
+        tracing.finish(trace, "rejected")
+        # 上游并发和排队都已满，快速返回 429 和排队信息
+        raise HTTPException(
+            status_code=429,
+            detail={"message": str(e), "upstream": e.upstream, "queue_position": e.queue_position, "retry_after": e.retry_after},
+            headers={"Retry-After": str(e.retry_after), tracing.TRACE_HEADER: trace.trace_id}
+        )
+    except Exception:
+        tracing.finish(trace, "error")
+        raise
+    # 上游在后台任务中只消费一次，客户端断开不会中断生成
+    generation = stream_log.start(response.body_iterator)
+    headers["X-Generation-Id"] = generation.id
+    return StreamingResponse(
+        stream_log.subscribe(generation),
+        media_type="text/event-stream",
+        headers=headers
+    )
+
+
+# Prometheus 指标：聊天流程各阶段耗时、生成速度、SQLite 写入耗时、上游排队状态
+@app.get("/api/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 # 会话历史记录 API
+# 基于游标的分页：before 为上一页返回的 next_before（"updated_at|id"），按更新时间倒序
+# 已归档的会话排在最后，archived 字段为 1
 @app.get("/api/chat/history")
-async def get_chat_history():
+async def get_chat_history(
+    before: str = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+):
     try:
-        conn = sqlite3.connect('chat_history.db')
-        conn.row_factory = sqlite3.Row  # 启用行工厂，使结果可以通过列名访问
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT id, summary, updated_at  FROM chat_sessions ORDER BY updated_at DESC")
-        rows = cursor.fetchall()
-        
-        # 将行转换为字典
-        sessions = [dict(row) for row in rows]
-        
-        conn.close()
-        return sessions
+        conditions, params = [], []
+        if before:
+            before_time, _, before_id = before.partition("|")
+            conditions, params = ["(updated_at, id) < (?, ?)"], [before_time, before_id]
+        sessions = [
+            {"id": row["id"], "summary": row["summary"], "updated_at": row["updated_at"], "archived": row["archived"]}
+            for row in await chat_archive.fetch_sessions(conditions, params, "DESC", limit + 1)
+        ]
+        # 多取一条用于判断是否还有下一页
+        next_before = None
+        if len(sessions) > limit:
+            sessions = sessions[:limit]
+            next_before = f"{sessions[-1]['updated_at']}|{sessions[-1]['id']}"
+        return {"sessions": sessions, "next_before": next_before}
         
     except Exception as e:
-        print(f"获取聊天历史失败: {str(e)}")
+        logger.exception("获取聊天历史失败: %s", e)
         raise HTTPException(status_code=500, detail=f"获取聊天历史失败: {str(e)}")
 
+# 会话消息分页：默认返回最新的 limit 条消息（按时间正序），before 为上一页返回的 next_before（消息 id）
 @app.get("/api/chat/session/{session_id}")
-async def get_session(session_id: str):
+async def get_session(
+    session_id: str,
+    before: int = Query(None),
+    limit: int = Query(100, ge=1, le=500),
+):
     try:
-        conn = sqlite3.connect('chat_history.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
         # 查询会话是否存在
-        cursor.execute("SELECT id FROM chat_sessions WHERE id = ?", (session_id,))
-        session = cursor.fetchone()
+        session = await storage.fetch_one("SELECT id FROM chat_sessions WHERE id = ?", (session_id,))
         
         if not session:
-            conn.close()
-            raise HTTPException(status_code=404, detail="会话不存在")
+            # 已归档的会话：解压后在内存中按同样的规则分页
+            archived = await chat_archive.get_session(session_id)
+            if not archived:
+                raise HTTPException(status_code=404, detail="会话不存在")
+            messages = [
+                {"id": m["id"], "role": m["role"], "content": m["content"]}
+                for m in archived["messages"] if before is None or m["id"] < before
+            ]
+            page = messages[-limit:]
+            next_before = page[0]["id"] if len(messages) > limit else None
+            return {"messages": page, "next_before": next_before, "archived": 1}
         
-        # 获取会话中的所有消息
-        cursor.execute(
-            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id asc",
-            (session_id,)
-        )
-        messages = [dict(row) for row in cursor.fetchall()]
-        
-        conn.close()
-        return {"messages": messages}
+        # 倒序取最新的一页消息（多取一条判断是否还有更早的消息），再翻转为正序
+        if before is not None:
+            messages = await storage.fetch_all(
+                "SELECT id, role, content FROM messages WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (session_id, before, limit + 1)
+            )
+        else:
+            messages = await storage.fetch_all(
+                "SELECT id, role, content FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit + 1)
+            )
+        next_before = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_before = messages[-1]["id"]
+        messages.reverse()
+        return {"messages": messages, "next_before": next_before}
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"获取会话详情失败: {str(e)}")
+        logger.exception("获取会话详情失败: %s", e)
         raise HTTPException(status_code=500, detail=f"获取会话详情失败: {str(e)}")
 
+# 全文检索历史消息：按相关度排序，返回高亮片段和所属会话
+@app.get("/api/chat/search")
+async def search_chat_history(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    before: int = Query(None, ge=1),
+):
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="检索关键词不能为空")
+    try:
+        return await chat_search.search_messages(q, limit, offset, before)
+    except Exception as e:
+        logger.exception("检索聊天记录失败: %s", e)
+        raise HTTPException(status_code=500, detail=f"检索聊天记录失败: {str(e)}")
+
 # 删除会话
 @app.delete("/api/chat/session/{session_id}")
 async def delete_session(session_id: str):
     try:
-        conn = sqlite3.connect('chat_history.db')
-        cursor = conn.cursor()
-        
-        # 首先删除会话关联的所有消息
-        cursor.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
-        
-        # 然后删除会话本身
-        cursor.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+        # 首先删除会话关联的所有消息，然后删除会话本身（同一事务），已归档的会话直接删除归档
+        _, deleted, deleted_archived = await storage.execute_many([
+            ("DELETE FROM messages WHERE session_id = ?", (session_id,)),
+            ("DELETE FROM chat_sessions WHERE id = ?", (session_id,)),
+            (f"DELETE FROM {storage.ARCHIVE_TABLE} WHERE id = ?", (session_id,)),
+        ])
+        context_cache.forget(session_id)
         
-        if cursor.rowcount == 0:
-            conn.close()
+        if deleted + deleted_archived == 0:
             raise HTTPException(status_code=404, detail="会话不存在")
         
-        conn.commit()
-        conn.close()
-        
         return {"message": "会话已删除"}
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"删除会话失败: {str(e)}")
+        logger.exception("删除会话失败: %s", e)
         raise HTTPException(status_code=500, detail=f"删除会话失败: {str(e)}")
 
 
@@ -600,81 +725,77 @@ async def rename_session(
 ):
 
     new_name = data.get("new_name")
-    print(f"重命名会话: {session_id}, 新名称: {new_name}")
+    logger.debug("重命名会话: %s, 新名称: %s", session_id, new_name)
     if not new_name:
         raise HTTPException(status_code=400, detail="缺少 new_name 参数")
     try:
-        conn = sqlite3.connect('chat_history.db')
-        cursor = conn.cursor()
-
         # 重命名会话
-        cursor.execute("UPDATE chat_sessions SET summary = ? WHERE id = ?", (new_name, session_id))
-        
-        conn.commit()
-        conn.close()
+        await storage.execute_many([
+            ("UPDATE chat_sessions SET summary = ? WHERE id = ?", (new_name, session_id)),
+            (f"UPDATE {storage.ARCHIVE_TABLE} SET summary = ? WHERE id = ?", (new_name, session_id)),
+        ])
         
         return {"message": "会话已重命名"}
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"重命名会话失败: {str(e)}")
+        logger.exception("重命名会话失败: %s", e)
         raise HTTPException(status_code=500, detail=f"重命名会话失败: {str(e)}")
 
 
 
-# 导出会话为markdown格式下载
+# 导出会话为markdown格式下载（按批读取消息，边查询边输出）
 @app.get("/api/chat/export/{session_id}")
 async def export_session(session_id: str):
     try:
-        conn = sqlite3.connect('chat_history.db')
-        conn.row_factory = sqlite3.Row  # Set row factory to enable dictionary access
-        cursor = conn.cursor()
-        
         # 查询会话是否存在
-        cursor.execute("SELECT id, summary FROM chat_sessions WHERE id = ?", (session_id,))
-        session = cursor.fetchone()
+        session = await storage.fetch_one(
+            f"SELECT id, summary, archived FROM ({chat_archive.SESSIONS_UNION}) WHERE id = ?",
+            (session_id,)
+        )
         
         if not session:
-            conn.close()
             raise HTTPException(status_code=404, detail="会话不存在")
         
-        # 获取会话中的所有消息
-        cursor.execute("SELECT role, content FROM messages WHERE session_id = ? ORDER BY id asc", (session_id,))
-        messages = cursor.fetchall()
-        
-        # 构建markdown内容
-        markdown_content = f"# 会话历史记录\n\n"
-        markdown_content += f"## 会话ID: {session_id}\n\n"
-        markdown_content += f"## 会话总结: {session['summary']}\n\n"
-        
-        for message in messages:
-            role = message['role']
-            content = message['content']
-            markdown_content += f"### {role}\n\n{content}\n\n"
-        
-        conn.close()
-        
         return StreamingResponse(
-            iter([markdown_content]), 
+            chat_export.session_markdown(session), 
             media_type="text/markdown", 
             headers={"Content-Disposition": f"attachment; filename=session_{session_id}.md"}
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"导出会话失败: {str(e)}")
+        logger.exception("导出会话失败: %s", e)
         raise HTTPException(status_code=500, detail=f"导出会话失败: {str(e)}")
 
 
+# 批量导出全部（或指定更新时间范围内的）会话：ndjson 每行一条消息，zip 每个会话一个 markdown 文件
+@app.get("/api/chat/export")
+async def export_sessions(
+    format: str = Query("ndjson", pattern="^(ndjson|zip)$"),
+    start: str = Query(None, description="起始时间（含），如 2025-01-01"),
+    end: str = Query(None, description="结束时间（不含），如 2025-04-01"),
+):
+    filename = f"chat_history_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    if format == "zip":
+        return StreamingResponse(
+            chat_export.sessions_zip(start, end),
+            media_type="application/zip",
+            headers={"Content-Disposition": f"attachment; filename={filename}.zip"}
+        )
+    return StreamingResponse(
+        chat_export.sessions_ndjson(start, end),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={filename}.ndjson"}
+    )
 
 
-
-
-
-
-
-
-
+# 各上游（大模型、联网搜索、向量模型、MCP）的并发、排队深度和排队耗时
+@app.get("/api/admission")
+def admission_metrics():
+    return admission.snapshot()
 
 
 # 健康检查接口
@@ -684,7 +805,6 @@ def health_check():
 
 
 if __name__ == "__main__":
-    init_db()
     import uvicorn
     # 可以通过环境变量设置端口，默认为8000
     port = int(os.getenv("PORT", 8000))
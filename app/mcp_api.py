@@ -1,13 +1,15 @@
 from fastapi import APIRouter, HTTPException
-import sqlite3
+import logging
 import requests
 import uuid
 import json
-from datetime import datetime
+import time
 from fastmcp import Client
 from fastmcp.client.transports import (PythonStdioTransport, SSETransport)
+import mcp_health
+import storage
 
-
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/mcp", tags=["mcp"])
 
@@ -15,10 +17,12 @@ router = APIRouter(prefix="/api/mcp", tags=["mcp"])
 # Function to fetch tools from an MCP server
 # 参考mcp定义：https://github.com/modelcontextprotocol/modelcontextprotocol/blob/main/docs/specification/2025-03-26/server/tools.mdx
 async def fetch_mcp_tools(server_url: str, auth_type: str, auth_value: str) -> list:
+    start = time.monotonic()
     try:
         async with Client(SSETransport(server_url)) as client:         
             tools = await client.list_tools()
-            print(tools)
+            logger.debug("MCP 工具列表: %s", tools)
+        mcp_health.record_success(server_url, time.monotonic() - start)
         # Ensure tools have required fields
         return [
             {
@@ -30,56 +34,58 @@ async def fetch_mcp_tools(server_url: str, auth_type: str, auth_value: str) -> l
             for tool in tools
         ]
     except Exception as e:
-        print(f"Error fetching tools from {server_url}: {str(e)}")
+        mcp_health.record_failure(server_url, str(e), time.monotonic() - start)
+        logger.warning("Error fetching tools from %s: %s", server_url, e)
         return []
 
+def _insert_tools_statements(server_id: str, tools: list) -> list:
+    # 生成把工具列表写入 mcp_tools 表的语句
+    return [
+        (
+            '''
+            INSERT INTO mcp_tools (id, server_id, name, description, input_schema, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''',
+            (
+                tool["id"],                   # 工具唯一 id
+                server_id,                    # 关联的服务器 id
+                tool["name"],                 # 工具名称
+                tool["description"],          # 工具描述
+                tool["input_schema"],         # 工具输入 schema
+                storage.now()                 # 创建时间
+            )
+        )
+        for tool in tools
+    ]
+
 # 创建 MCP 服务器的接口
 @router.post("/servers")
 async def create_mcp_server(server: dict):
     try:
         # 生成唯一的 server_id
         server_id = str(uuid.uuid4())
-        # 连接到 SQLite 数据库
-        conn = sqlite3.connect('chat_history.db')
-        cursor = conn.cursor()
-        # 插入 MCP 服务器信息到 mcp_servers 表
-        cursor.execute(
-            '''
-            INSERT INTO mcp_servers (id, name, url, description, auth_type, auth_value, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''',
-            (
-                server_id,
-                server["name"],
-                server["url"],
-                server.get("description", ""),           # 可选字段，默认为空字符串
-                server.get("auth_type", "none"),         # 可选字段，默认为 "none"
-                server.get("auth_value", ""),             # 可选字段，默认为空字符串
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),  # 创建时间
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S')   # 更新时间
-            )
-        )
-        conn.commit()
-        
-        # 从 MCP 服务器拉取工具列表，并存储到 mcp_tools 表
+        # 从 MCP 服务器拉取工具列表（网络请求放在事务之外，避免长时间占用写锁）
         tools = await fetch_mcp_tools(server["url"], server.get("auth_type", "none"), server.get("auth_value", ""))
-        for tool in tools:
-            cursor.execute(
+        # 插入 MCP 服务器信息到 mcp_servers 表，并存储工具到 mcp_tools 表
+        await storage.execute_many([
+            (
                 '''
-                INSERT INTO mcp_tools (id, server_id, name, description, input_schema, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
+                INSERT INTO mcp_servers (id, name, url, description, auth_type, auth_value, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 ''',
                 (
-                    tool["id"],                   # 工具唯一 id
-                    server_id,                    # 关联的服务器 id
-                    tool["name"],                 # 工具名称
-                    tool["description"],          # 工具描述
-                    tool["input_schema"],         # 工具输入 schema
-                    datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # 创建时间
+                    server_id,
+                    server["name"],
+                    server["url"],
+                    server.get("description", ""),           # 可选字段，默认为空字符串
+                    server.get("auth_type", "none"),         # 可选字段，默认为 "none"
+                    server.get("auth_value", ""),             # 可选字段，默认为空字符串
+                    storage.now(),                           # 创建时间
+                    storage.now()                            # 更新时间
                 )
-            )
-        conn.commit()
-        conn.close()
+            ),
+            *_insert_tools_statements(server_id, tools),
+        ])
         # 返回创建成功的 server_id 和消息
         return {"id": server_id, "message": "MCP server created successfully"}
     except Exception as e:
@@ -93,12 +99,10 @@ async def create_mcp_server(server: dict):
 @router.get("/servers")
 async def list_mcp_servers():
     try:
-        conn = sqlite3.connect('chat_history.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, url, description, auth_type, auth_value, created_at, updated_at FROM mcp_servers")
-        servers = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        servers = await storage.fetch_all("SELECT id, name, url, description, auth_type, auth_value, created_at, updated_at FROM mcp_servers")
+        # 附带健康状态：延迟、错误率和熔断状态
+        for server in servers:
+            server["health"] = mcp_health.get_health(server["url"])
         return servers
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list MCP servers: {str(e)}")
@@ -107,15 +111,12 @@ async def list_mcp_servers():
 @router.get("/servers/{server_id}")
 async def get_mcp_server(server_id: str):
     try:
-        conn = sqlite3.connect('chat_history.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, url, description, auth_type, auth_value, created_at, updated_at FROM mcp_servers WHERE id = ?", (server_id,))
-        server = cursor.fetchone()
-        conn.close()
+        server = await storage.fetch_one("SELECT id, name, url, description, auth_type, auth_value, created_at, updated_at FROM mcp_servers WHERE id = ?", (server_id,))
         if not server:
             raise HTTPException(status_code=404, detail="MCP server not found")
-        return dict(server)
+        return server
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get MCP server: {str(e)}")
 
@@ -123,51 +124,41 @@ async def get_mcp_server(server_id: str):
 @router.put("/servers/{server_id}")
 async def update_mcp_server(server_id: str, server: dict):
     try:
-        conn = sqlite3.connect('chat_history.db')
-        cursor = conn.cursor()
-        cursor.execute(
-            '''
-            UPDATE mcp_servers
-            SET name = ?, url = ?, description = ?, auth_type = ?, auth_value = ?, updated_at = ?
-            WHERE id = ?
-            ''',
-            (
-                server["name"],
-                server["url"],
-                server.get("description", ""),
-                server.get("auth_type", "none"),
-                server.get("auth_value", ""),
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                server_id
-            )
-        )
-        if cursor.rowcount == 0:
-            conn.close()
+        old_server = await storage.fetch_one("SELECT url FROM mcp_servers WHERE id = ?", (server_id,))
+        if not old_server:
             raise HTTPException(status_code=404, detail="MCP server not found")
-        
-        # Delete existing tools for this server
-        cursor.execute("DELETE FROM mcp_tools WHERE server_id = ?", (server_id,))
-        
-        # Fetch and store new tools
+        # 地址可能变更，清理旧地址的健康状态
+        mcp_health.forget(old_server["url"])
+
+        # Fetch new tools
         tools = await fetch_mcp_tools(server["url"], server.get("auth_type", "none"), server.get("auth_value", ""))
-        for tool in tools:
-            cursor.execute(
+
+        # Update server, then replace its tools in one transaction
+        updated, *_ = await storage.execute_many([
+            (
                 '''
-                INSERT INTO mcp_tools (id, server_id, name, description, input_schema,created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
+                UPDATE mcp_servers
+                SET name = ?, url = ?, description = ?, auth_type = ?, auth_value = ?, updated_at = ?
+                WHERE id = ?
                 ''',
                 (
-                    tool["id"],
-                    server_id,
-                    tool["name"],
-                    tool["description"],
-                    tool["input_schema"],
-                    datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    server["name"],
+                    server["url"],
+                    server.get("description", ""),
+                    server.get("auth_type", "none"),
+                    server.get("auth_value", ""),
+                    storage.now(),
+                    server_id
                 )
-            )
-        conn.commit()
-        conn.close()
+            ),
+            ("DELETE FROM mcp_tools WHERE server_id = ?", (server_id,)),
+            *_insert_tools_statements(server_id, tools),
+        ])
+        if updated == 0:
+            raise HTTPException(status_code=404, detail="MCP server not found")
         return {"message": "MCP server updated successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update MCP server: {str(e)}")
 
@@ -175,17 +166,19 @@ async def update_mcp_server(server_id: str, server: dict):
 @router.delete("/servers/{server_id}")
 async def delete_mcp_server(server_id: str):
     try:
-        conn = sqlite3.connect('chat_history.db')
-        cursor = conn.cursor()
-        # Delete associated tools
-        cursor.execute("DELETE FROM mcp_tools WHERE server_id = ?", (server_id,))
-        # Delete server
-        cursor.execute("DELETE FROM mcp_servers WHERE id = ?", (server_id,))
-        if cursor.rowcount == 0:
+        old_server = await storage.fetch_one("SELECT url FROM mcp_servers WHERE id = ?", (server_id,))
+        if old_server:
+            mcp_health.forget(old_server["url"])
+        # Delete associated tools, then the server
+        _, deleted = await storage.execute_many([
+            ("DELETE FROM mcp_tools WHERE server_id = ?", (server_id,)),
+            ("DELETE FROM mcp_servers WHERE id = ?", (server_id,)),
+        ])
+        if deleted == 0:
             raise HTTPException(status_code=404, detail="MCP server not found")
-        conn.commit()
-        conn.close()
         return {"message": "MCP server deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete MCP server: {str(e)}")
 
@@ -193,38 +186,19 @@ async def delete_mcp_server(server_id: str):
 @router.post("/servers/{server_id}/refresh-tools")
 async def refresh_mcp_server_tools(server_id: str):
     try:
-        conn = sqlite3.connect('chat_history.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT url, auth_type, auth_value FROM mcp_servers WHERE id = ?", (server_id,))
-        server = cursor.fetchone()
+        server = await storage.fetch_one("SELECT url, auth_type, auth_value FROM mcp_servers WHERE id = ?", (server_id,))
         if not server:
-            conn.close()
             raise HTTPException(status_code=404, detail="MCP server not found")
         
-        # Delete existing tools for this server
-        cursor.execute("DELETE FROM mcp_tools WHERE server_id = ?", (server_id,))
-        
-        # Fetch and store new tools
+        # Fetch new tools, then replace existing tools in one transaction
         tools = await fetch_mcp_tools(server["url"], server["auth_type"], server["auth_value"])
-        for tool in tools:
-            cursor.execute(
-                '''
-                INSERT INTO mcp_tools (id, server_id, name, description, input_schema,created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-                ''',
-                (
-                    tool["id"],
-                    server_id,
-                    tool["name"],
-                    tool["description"],
-                    tool["input_schema"],
-                    datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                )
-            )
-        conn.commit()
-        conn.close()
+        await storage.execute_many([
+            ("DELETE FROM mcp_tools WHERE server_id = ?", (server_id,)),
+            *_insert_tools_statements(server_id, tools),
+        ])
         return {"message": "Tools refreshed successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to refresh tools: {str(e)}")
 
@@ -232,15 +206,10 @@ async def refresh_mcp_server_tools(server_id: str):
 @router.get("/tools")
 async def list_tools(server_id: str = None):
     try:
-        conn = sqlite3.connect('chat_history.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
         if server_id:
-            cursor.execute("SELECT * FROM mcp_tools WHERE server_id = ?", (server_id,))
+            tools = await storage.fetch_all("SELECT * FROM mcp_tools WHERE server_id = ?", (server_id,))
         else:
-            cursor.execute("SELECT * FROM mcp_tools")
-        tools = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+            tools = await storage.fetch_all("SELECT * FROM mcp_tools")
         return tools
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list tools: {str(e)}")
@@ -248,14 +217,11 @@ async def list_tools(server_id: str = None):
 # Helper function to get MCP server details (used by process_stream_request)
 async def get_mcp_server_details(server_id: str) -> dict:
     try:
-        conn = sqlite3.connect('chat_history.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, url, auth_type, auth_value FROM mcp_servers WHERE id = ?", (server_id,))
-        server = cursor.fetchone()
-        conn.close()
+        server = await storage.fetch_one("SELECT id, name, url, auth_type, auth_value FROM mcp_servers WHERE id = ?", (server_id,))
         if not server:
             raise HTTPException(status_code=404, detail="MCP server not found")
-        return dict(server)
+        return server
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to get MCP server: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to get MCP server: {str(e)}")
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from fastmcp import Client
+from fastmcp.client.transports import SSETransport
+from fastmcp.exceptions import ClientError, ToolError
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+# 熔断器状态
+CLOSED = "closed"          # 正常，请求直接放行
+OPEN = "open"              # 熔断，请求快速失败
+HALF_OPEN = "half_open"    # 半开，放行一次试探请求
+
+# 健康探测与熔断配置（可通过环境变量覆盖）
+MCP_PROBE_INTERVAL = float(os.getenv("MCP_PROBE_INTERVAL", 30))        # 后台探测间隔（秒）
+MCP_PROBE_TIMEOUT = float(os.getenv("MCP_PROBE_TIMEOUT", 5))           # 单次探测超时（秒）
+MCP_CALL_TIMEOUT = float(os.getenv("MCP_CALL_TIMEOUT", 30))            # 工具调用超时（秒，含建立连接）
+MCP_FAILURE_THRESHOLD = int(os.getenv("MCP_FAILURE_THRESHOLD", 3))     # 连续失败多少次后熔断
+MCP_RECOVERY_TIMEOUT = float(os.getenv("MCP_RECOVERY_TIMEOUT", 30))    # 熔断后多久进入半开状态（秒）
+MCP_HEALTH_WINDOW = int(os.getenv("MCP_HEALTH_WINDOW", 20))            # 统计延迟和错误率的最近调用次数
+
+
+# McpError 中表示连接断开或会话读超时的错误码（服务器没有正常响应），计入熔断；
+# 其余错误码是服务器返回的 JSON-RPC 错误（如参数不合法），说明服务器本身正常
+MCP_TRANSPORT_ERROR_CODES = {CONNECTION_CLOSED, 408, -32001}
+
+
+def is_server_failure(error: Exception) -> bool:
+    """工具调用的异常是否说明服务器不可用（应计入熔断）"""
+    if isinstance(error, (ClientError, ToolError)):
+        return False
+    if isinstance(error, McpError):
+        return error.error.code in MCP_TRANSPORT_ERROR_CODES
+    return True
+
+
+class CircuitOpenError(Exception):
+    """MCP 服务器处于熔断状态，调用被快速拒绝"""
+
+
+class CircuitBreaker:
+    """记录单个 MCP 服务器的延迟、错误率和熔断状态"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.outcomes = deque(maxlen=MCP_HEALTH_WINDOW)  # (是否成功, 耗时秒)
+        self.last_error = None
+        self.last_checked = None
+
+    def allow_request(self) -> bool:
+        # 熔断时间到后进入半开状态，只放行一次试探请求
+        if self.state == OPEN and time.monotonic() - self.opened_at >= MCP_RECOVERY_TIMEOUT:
+            self.state = HALF_OPEN
+            self.trial_in_flight = False
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def is_available(self) -> bool:
+        # 只读判断，用于决定是否把该服务器的工具放进 prompt
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= MCP_RECOVERY_TIMEOUT
+        return True
+
+    def record_success(self, latency: float):
+        self.outcomes.append((True, latency))
+        self.last_checked = time.time()
+        self.consecutive_failures = 0
+        self.trial_in_flight = False
+        self.state = CLOSED
+        self.opened_at = None
+
+    def record_failure(self, error: str, latency: float):
+        self.outcomes.append((False, latency))
+        self.last_checked = time.time()
+        self.last_error = error
+        self.consecutive_failures += 1
+        self.trial_in_flight = False
+        if self.state == HALF_OPEN or self.consecutive_failures >= MCP_FAILURE_THRESHOLD:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        latencies = [latency for ok, latency in self.outcomes if ok]
+        failures = sum(1 for ok, _ in self.outcomes if not ok)
+        return {
+            "state": self.state,
+            "latency_ms": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+            "error_rate": round(failures / len(self.outcomes), 3) if self.outcomes else None,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "last_checked": self.last_checked,
+        }
+
+
+# 以 server_url 为键的熔断器表（Agent 决策结果里只有 server_url）
+_breakers = {}
+_probe_task = None
+
+
+def get_breaker(url: str) -> CircuitBreaker:
+    breaker = _breakers.get(url)
+    if breaker is None:
+        breaker = _breakers[url] = CircuitBreaker(url)
+    return breaker
+
+
+def is_available(url: str) -> bool:
+    return get_breaker(url).is_available()
+
+
+def get_health(url: str) -> dict:
+    return get_breaker(url).snapshot()
+
+
+def forget(url: str):
+    # 服务器被删除或修改地址后，清理其健康状态
+    _breakers.pop(url, None)
+
+
+def record_success(url: str, latency: float):
+    get_breaker(url).record_success(latency)
+
+
+def record_failure(url: str, error: str, latency: float):
+    get_breaker(url).record_failure(error, latency)
+
+
+async def call_tool(server_url: str, tool_name: str, parameters: dict, headers: dict = None):
+    """
+    通过熔断器调用 MCP 工具：熔断时直接抛出 CircuitOpenError，
+    否则带超时调用，并把结果计入该服务器的健康统计。
+    headers 为附加到 SSE 请求上的请求头（如追踪头）。
+    """
+    breaker = get_breaker(server_url)
+    if not breaker.allow_request():
+        raise CircuitOpenError(f"MCP 服务器 {server_url} 暂不可用（熔断中）")
+
+    async def _call():
+        async with Client(SSETransport(server_url, headers=headers)) as client:
+            return await client.call_tool(tool_name, parameters)
+
+    start = time.monotonic()
+    try:
+        # 超时覆盖建立 SSE 连接、握手和工具调用全过程，服务器接受连接后无响应也不会一直挂起
+        result = await asyncio.wait_for(_call(), MCP_CALL_TIMEOUT)
+    except Exception as e:
+        if is_server_failure(e):
+            breaker.record_failure(str(e) or type(e).__name__, time.monotonic() - start)
+        else:
+            # 工具返回错误或参数不合法：服务器本身正常响应，不计入熔断
+            breaker.record_success(time.monotonic() - start)
+        raise
+    except BaseException:
+        # 请求被取消（客户端断开等）：释放半开状态的试探名额，不影响统计
+        breaker.trial_in_flight = False
+        raise
+    breaker.record_success(time.monotonic() - start)
+    return result
+
+
+async def probe_server(url: str):
+    # 探测：建立 SSE 连接并列出工具，超时视为失败
+    breaker = get_breaker(url)
+    if not breaker.allow_request():
+        return
+
+    async def _probe():
+        async with Client(SSETransport(url)) as client:
+            await client.list_tools()
+
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(_probe(), MCP_PROBE_TIMEOUT)
+    except Exception as e:
+        breaker.record_failure(str(e) or type(e).__name__, time.monotonic() - start)
+        return
+    breaker.record_success(time.monotonic() - start)
+
+
+async def probe_all_servers():
+    urls = [row["url"] for row in await storage.fetch_all("SELECT DISTINCT url FROM mcp_servers")]
+    # 清理已经不存在的服务器
+    for url in list(_breakers):
+        if url not in urls:
+            forget(url)
+    await asyncio.gather(*(probe_server(url) for url in urls))
+
+
+async def _probe_loop():
+    while True:
+        try:
+            await probe_all_servers()
+        except Exception as e:
+            logger.warning("MCP 健康探测失败: %s", e)
+        await asyncio.sleep(MCP_PROBE_INTERVAL)
+
+
+def start_health_monitor():
+    global _probe_task
+    if _probe_task is None or _probe_task.done():
+        _probe_task = asyncio.create_task(_probe_loop())
+
+
+async def stop_health_monitor():
+    global _probe_task
+    if _probe_task is not None:
+        _probe_task.cancel()
+        try:
+            await _probe_task
+        except asyncio.CancelledError:
+            pass
+        _probe_task = None
@@ -0,0 +1,138 @@
+"""
+订单分析库的结构迁移：为 orders 建立索引、按月/客户/产品/销售员的预聚合（rollup）表和同步触发器。
+需要可写连接，只在主库上执行（只读副本通过复制获得这些表）；订单 MCP 服务本身只读。
+在 app 目录下运行（可重复执行，已存在的对象不会重建）：
+    python -m mcp_server.order_schema --db chat_history.db
+"""
+import argparse
+import os
+import sqlite3
+
+# 主库路径：默认与聊天应用共用 chat_history.db
+ORDER_PRIMARY_DB_PATH = os.getenv("ORDER_PRIMARY_DB_PATH", "chat_history.db")
+ORDER_DB_BUSY_TIMEOUT = int(os.getenv("ORDER_DB_BUSY_TIMEOUT", 5000))
+
+
+# 预聚合（rollup）表定义：表名 -> (主键列定义, 由订单行计算主键的表达式)
+# 表达式中的 {row} 在触发器里替换为 NEW / OLD，在回填时替换为 orders
+ROLLUP_TABLES = {
+    "orders_sales_by_month": (
+        ["month INTEGER", "year INTEGER"],
+        ["CAST(strftime('%m', {row}.create_time, 'unixepoch') AS INTEGER)",
+         "CAST(strftime('%Y', {row}.create_time, 'unixepoch') AS INTEGER)"],
+    ),
+    "orders_sales_by_customer": (["customer_name TEXT"], ["{row}.customer_name"]),
+    "orders_sales_by_product": (["product_name TEXT"], ["{row}.product_name"]),
+    "orders_sales_by_salesperson": (["sales_name TEXT"], ["{row}.sales_name"]),
+}
+
+# orders 表上的普通索引
+ORDER_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_orders_sales_name_time ON orders (sales_name, create_time DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_create_time ON orders (create_time)",
+]
+
+# rollup 表上用于排行榜的索引
+ROLLUP_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_sales_by_customer_total ON orders_sales_by_customer (total_sales DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_sales_by_product_count ON orders_sales_by_product (order_count DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_sales_by_salesperson_total ON orders_sales_by_salesperson (total_sales DESC)",
+]
+
+
+def _rollup_delta_sql(table: str, key_cols: list, key_exprs: list, row: str, sign: str) -> str:
+    # 生成把一行订单的金额/数量累加（sign='+'）或扣减（sign='-'）到 rollup 表的语句
+    names = [col.split()[0] for col in key_cols]
+    exprs = [expr.format(row=row) for expr in key_exprs]
+    sql = f"""
+        INSERT INTO {table} ({', '.join(names)}, total_sales, order_count)
+        VALUES ({', '.join(exprs)}, {sign}{row}.price, {sign}1)
+        ON CONFLICT ({', '.join(names)}) DO UPDATE SET
+            total_sales = total_sales + excluded.total_sales,
+            order_count = order_count + excluded.order_count;
+    """
+    if sign == "-":
+        # 扣减到 0 的分组直接删除，保证 rollup 表只保留有订单的分组
+        where = " AND ".join(f"{name} = {expr}" for name, expr in zip(names, exprs))
+        sql += f"DELETE FROM {table} WHERE {where} AND order_count <= 0;\n"
+    return sql
+
+
+def init_analytics(db: sqlite3.Connection):
+    """
+    创建 orders 索引、rollup 表以及同步触发器。
+    rollup 表首次创建时从 orders 全量回填一次，之后由触发器增量维护。
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for sql in ORDER_INDEXES:
+            db.execute(sql)
+
+        insert_body, delete_body = "", ""
+        for table, (key_cols, key_exprs) in ROLLUP_TABLES.items():
+            exists = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            ).fetchone()
+            names = [col.split()[0] for col in key_cols]
+            db.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {', '.join(key_cols)},
+                    total_sales REAL NOT NULL DEFAULT 0,
+                    order_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY ({', '.join(names)})
+                )
+            """)
+            if not exists:
+                exprs = [expr.format(row="orders") for expr in key_exprs]
+                db.execute(f"""
+                    INSERT INTO {table} ({', '.join(names)}, total_sales, order_count)
+                    SELECT {', '.join(exprs)}, SUM(price), COUNT(*)
+                    FROM orders
+                    GROUP BY {', '.join(exprs)}
+                """)
+            insert_body += _rollup_delta_sql(table, key_cols, key_exprs, "NEW", "+")
+            delete_body += _rollup_delta_sql(table, key_cols, key_exprs, "OLD", "-")
+
+        for sql in ROLLUP_INDEXES:
+            db.execute(sql)
+
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS trg_orders_rollup_insert AFTER INSERT ON orders BEGIN {insert_body} END")
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS trg_orders_rollup_delete AFTER DELETE ON orders BEGIN {delete_body} END")
+        db.execute(
+            "CREATE TRIGGER IF NOT EXISTS trg_orders_rollup_update "
+            "AFTER UPDATE OF create_time, customer_name, product_name, sales_name, price ON orders "
+            f"BEGIN {delete_body} {insert_body} END"
+        )
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+
+
+def migrate(path: str) -> bool:
+    """在 path 指向的主库上切换到 WAL 并建立索引和预聚合表，库不存在或没有 orders 表时返回 False"""
+    if not os.path.exists(path):
+        return False
+    conn = sqlite3.connect(path, timeout=ORDER_DB_BUSY_TIMEOUT / 1000)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'orders'").fetchone():
+            return False
+        conn.execute("PRAGMA journal_mode = WAL")
+        init_analytics(conn)
+        return True
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在订单主库上建立索引、预聚合表和触发器")
+    parser.add_argument("--db", default=ORDER_PRIMARY_DB_PATH, help="主库路径（不要指向只读副本）")
+    args = parser.parse_args()
+    if migrate(args.db):
+        print(f"{args.db}: 订单索引和预聚合表已就绪")
+    else:
+        print(f"{args.db}: 数据库不存在或没有 orders 表，跳过")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,184 @@
 from fastmcp import FastMCP
+import asyncio
+import logging
+import os
 import sqlite3
+import threading
+import time
 
-# 数据库连接
-conn = sqlite3.connect('chat_history.db')
-cursor = conn.cursor()
+import numpy as np
+import pandas as pd
+
+from mcp_server.order_schema import ROLLUP_TABLES
+
+logger = logging.getLogger(__name__)
+
+# 分析库路径：默认与聊天应用共用 chat_history.db，可配置为独立的只读副本
+ORDER_DB_PATH = os.getenv("ORDER_DB_PATH", "chat_history.db")
+# 内存映射 I/O 大小（字节），0 表示关闭
+ORDER_DB_MMAP_SIZE = int(os.getenv("ORDER_DB_MMAP_SIZE", 256 * 1024 * 1024))
+# 等待写锁释放的超时（毫秒）
+ORDER_DB_BUSY_TIMEOUT = int(os.getenv("ORDER_DB_BUSY_TIMEOUT", 5000))
+
+# 每个线程持有自己的只读连接，sqlite3 连接不能跨线程共享
+_local = threading.local()
+
+
+def get_connection() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(ORDER_DB_PATH, timeout=ORDER_DB_BUSY_TIMEOUT / 1000)
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute(f"PRAGMA mmap_size = {ORDER_DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout = {ORDER_DB_BUSY_TIMEOUT}")
+        _local.conn = conn
+    return conn
+
+
+def fetch_all(sql: str, params: tuple = ()) -> list:
+    return get_connection().execute(sql, params).fetchall()
+
+
+async def run_query(sql: str, params: tuple = ()) -> list:
+    # 在线程池中执行查询，避免阻塞事件循环，并发工具调用可以分散到多个线程
+    return await asyncio.to_thread(fetch_all, sql, params)
+
+
+def check_schema():
+    # 索引、预聚合表和触发器由 order_schema 在主库上创建，服务本身只读；缺失时统计类工具会报错
+    if not os.path.exists(ORDER_DB_PATH):
+        logger.warning("分析库 %s 不存在", ORDER_DB_PATH)
+        return
+    missing = [
+        table for table in ROLLUP_TABLES
+        if not fetch_all("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    ]
+    if missing:
+        logger.warning(
+            "分析库 %s 缺少预聚合表 %s，请先在主库上执行 python -m mcp_server.order_schema",
+            ORDER_DB_PATH, ", ".join(missing)
+        )
+
+
+check_schema()
+
+
+# 内存列式快照：整表加载一次，之后按 create_time 增量追加新订单
+# 增量刷新看不到历史订单的修改/删除，因此每隔一段时间全量重载一次
+ORDER_SNAPSHOT_FULL_RELOAD = float(os.getenv("ORDER_SNAPSHOT_FULL_RELOAD", 600))
+SNAPSHOT_COLUMNS = ["id", "customer_name", "product_name", "price", "sales_name", "create_time", "status"]
+AGGREGATE_DIMENSIONS = ["customer_name", "product_name", "sales_name", "status", "year", "month", "year_month"]
+AGGREGATE_METRICS = {"sum": "sum", "count": "size", "avg": "mean"}
+
+
+class OrdersSnapshot:
+    def __init__(self):
+        self.df = None
+        self.max_time = None
+        self.boundary_ids = set()   # create_time 等于 max_time 的订单 id，增量刷新时去重
+        self.loaded_at = 0.0
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def _to_frame(rows: list) -> pd.DataFrame:
+        df = pd.DataFrame(rows, columns=SNAPSHOT_COLUMNS)
+        # 与原 SQL 一致，按 UTC 解析 unix 时间戳
+        created = pd.to_datetime(df["create_time"], unit="s")
+        df["year"] = created.dt.year
+        df["month"] = created.dt.month
+        df["year_month"] = created.dt.strftime("%Y-%m")
+        return df
+
+    def _mark_boundary(self):
+        times = self.df["create_time"].to_numpy()
+        if len(times) == 0:
+            self.max_time, self.boundary_ids = None, set()
+            return
+        self.max_time = int(times.max())
+        self.boundary_ids = set(self.df["id"].to_numpy()[times == self.max_time].tolist())
+
+    def _load_full(self):
+        rows = fetch_all(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM orders")
+        self.df = self._to_frame(rows)
+        self._mark_boundary()
+        self.loaded_at = time.monotonic()
+
+    def _load_incremental(self):
+        if self.max_time is None:
+            self._load_full()
+            return
+        # create_time 上有索引，只会读到新订单和边界上的少量订单
+        rows = fetch_all(
+            f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM orders WHERE create_time >= ?",
+            (self.max_time,),
+        )
+        rows = [row for row in rows if row[0] not in self.boundary_ids]
+        if rows:
+            self.df = pd.concat([self.df, self._to_frame(rows)], ignore_index=True)
+            self._mark_boundary()
+
+    async def get(self) -> pd.DataFrame:
+        async with self.lock:
+            if self.df is None or time.monotonic() - self.loaded_at > ORDER_SNAPSHOT_FULL_RELOAD:
+                await asyncio.to_thread(self._load_full)
+            else:
+                await asyncio.to_thread(self._load_incremental)
+        return self.df
+
+
+orders_snapshot = OrdersSnapshot()
+
+
+def _parse_date(value: str, end: bool = False) -> int:
+    # 'YYYY-MM-DD' -> unix 时间戳（UTC）；结束日期包含当天
+    ts = pd.Timestamp(value)
+    if end:
+        ts += pd.Timedelta(days=1)
+    return int(ts.timestamp())
+
+
+def aggregate(df: pd.DataFrame, dimensions: list, metric: str, start_ts: int = None, end_ts: int = None, top_n: int = 10) -> list:
+    """
+    在快照上做向量化过滤和分组聚合，返回 [(分组键元组, 指标值), ...]，按指标值降序取前 top_n。
+    """
+    mask = np.ones(len(df), dtype=bool)
+    times = df["create_time"].to_numpy()
+    if start_ts is not None:
+        mask &= times >= start_ts
+    if end_ts is not None:
+        mask &= times < end_ts
+    prices = df["price"][mask]
+
+    if not dimensions:
+        if metric == "count":
+            return [((), int(mask.sum()))]
+        return [((), float(getattr(prices, AGGREGATE_METRICS[metric])()) if len(prices) else None)]
+
+    grouped = prices.groupby([df[dim][mask] for dim in dimensions], sort=False)
+    values = getattr(grouped, AGGREGATE_METRICS[metric])()
+    values = values.nlargest(top_n)
+    return [
+        (key if isinstance(key, tuple) else (key,), value.item() if hasattr(value, "item") else value)
+        for key, value in values.items()
+    ]
 
 # 创建 FastMCP 服务器
 mcp = FastMCP("order service mcp")
 
 
 @mcp.tool(description="获取指定月份的销售总额")
-def get_monthly_sales_total(month: int) -> str:
+async def get_monthly_sales_total(month: int) -> str:
     # 验证月份参数
     if not (1 <= month <= 12):
         return "无效的月份"
     
-    # 将整数月份转换为两位数字字符串（如 1 -> '01'）
-    month_str = f"{month:02d}"
-    
-    # 参数化查询
+    # 从按月预聚合表中查询（主键前缀为 month，走索引）
     query = """
-    SELECT SUM(price) as total_sales
-    FROM orders
-    WHERE strftime('%m', datetime(create_time, 'unixepoch')) = ?
+    SELECT SUM(total_sales) as total_sales
+    FROM orders_sales_by_month
+    WHERE month = ?
     """
-    cursor.execute(query, (month_str,))
-    result = cursor.fetchone()
+    result = (await run_query(query, (month,)))[0]
     
     # 处理查询结果
     if result[0] is None:
@@ -34,48 +187,44 @@ def get_monthly_sales_total(month: int) -> str:
  
 
 @mcp.tool(description="获取消费最高的用户")
-def get_highest_spending_customer() -> str:
+async def get_highest_spending_customer() -> str:
     query = """
-    SELECT customer_name, SUM(price) as total_consumption
-    FROM orders
-    GROUP BY customer_name
-    ORDER BY total_consumption DESC
+    SELECT customer_name, total_sales as total_consumption
+    FROM orders_sales_by_customer
+    ORDER BY total_sales DESC
     LIMIT 1
     """
-    cursor.execute(query)
-    result = cursor.fetchone()
+    rows = await run_query(query)
+    result = rows[0] if rows else None
     if result is None:
         return "未找到客户记录"
     return f"消费最高的用户：{result[0]}，总消费额 {result[1]}"
 
 # 工具 3：获取最受欢迎的产品（基于订单数量）
 @mcp.tool(description="获取最受欢迎的产品（基于订单数量）")
-def get_most_popular_product() -> str:
+async def get_most_popular_product() -> str:
     query = """
-    SELECT product_name, COUNT(*) as order_count
-    FROM orders
-    GROUP BY product_name
+    SELECT product_name, order_count
+    FROM orders_sales_by_product
     ORDER BY order_count DESC
     LIMIT 1
     """
-    cursor.execute(query)
-    result = cursor.fetchone()
+    rows = await run_query(query)
+    result = rows[0] if rows else None
     if result is None:
         return "未找到产品记录"
     return f"最受欢迎的产品：{result[0]}，订单数量 {result[1]}"
 
 # 工具 4：获取销售员排行榜（基于总销售额）
 @mcp.tool(description="获取销售员排行榜（基于总销售额）")
-def get_salesperson_ranking(limit: int = 10) -> str:
-    query = f"""
-    SELECT sales_name, SUM(price) as total_sales
-    FROM orders
-    GROUP BY sales_name
+async def get_salesperson_ranking(limit: int = 10) -> str:
+    query = """
+    SELECT sales_name, total_sales
+    FROM orders_sales_by_salesperson
     ORDER BY total_sales DESC
     LIMIT ?
     """
-    cursor.execute(query, (limit,))
-    results = cursor.fetchall()
+    results = await run_query(query, (limit,))
     if not results:
         return "未找到销售员记录"
     # 这段代码将查询结果格式化为销售员排行榜的字符串。
@@ -89,7 +238,7 @@ def get_salesperson_ranking(limit: int = 10) -> str:
 
 # 工具 5：查询某销售员的销售记录，按照时间倒序
 @mcp.tool(description="查询某销售员（周慧，李娜，黄健等）的销售记录，按照时间倒序，最多20条")
-def get_salesperson_sales_detail(sales_name: str) -> str:
+async def get_salesperson_sales_detail(sales_name: str) -> str:
     query = """
     SELECT sales_name, sales_id, product_name, product_id, price, create_time
     FROM orders
@@ -97,8 +246,7 @@ def get_salesperson_sales_detail(sales_name: str) -> str:
     ORDER BY create_time DESC
     LIMIT 20
     """
-    cursor.execute(query, (sales_name,))
-    results = cursor.fetchall()
+    results = await run_query(query, (sales_name,))
     if not results:
         return "未找到销售员记录"
     # 输出格式为：销售员: {name}，销售ID: {sales_id}，产品: {product_name}（ID: {product_id}），价格: {price}，时间: {create_time}
@@ -109,4 +257,39 @@ def get_salesperson_sales_detail(sales_name: str) -> str:
     return ranking
 
 
+# 工具 6：通用订单聚合
+@mcp.tool(description=(
+    "通用订单统计：按维度分组聚合订单金额。"
+    "group_by 为逗号分隔的维度，可选 customer_name, product_name, sales_name, status, year, month, year_month，留空表示不分组；"
+    "metric 可选 sum（销售额）、count（订单数）、avg（平均客单价）；"
+    "start_date / end_date 为 YYYY-MM-DD 格式的起止日期（含当天，可留空）；top_n 为返回的前 N 组"
+))
+async def aggregate_orders(group_by: str = "", metric: str = "sum", start_date: str = "", end_date: str = "", top_n: int = 10) -> str:
+    dimensions = [dim.strip() for dim in group_by.split(",") if dim.strip()]
+    invalid = [dim for dim in dimensions if dim not in AGGREGATE_DIMENSIONS]
+    if invalid:
+        return f"无效的分组维度：{', '.join(invalid)}，可选：{', '.join(AGGREGATE_DIMENSIONS)}"
+    if metric not in AGGREGATE_METRICS:
+        return f"无效的统计指标：{metric}，可选：{', '.join(AGGREGATE_METRICS)}"
+    try:
+        start_ts = _parse_date(start_date) if start_date else None
+        end_ts = _parse_date(end_date, end=True) if end_date else None
+    except ValueError:
+        return "无效的日期，请使用 YYYY-MM-DD 格式"
+
+    df = await orders_snapshot.get()
+    results = await asyncio.to_thread(aggregate, df, dimensions, metric, start_ts, end_ts, max(1, top_n))
+    if not results or results[0][1] is None:
+        return "未找到符合条件的订单记录"
+
+    metric_name = {"sum": "销售额", "count": "订单数", "avg": "平均金额"}[metric]
+    if not dimensions:
+        return f"{metric_name}：{results[0][1]}"
+    lines = [
+        "，".join(f"{dim}={value}" for dim, value in zip(dimensions, key)) + f"：{value}"
+        for key, value in results
+    ]
+    return f"按 {', '.join(dimensions)} 统计的{metric_name}（前{len(lines)}组）：\n" + "\n".join(lines)
+
+
 app = mcp.sse_app()
\ No newline at end of file
@@ -0,0 +1,170 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# 延迟直方图的默认分桶（秒），覆盖从毫秒级的数据库写入到分钟级的长回答
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()       # 会在线程池（数据库线程、to_thread）中记录
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_items(items))
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_items(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各分桶计数（不累计）..., +Inf 分桶计数, 总和]
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[bisect.bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_items(self, items):
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class GaugeCallback(_Metric):
+    """抓取时才取值的指标，callback 返回 {标签值元组: 数值}"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple, callback, type: str = "gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type = type
+
+    def _render_items(self, items):
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self.callback().items())
+        ]
+
+
+def render() -> str:
+    """Prometheus 文本格式（0.0.4）"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def chat_mode(web_search: bool, rag_search: bool, agent_mode: bool) -> str:
+    # 聊天请求的模式标签，组合数量固定，避免标签基数膨胀
+    if agent_mode:
+        return "agent"
+    if web_search and rag_search:
+        return "web_rag"
+    if web_search:
+        return "web"
+    if rag_search:
+        return "rag"
+    return "chat"
+
+
+# 聊天流程
+chat_requests = Counter("chat_requests_total", "聊天请求数", ("mode",))
+chat_stage_seconds = Histogram(
+    "chat_stage_seconds",
+    "聊天流程各阶段耗时（秒）：load_history / web_search / rag_embed / rag_search / agent_decision / "
+    "mcp_tool_call / llm_first_token / llm_generation",
+    ("stage", "mode"),
+)
+llm_tokens_per_second = Histogram(
+    "llm_tokens_per_second", "流式生成速度（估算 token / 秒，从首个 token 起算）", ("mode",), TOKEN_RATE_BUCKETS
+)
+llm_output_tokens = Counter("llm_output_tokens_total", "流式生成的 token 数（估算）", ("mode",))
+
+# SQLite 写入
+sqlite_write_seconds = Histogram("sqlite_write_seconds", "写入队列每批提交的耗时（秒）", ())
+sqlite_write_statements = Counter("sqlite_write_statements_total", "写入队列提交的语句数", ())
+
+# 事件循环
+event_loop_lag_seconds = Histogram("event_loop_lag_seconds", "事件循环心跳的延迟（秒），反映阻塞调用的影响", ())
+event_loop_stalls = Counter("event_loop_stalls_total", "事件循环阻塞超过 LOOP_LAG_THRESHOLD_MS 的次数", ())
+
+
+def _admission_values(field: str):
+    import admission
+
+    return lambda: {(name,): snapshot[field] for name, snapshot in admission.snapshot().items()}
+
+
+# 上游准入控制的实时状态
+GaugeCallback("upstream_in_flight", "上游正在执行的请求数", ("upstream",), _admission_values("in_flight"))
+GaugeCallback("upstream_queue_depth", "上游排队等待的请求数", ("upstream",), _admission_values("queue_depth"))
+GaugeCallback("upstream_rejected_total", "上游拒绝的请求数", ("upstream",), _admission_values("rejected"), "counter")
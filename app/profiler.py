@@ -0,0 +1,168 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# 事件循环卡顿监控与采样分析配置（可通过环境变量覆盖）
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", 200))     # 事件循环被阻塞超过该时长记为一次卡顿，0 关闭监控
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", 0.1))      # 心跳间隔（秒），也是卡顿检测的精度
+LOOP_STALL_HISTORY = int(os.getenv("LOOP_STALL_HISTORY", 100))              # 内存中保留的最近卡顿记录数
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))           # 单次采样分析的最长时间（秒）
+STACK_MAX_DEPTH = 64
+
+_stalls = collections.deque(maxlen=LOOP_STALL_HISTORY)
+_pending = None                 # 看门狗线程发现、心跳尚未恢复的卡顿
+_pending_lock = threading.Lock()
+_last_beat = 0.0
+_loop_thread_id = None
+_heartbeat_task = None
+_watchdog = None
+_watchdog_stop = threading.Event()
+_profile_lock = threading.Lock()
+_stdlib_dir = sysconfig.get_paths()["stdlib"] + os.sep
+
+
+def _frame_label(code) -> str:
+    # 折叠栈格式以 ";" 分隔帧、以空格分隔计数，帧名里不能出现这两个字符
+    path = code.co_filename
+    marker = "site-packages" + os.sep
+    if marker in path:
+        path = path.split(marker, 1)[1]
+    elif path.startswith(_stdlib_dir):
+        path = path[len(_stdlib_dir):]
+    elif path.startswith(os.getcwd() + os.sep):
+        path = os.path.relpath(path)
+    return f"{code.co_name}({path}:{code.co_firstlineno})".replace(";", ":").replace(" ", "_")
+
+
+def _collapse(frame) -> list:
+    """frame 所在调用栈从外到内的帧名列表"""
+    labels = []
+    while frame is not None and len(labels) < STACK_MAX_DEPTH:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+# ---------------- 事件循环卡顿监控 ----------------
+# 心跳协程按固定间隔更新时间戳，看门狗线程发现心跳超过阈值没有更新时，
+# 说明事件循环线程正在执行阻塞调用，此时抓取该线程的调用栈即为阻塞点。
+
+async def _heartbeat():
+    global _last_beat, _pending
+    while True:
+        expected = time.monotonic() + LOOP_MONITOR_INTERVAL
+        await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+        now = time.monotonic()
+        lag = max(now - expected, 0.0)
+        _last_beat = now
+        metrics.event_loop_lag_seconds.observe(lag)
+        with _pending_lock:
+            stall, _pending = _pending, None
+        if stall is not None:
+            stall["duration_ms"] = round(lag * 1000, 1)
+            _stalls.append(stall)
+            metrics.event_loop_stalls.inc()
+            logger.warning("事件循环阻塞 %.0fms，阻塞位置:\n%s", lag * 1000, stall["traceback"])
+
+
+def _watch():
+    global _pending
+    while not _watchdog_stop.wait(LOOP_MONITOR_INTERVAL / 2):
+        blocked_ms = (time.monotonic() - _last_beat - LOOP_MONITOR_INTERVAL) * 1000
+        if blocked_ms < LOOP_LAG_THRESHOLD_MS or _pending is not None:
+            continue
+        frame = sys._current_frames().get(_loop_thread_id)
+        if frame is None:
+            continue
+        stall = {
+            "detected_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "stack": ";".join(_collapse(frame)),
+            "traceback": "".join(traceback.format_stack(frame, limit=STACK_MAX_DEPTH)),
+        }
+        del frame
+        with _pending_lock:
+            # 心跳可能刚好恢复，此时这次抓到的栈已经不是阻塞点
+            if time.monotonic() - _last_beat - LOOP_MONITOR_INTERVAL >= LOOP_LAG_THRESHOLD_MS / 1000:
+                _pending = stall
+
+
+def start_monitor():
+    global _heartbeat_task, _watchdog, _loop_thread_id, _last_beat
+    # 采样分析按线程 id 区分事件循环线程，关闭卡顿监控时也要记录
+    _loop_thread_id = threading.get_ident()
+    if LOOP_LAG_THRESHOLD_MS <= 0 or (_heartbeat_task is not None and not _heartbeat_task.done()):
+        return
+    _last_beat = time.monotonic()
+    _heartbeat_task = asyncio.create_task(_heartbeat())
+    _watchdog_stop.clear()
+    _watchdog = threading.Thread(target=_watch, name="loop-watchdog", daemon=True)
+    _watchdog.start()
+
+
+async def stop_monitor():
+    global _heartbeat_task, _watchdog
+    if _watchdog is not None:
+        _watchdog_stop.set()
+        _watchdog.join()
+        _watchdog = None
+    if _heartbeat_task is not None:
+        _heartbeat_task.cancel()
+        try:
+            await _heartbeat_task
+        except asyncio.CancelledError:
+            pass
+        _heartbeat_task = None
+
+
+def recent_stalls(limit: int = 50) -> list:
+    """最近的卡顿记录，最新的在前"""
+    return list(reversed(_stalls))[:limit]
+
+
+# ---------------- 采样分析 ----------------
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def profile(seconds: float, interval_ms: float = 5, threads: str = "loop") -> str:
+    """
+    按 interval_ms 对线程调用栈采样 seconds 秒，返回折叠栈文本（每行 "帧;帧;... 次数"），
+    可直接交给 flamegraph.pl / speedscope 生成火焰图。
+    threads 为 "loop" 时只采样事件循环线程，"all" 时采样所有线程（栈底为线程名）。
+    在线程中阻塞执行，同一时间只允许一次采样。
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("已有采样分析正在进行")
+    try:
+        seconds = min(seconds, PROFILE_MAX_SECONDS)
+        interval = interval_ms / 1000
+        me = threading.get_ident()
+        counts = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me or (threads == "loop" and thread_id != _loop_thread_id):
+                    continue
+                stack = _collapse(frame)
+                if threads != "loop":
+                    stack.insert(0, names.get(thread_id, str(thread_id)).replace(" ", "_"))
+                counts[";".join(stack)] += 1
+            frame = None
+            time.sleep(interval)
+        return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+    finally:
+        _profile_lock.release()
@@ -0,0 +1,307 @@
+import asyncio
+import functools
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+# 聊天记录数据库配置（可通过环境变量覆盖）
+DB_PATH = os.getenv("CHAT_DB_PATH", "chat_history.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))              # 连接池大小，同时也是数据库线程数
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", 5000))     # 等待写锁的超时（毫秒）
+DB_STATEMENT_CACHE = 256                                      # 每个连接缓存的预编译语句数
+# 归档会话单独存放的数据库文件（可放在更便宜的存储上），为空时归档表放在主库中
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "")
+ARCHIVE_TABLE = "archive.archived_sessions" if ARCHIVE_DB_PATH else "archived_sessions"
+
+
+class ConnectionPool:
+    """
+    固定大小的 SQLite 连接池。连接以自动提交模式打开，需要事务时显式 BEGIN。
+    所有连接都只在数据库线程池中使用，线程数与连接数相同，因此不会出现等待连接的情况。
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT / 1000,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}")
+        if ARCHIVE_DB_PATH:
+            conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+            conn.execute("PRAGMA archive.journal_mode = WAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                conn = self._connect() if len(self._all) < self.size else None
+                if conn is not None:
+                    self._all.append(conn)
+            if conn is None:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+            self._idle = queue.LifoQueue()
+
+
+pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="sqlite")
+
+
+def now() -> str:
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    # 写事务：BEGIN IMMEDIATE 先拿写锁，避免读后升级写锁时出现 "database is locked"
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _with_connection(fn, *args):
+    with pool.connection() as conn:
+        return fn(conn, *args)
+
+
+async def run(fn, *args):
+    """在数据库线程中以 fn(conn, *args) 的形式执行，返回其结果"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(_with_connection, fn, *args))
+
+
+async def fetch_all(sql: str, params: tuple = ()) -> list:
+    def _fetch(conn):
+        return [dict(row) for row in conn.execute(sql, params).fetchall()]
+    return await run(_fetch)
+
+
+async def fetch_one(sql: str, params: tuple = ()):
+    def _fetch(conn):
+        row = conn.execute(sql, params).fetchone()
+        return dict(row) if row else None
+    return await run(_fetch)
+
+
+async def execute(sql: str, params: tuple = ()) -> int:
+    """执行单条写语句，返回受影响的行数"""
+    def _execute(conn):
+        return conn.execute(sql, params).rowcount
+    return await run(_execute)
+
+
+async def execute_many(statements: list) -> list:
+    """在同一个事务中依次执行 [(sql, params), ...]，返回每条语句受影响的行数"""
+    def _execute(conn):
+        with transaction(conn):
+            return [conn.execute(sql, params).rowcount for sql, params in statements]
+    return await run(_execute)
+
+
+def _init_schema(conn: sqlite3.Connection):
+    # 增量回收空闲页（新库立即生效，已有的库需停服执行 python -m chat_archive --enable-incremental-vacuum）
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    # Create chat sessions table
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS chat_sessions (
+        id TEXT PRIMARY KEY,
+        summary TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # Create messages table
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT,
+        role TEXT,
+        content TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+    )
+    ''')
+
+    # Create MCP servers table
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS mcp_servers (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        url TEXT NOT NULL,
+        description TEXT,
+        auth_type TEXT,
+        auth_value TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # Create MCP tools table
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS mcp_tools (
+        id TEXT PRIMARY KEY,
+        server_id TEXT,
+        name TEXT NOT NULL,
+        description TEXT,
+        input_schema TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (server_id) REFERENCES mcp_servers(id)
+    )
+    ''')
+
+    # 会话滚动记忆：早期对话的压缩摘要，以及摘要已覆盖到的消息 id
+    _add_columns(conn, "chat_sessions", {
+        "memory_summary": "TEXT",
+        "memory_upto": "INTEGER NOT NULL DEFAULT 0",
+    })
+
+    # 会话消息按 (session_id, id) 分页查询，会话列表按 (updated_at, id) 倒序分页
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages (session_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated_at ON chat_sessions (updated_at, id)")
+
+    # 归档会话：元数据 + zlib 压缩的消息 JSON，每个会话一行
+    schema = "archive." if ARCHIVE_DB_PATH else ""
+    if ARCHIVE_DB_PATH:
+        conn.execute("PRAGMA archive.auto_vacuum = INCREMENTAL")
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {ARCHIVE_TABLE} (
+        id TEXT PRIMARY KEY,
+        summary TEXT,
+        created_at TIMESTAMP,
+        updated_at TIMESTAMP,
+        archived_at TIMESTAMP,
+        message_count INTEGER NOT NULL,
+        payload BLOB NOT NULL
+    )
+    ''')
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}idx_archived_sessions_updated_at ON archived_sessions (updated_at, id)")
+
+    # 流式生成的帧日志（STREAM_LOG_SPILL 开启时使用），用于断线续传
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stream_frames (
+        generation_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (generation_id, seq)
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stream_frames_created_at ON stream_frames (created_at)")
+
+    # 慢请求日志：超过 SLOW_REQUEST_THRESHOLD_MS 的请求及其各阶段耗时
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS slow_requests (
+        trace_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        status TEXT NOT NULL,
+        duration_ms REAL NOT NULL,
+        attributes TEXT NOT NULL,
+        spans TEXT NOT NULL,
+        created_at TIMESTAMP NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_slow_requests_created_at ON slow_requests (created_at)")
+
+    _init_search_index(conn)
+
+
+def _add_columns(conn: sqlite3.Connection, table: str, columns: dict):
+    # 已有数据库不会因为 CREATE TABLE IF NOT EXISTS 获得新列，这里按需补齐
+    existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    for name, definition in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def _init_search_index(conn: sqlite3.Connection):
+    # 消息全文索引：FTS5 trigram 分词，中文无需分词器即可子串检索
+    with transaction(conn):
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone()
+        conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content,
+            session_id UNINDEXED,
+            tokenize = 'trigram'
+        )
+        ''')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS search_index_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        ''')
+        if not exists:
+            # 新建索引时记录需要回填的历史消息范围，由后台任务分批回填
+            max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+            conn.execute("INSERT OR REPLACE INTO search_index_state (name, value) VALUES ('backfill_upto', ?)", (max_id,))
+            conn.execute("INSERT OR REPLACE INTO search_index_state (name, value) VALUES ('backfill_done', 0)")
+
+        # 触发器保持索引与 messages 同步，rowid 即消息 id
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content, session_id) VALUES (NEW.id, NEW.content, NEW.session_id);
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete AFTER DELETE ON messages BEGIN
+            DELETE FROM messages_fts WHERE rowid = OLD.id;
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update AFTER UPDATE OF content, session_id ON messages BEGIN
+            DELETE FROM messages_fts WHERE rowid = OLD.id;
+            INSERT INTO messages_fts (rowid, content, session_id) VALUES (NEW.id, NEW.content, NEW.session_id);
+        END
+        ''')
+
+
+async def init_db():
+    await run(_init_schema)
+    logger.info("数据库初始化完成")
+
+
+def close():
+    # 等待已提交的数据库任务执行完，再关闭所有连接
+    _executor.shutdown(wait=True)
+    pool.close()
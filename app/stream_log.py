@@ -0,0 +1,169 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+import storage
+from write_queue import write_queue
+
+logger = logging.getLogger(__name__)
+
+
+# 帧日志配置（可通过环境变量覆盖）
+STREAM_LOG_TTL = float(os.getenv("STREAM_LOG_TTL", 300))                        # 生成结束后帧日志保留多久（秒）
+STREAM_LOG_SPILL = os.getenv("STREAM_LOG_SPILL", "false").lower() == "true"     # 是否把结束的生成落盘到 SQLite
+STREAM_RETRY_MS = int(os.getenv("STREAM_RETRY_MS", 1000))                       # 建议浏览器的重连间隔（毫秒）
+STREAM_SHUTDOWN_GRACE = float(os.getenv("STREAM_SHUTDOWN_GRACE", 10))          # 关闭服务时等待进行中的生成结束的最长时间（秒），超时后取消
+STREAM_LOG_CLEANUP_INTERVAL = 60
+
+
+class Generation:
+    """
+    一次大模型生成的帧日志。上游只消费一次，所有连接（包括断线重连）都从这里读取，
+    帧序号从 1 开始，SSE 的事件 id 为 "<generation_id>:<seq>"。
+    """
+
+    def __init__(self, generation_id: str, frames: list = None, done: bool = False):
+        self.id = generation_id
+        self.frames = frames or []
+        self.done = done
+        self.finished_at = time.time() if done else None
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def append(self, frame: str):
+        self.frames.append(frame)
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self.finished_at = time.time()
+        self._notify()
+
+    def _notify(self):
+        # 唤醒所有等待者，并为下一次等待换一个新的 Event
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+
+_generations = {}
+_producers = set()          # 进行中的生成任务，关闭服务时等待或取消
+_cleanup_task = None
+
+
+def start(body_iterator) -> Generation:
+    """在后台消费上游的 SSE 帧并写入帧日志，客户端断开不会中断生成"""
+    generation = Generation(uuid.uuid4().hex)
+    _generations[generation.id] = generation
+    generation.task = asyncio.create_task(_produce(generation, body_iterator))
+    _producers.add(generation.task)
+    generation.task.add_done_callback(_producers.discard)
+    return generation
+
+
+async def stop_generations():
+    """等待进行中的生成最多 STREAM_SHUTDOWN_GRACE 秒（回答和帧日志照常写入），之后取消剩余的生成"""
+    if not _producers:
+        return
+    tasks = list(_producers)
+    _, pending = await asyncio.wait(tasks, timeout=STREAM_SHUTDOWN_GRACE)
+    if pending:
+        logger.warning("关闭服务时取消 %d 个未完成的生成", len(pending))
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _produce(generation: Generation, body_iterator):
+    try:
+        async for frame in body_iterator:
+            generation.append(frame if isinstance(frame, str) else frame.decode("utf-8"))
+    except Exception as e:
+        generation.append(f"data: {json.dumps({'content': f'错误：生成中断 - {str(e)}', 'done': True})}\n\n")
+    finally:
+        generation.finish()
+    if STREAM_LOG_SPILL:
+        await _spill(generation)
+
+
+async def _spill(generation: Generation):
+    # 结束的生成写入 SQLite，内存淘汰或进程重启后仍能续传
+    created_at = generation.finished_at
+    await write_queue.submit([
+        (
+            "INSERT OR REPLACE INTO stream_frames (generation_id, seq, data, created_at) VALUES (?, ?, ?, ?)",
+            (generation.id, seq, frame, created_at)
+        )
+        for seq, frame in enumerate(generation.frames, start=1)
+    ])
+
+
+def parse_event_id(event_id: str):
+    generation_id, _, seq = (event_id or "").partition(":")
+    if not generation_id or not seq.isdigit():
+        return None, 0
+    return generation_id, int(seq)
+
+
+async def find(generation_id: str):
+    generation = _generations.get(generation_id)
+    if generation is None and STREAM_LOG_SPILL:
+        rows = await storage.fetch_all(
+            "SELECT data FROM stream_frames WHERE generation_id = ? ORDER BY seq",
+            (generation_id,)
+        )
+        if rows:
+            generation = Generation(generation_id, [row["data"] for row in rows], done=True)
+    return generation
+
+
+def has_pending(generation: Generation, after_seq: int) -> bool:
+    return not generation.done or after_seq < len(generation.frames)
+
+
+async def subscribe(generation: Generation, after_seq: int = 0):
+    """从 after_seq 之后的帧开始输出，直到生成结束"""
+    yield f"retry: {STREAM_RETRY_MS}\n\n"
+    seq = after_seq
+    while True:
+        changed = generation._changed
+        while seq < len(generation.frames):
+            frame = generation.frames[seq]
+            seq += 1
+            yield f"id: {generation.id}:{seq}\n{frame}"
+        if generation.done:
+            return
+        await changed.wait()
+
+
+async def _cleanup_loop():
+    while True:
+        await asyncio.sleep(STREAM_LOG_CLEANUP_INTERVAL)
+        expire_before = time.time() - STREAM_LOG_TTL
+        for generation_id, generation in list(_generations.items()):
+            if generation.done and generation.finished_at < expire_before:
+                _generations.pop(generation_id, None)
+        if STREAM_LOG_SPILL:
+            try:
+                await write_queue.submit([("DELETE FROM stream_frames WHERE created_at < ?", (expire_before,))])
+            except Exception as e:
+                logger.warning("清理帧日志失败: %s", e)
+
+
+def start_cleanup():
+    global _cleanup_task
+    if _cleanup_task is None or _cleanup_task.done():
+        _cleanup_task = asyncio.create_task(_cleanup_loop())
+
+
+async def stop_cleanup():
+    global _cleanup_task
+    if _cleanup_task is not None:
+        _cleanup_task.cancel()
+        try:
+            await _cleanup_task
+        except asyncio.CancelledError:
+            pass
+        _cleanup_task = None
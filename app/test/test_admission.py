@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+import admission
+from admission import BATCH, INTERACTIVE, AdmissionRejected, Limiter
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_priority_waiter_gets_slot_first():
+    async def main():
+        limiter = Limiter("test", 1, 0, 8)
+        slot = await limiter.acquire()
+        order = []
+
+        async def waiter(name, priority):
+            async with limiter.slot(priority):
+                order.append(name)
+
+        tasks = [asyncio.create_task(waiter("batch", BATCH)), asyncio.create_task(waiter("chat", INTERACTIVE))]
+        await asyncio.sleep(0)
+        slot.release()
+        await asyncio.gather(*tasks)
+        return order, limiter.in_flight
+
+    assert run(main()) == (["chat", "batch"], 0)
+
+
+def test_full_queue_rejects():
+    async def main():
+        limiter = Limiter("test", 1, 0, 1)
+        slot = await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as e:
+            await limiter.acquire()
+        assert e.value.queue_position == 2
+        slot.release()
+        (await queued).release()
+        return limiter.in_flight, limiter.rejected
+
+    assert run(main()) == (0, 1)
+
+
+def test_cancelled_waiter_hands_slot_to_next():
+    async def main():
+        limiter = Limiter("test", 1, 0, 8)
+        slot = await limiter.acquire()
+        first = asyncio.create_task(limiter.acquire())
+        second = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        # 名额交接给 first 后、first 恢复运行前被取消：first 要么拿到名额，要么把名额转交给 second
+        slot.release()
+        first.cancel()
+        try:
+            (await first).release()
+        except asyncio.CancelledError:
+            pass
+        (await asyncio.wait_for(second, 1)).release()
+        return limiter.in_flight, len(limiter._waiters)
+
+    assert run(main()) == (0, 0)
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def main():
+        limiter = Limiter("test", 1, 0, 8)
+        slot = await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert len(limiter._waiters) == 0
+        slot.release()
+        return limiter.in_flight
+
+    assert run(main()) == 0
+
+
+def test_wait_timeout_rejects_and_leaves_queue(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_MAX_WAIT", 0.01)
+
+    async def main():
+        limiter = Limiter("test", 1, 0, 8)
+        slot = await limiter.acquire()
+        with pytest.raises(AdmissionRejected):
+            await limiter.acquire()
+        assert len(limiter._waiters) == 0
+        slot.release()
+        return limiter.in_flight
+
+    assert run(main()) == 0
+
+
+def test_slot_release_is_idempotent():
+    async def main():
+        limiter = Limiter("test", 2, 0, 8)
+        slot = await limiter.acquire()
+        slot.release()
+        slot.release()
+        return limiter.in_flight
+
+    assert run(main()) == 0
+
+
+def test_thread_slot_from_worker_thread():
+    async def main():
+        limiter = Limiter("test", 1, 0, 8)
+        loop = asyncio.get_running_loop()
+
+        def work():
+            with limiter.thread_slot(loop, BATCH):
+                return limiter.in_flight
+
+        held = await asyncio.to_thread(work)
+        await asyncio.sleep(0)
+        return held, limiter.in_flight
+
+    assert run(main()) == (1, 0)
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+from fastmcp.exceptions import ClientError, ToolError
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, INVALID_PARAMS, ErrorData
+
+import mcp_health
+
+URL = "http://mcp.test/sse"
+
+
+class FakeClient:
+    """替代 fastmcp.Client：call_tool 抛出预设的异常，或返回结果"""
+
+    error = None
+
+    def __init__(self, transport):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def call_tool(self, name, parameters):
+        if FakeClient.error is not None:
+            raise FakeClient.error
+        return ["ok"]
+
+
+@pytest.fixture(autouse=True)
+def fake_client(monkeypatch):
+    monkeypatch.setattr(mcp_health, "Client", FakeClient)
+    monkeypatch.setattr(mcp_health, "MCP_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(mcp_health, "MCP_RECOVERY_TIMEOUT", 0.05)
+    mcp_health.forget(URL)
+    FakeClient.error = None
+    yield
+    mcp_health.forget(URL)
+
+
+def call(error=None):
+    FakeClient.error = error
+    return asyncio.run(mcp_health.call_tool(URL, "tool", {}))
+
+
+def mcp_error(code):
+    return McpError(ErrorData(code=code, message="error"))
+
+
+@pytest.mark.parametrize("error", [
+    ClientError("参数错误"),
+    ToolError("工具执行失败"),
+    mcp_error(INVALID_PARAMS),
+])
+def test_tool_errors_do_not_open_circuit(error):
+    for _ in range(5):
+        with pytest.raises(type(error)):
+            call(error)
+    health = mcp_health.get_health(URL)
+    assert health["state"] == mcp_health.CLOSED
+    assert health["consecutive_failures"] == 0
+
+
+@pytest.mark.parametrize("error", [
+    mcp_error(CONNECTION_CLOSED),
+    mcp_error(408),
+    ConnectionError("connection refused"),
+])
+def test_transport_errors_open_circuit(error):
+    for _ in range(3):
+        with pytest.raises(type(error)):
+            call(error)
+    assert mcp_health.get_health(URL)["state"] == mcp_health.OPEN
+    # 熔断中直接快速失败，不再调用服务器
+    with pytest.raises(mcp_health.CircuitOpenError):
+        call()
+
+
+def test_half_open_trial():
+    for _ in range(3):
+        with pytest.raises(McpError):
+            call(mcp_error(CONNECTION_CLOSED))
+    assert mcp_health.get_health(URL)["state"] == mcp_health.OPEN
+
+    # 恢复时间到后放行一次试探：连接仍断开则重新熔断
+    asyncio.run(asyncio.sleep(0.06))
+    with pytest.raises(McpError):
+        call(mcp_error(CONNECTION_CLOSED))
+    assert mcp_health.get_health(URL)["state"] == mcp_health.OPEN
+
+    # 工具级错误说明服务器已恢复，关闭熔断
+    asyncio.run(asyncio.sleep(0.06))
+    assert mcp_health.is_available(URL)
+    with pytest.raises(ToolError):
+        call(ToolError("参数错误"))
+    assert mcp_health.get_health(URL)["state"] == mcp_health.CLOSED
+    assert call() == ["ok"]
+
+
+def test_half_open_allows_single_trial():
+    breaker = mcp_health.get_breaker(URL)
+    for _ in range(3):
+        breaker.record_failure("down", 0)
+    asyncio.run(asyncio.sleep(0.06))
+    assert breaker.allow_request()
+    assert breaker.state == mcp_health.HALF_OPEN
+    assert not breaker.allow_request()
+
+
+def test_call_timeout_counts_as_failure(monkeypatch):
+    class HangingClient(FakeClient):
+        async def __aenter__(self):
+            # 接受连接后不再响应：超时覆盖建立连接的过程
+            await asyncio.sleep(10)
+
+    monkeypatch.setattr(mcp_health, "Client", HangingClient)
+    monkeypatch.setattr(mcp_health, "MCP_CALL_TIMEOUT", 0.05)
+    with pytest.raises(asyncio.TimeoutError):
+        call()
+    assert mcp_health.get_health(URL)["consecutive_failures"] == 1
@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+
+import pytest
+
+import upload_sessions
+from upload_sessions import UploadError
+
+
+@pytest.fixture(autouse=True)
+def tmp_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(upload_sessions, "UPLOAD_TMP_DIR", str(tmp_path / "upload_tmp"))
+    upload_sessions._sessions.clear()
+    yield tmp_path
+    upload_sessions._sessions.clear()
+
+
+async def chunks(*pieces, gate=None):
+    for i, piece in enumerate(pieces):
+        if gate is not None and i:
+            await gate.wait()
+        yield piece
+
+
+def write(session, index, data, sha256=None):
+    return upload_sessions.write_chunk(session, index, chunks(data), sha256)
+
+
+def test_chunks_in_any_order(tmp_dir):
+    data = b"abcdefghij"
+    dest = str(tmp_dir / "docs" / "a.txt")
+
+    async def main():
+        session = upload_sessions.create("a.txt", "", len(data), 4, hashlib.sha256(data).hexdigest())
+        for index in (2, 0, 1):
+            await write(session, index, data[index * 4:index * 4 + 4])
+        return await upload_sessions.complete(session, dest)
+
+    assert asyncio.run(main()) == hashlib.sha256(data).hexdigest()
+    with open(dest, "rb") as f:
+        assert f.read() == data
+    assert upload_sessions._sessions == {}
+
+
+def test_resume_after_restart(tmp_dir):
+    async def main():
+        session = upload_sessions.create("a.txt", "", 8, 4)
+        await write(session, 0, b"abcd")
+        upload_sessions._sessions.clear()
+        resumed = upload_sessions.get(session.id)
+        assert resumed is not session
+        assert resumed.status()["missing"] == [1]
+        await write(resumed, 1, b"efgh")
+        await upload_sessions.complete(resumed, str(tmp_dir / "a.txt"))
+
+    asyncio.run(main())
+    assert (tmp_dir / "a.txt").read_bytes() == b"abcdefgh"
+
+
+def test_failed_retry_marks_chunk_missing():
+    async def main():
+        session = upload_sessions.create("a.txt", "", 8, 4)
+        await write(session, 0, b"abcd")
+        with pytest.raises(UploadError) as e:
+            await write(session, 0, b"zzzz", hashlib.sha256(b"abcd").hexdigest())
+        assert e.value.status_code == 422
+        return session.status()["missing"]
+
+    assert asyncio.run(main()) == [0, 1]
+
+
+def test_chunk_length_checked():
+    async def main():
+        session = upload_sessions.create("a.txt", "", 8, 4)
+        with pytest.raises(UploadError) as e:
+            await write(session, 1, b"efghi")
+        return e.value.status_code
+
+    assert asyncio.run(main()) == 400
+
+
+def test_complete_during_chunk_write_conflicts(tmp_dir):
+    async def main():
+        session = upload_sessions.create("a.txt", "", 8, 4)
+        await write(session, 0, b"abcd")
+        gate = asyncio.Event()
+        writing = asyncio.create_task(upload_sessions.write_chunk(session, 1, chunks(b"ef", b"gh", gate=gate)))
+        await asyncio.sleep(0.01)
+        with pytest.raises(UploadError) as e:
+            await upload_sessions.complete(session, str(tmp_dir / "a.txt"))
+        assert e.value.status_code == 409
+        gate.set()
+        await writing
+        await upload_sessions.complete(session, str(tmp_dir / "a.txt"))
+
+    asyncio.run(main())
+    assert (tmp_dir / "a.txt").read_bytes() == b"abcdefgh"
+
+
+def test_abort_during_chunk_write():
+    async def main():
+        session = upload_sessions.create("a.txt", "", 8, 4)
+        gate = asyncio.Event()
+        writing = asyncio.create_task(upload_sessions.write_chunk(session, 0, chunks(b"ab", b"cd", gate=gate)))
+        await asyncio.sleep(0.01)
+        await upload_sessions.abort(session)
+        gate.set()
+        with pytest.raises(UploadError) as e:
+            await writing
+        assert e.value.status_code == 404
+        with pytest.raises(UploadError) as e:
+            upload_sessions.get(session.id)
+        assert e.value.status_code == 404
+
+    asyncio.run(main())
+
+
+def test_write_after_complete_not_found(tmp_dir):
+    async def main():
+        session = upload_sessions.create("a.txt", "", 4, 4)
+        await write(session, 0, b"abcd")
+        await upload_sessions.complete(session, str(tmp_dir / "a.txt"))
+        for call in (write(session, 0, b"abcd"), upload_sessions.abort(session)):
+            with pytest.raises(UploadError) as e:
+                await call
+            assert e.value.status_code == 404
+
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import storage
+import write_queue as wq
+
+
+@pytest.fixture(autouse=True)
+def temp_db(tmp_path, monkeypatch):
+    pool = storage.ConnectionPool(str(tmp_path / "test.db"), 1)
+    monkeypatch.setattr(storage, "pool", pool)
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+    yield pool
+    pool.close()
+
+
+def rows(pool):
+    with pool.connection() as conn:
+        return [tuple(row) for row in conn.execute("SELECT id, name FROM items ORDER BY id")]
+
+
+def insert(item_id, name):
+    return [("INSERT INTO items (id, name) VALUES (?, ?)", (item_id, name))]
+
+
+def test_units_are_committed_in_one_batch(temp_db, monkeypatch):
+    batches = []
+    write_batch = wq._write_batch
+    monkeypatch.setattr(wq, "_write_batch", lambda conn, units: batches.append(len(units)) or write_batch(conn, units))
+
+    async def main():
+        queue = wq.WriteBehindQueue()
+        queue.start()
+        futures = [await queue.submit(insert(i, f"item{i}")) for i in range(5)]
+        await asyncio.gather(*futures)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert batches == [5]
+    assert rows(temp_db) == [(i, f"item{i}") for i in range(5)]
+
+
+def test_failed_unit_is_rolled_back_alone(temp_db):
+    async def main():
+        queue = wq.WriteBehindQueue()
+        queue.start()
+        ok = await queue.submit(insert(1, "a"))
+        # 第二条语句违反 NOT NULL，整个单元回滚，第一条也不应写入
+        bad = await queue.submit(insert(2, "b") + insert(3, None))
+        after = await queue.submit(insert(4, "d"))
+        await ok
+        with pytest.raises(sqlite3.IntegrityError):
+            await bad
+        await after
+        await queue.stop()
+
+    asyncio.run(main())
+    assert rows(temp_db) == [(1, "a"), (4, "d")]
+
+
+def test_stop_flushes_pending_writes(temp_db):
+    async def main():
+        queue = wq.WriteBehindQueue()
+        queue.start()
+        for i in range(3):
+            await queue.submit(insert(i, "x"))
+        await queue.stop()
+
+    asyncio.run(main())
+    assert len(rows(temp_db)) == 3
+
+
+def test_wait_raises_unit_error(temp_db):
+    async def main():
+        queue = wq.WriteBehindQueue()
+        queue.start()
+        try:
+            await queue.submit(insert(1, None), wait=True)
+        finally:
+            await queue.stop()
+
+    with pytest.raises(sqlite3.IntegrityError):
+        asyncio.run(main())
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import metrics
+import storage
+from write_queue import write_queue
+
+logger = logging.getLogger(__name__)
+
+
+# 请求追踪配置（可通过环境变量覆盖）
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", 5000))    # 超过该耗时的请求写入慢请求日志，0 表示全部记录
+SLOW_LOG_MAX_ROWS = int(os.getenv("SLOW_LOG_MAX_ROWS", 1000))                       # 慢请求日志最多保留的条数
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")                        # 设置后按 OTLP/HTTP JSON 导出，例如 http://collector:4318
+OTLP_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "rag-chat")
+OTLP_TIMEOUT = 5
+
+TRACE_HEADER = "X-Trace-Id"
+_TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-[0-9a-f]{16}-[0-9a-f]{2}$")
+
+_current = ContextVar("trace", default=None)
+
+
+class Trace:
+    """
+    一次请求的追踪：trace_id 与 W3C traceparent 兼容（32 位十六进制），
+    spans 记录各阶段相对请求开始的偏移和耗时（毫秒）。
+    """
+
+    def __init__(self, name: str, trace_id: str = None, **attributes):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = attributes
+        self.spans = []
+        self.started_at = time.perf_counter()
+        self.started_wall = time.time_ns()
+        self.finished = False
+
+    def record(self, name: str, start: float, end: float, **attributes):
+        """记录一个阶段，start / end 为 time.perf_counter() 的读数"""
+        self.spans.append({
+            "name": name,
+            "start_ms": round((start - self.started_at) * 1000, 2),
+            "duration_ms": round((end - start) * 1000, 2),
+            **({"attributes": attributes} if attributes else {}),
+        })
+
+    def headers(self) -> dict:
+        # 传给上游的追踪头：W3C traceparent 供支持的服务串联，X-Trace-Id 便于在日志里检索
+        return {"traceparent": f"00-{self.trace_id}-{self.span_id}-01", TRACE_HEADER: self.trace_id}
+
+
+def parse_trace_id(headers) -> str:
+    """从请求头中取上游传入的 trace_id，没有或格式不对时返回 None"""
+    match = _TRACEPARENT.match(headers.get("traceparent", "").strip().lower())
+    if match:
+        return match.group(1)
+    trace_id = headers.get(TRACE_HEADER, "").strip().lower()
+    return trace_id if re.fullmatch(r"[0-9a-f]{32}", trace_id) else None
+
+
+def start(name: str, trace_id: str = None, **attributes) -> Trace:
+    """开始追踪并设为当前上下文的追踪；之后创建的任务（如流式生成的后台任务）会继承"""
+    trace = Trace(name, trace_id, **attributes)
+    _current.set(trace)
+    return trace
+
+
+def current():
+    return _current.get()
+
+
+def headers() -> dict:
+    trace = _current.get()
+    return trace.headers() if trace is not None else {}
+
+
+@contextmanager
+def stage(name: str, mode: str, **attributes):
+    """记录聊天流程的一个阶段：写入当前追踪的 span，同时计入 chat_stage_seconds 指标"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        end_time = time.perf_counter()
+        metrics.chat_stage_seconds.observe(end_time - start_time, stage=name, mode=mode)
+        trace = _current.get()
+        if trace is not None:
+            trace.record(name, start_time, end_time, **attributes)
+
+
+def finish(trace: Trace, status: str = "ok"):
+    """结束追踪：超过阈值写入慢请求日志，配置了 OTLP 时导出；重复调用只生效一次"""
+    if trace is None or trace.finished:
+        return
+    trace.finished = True
+    duration_ms = (time.perf_counter() - trace.started_at) * 1000
+    if duration_ms >= SLOW_REQUEST_THRESHOLD_MS:
+        logger.info("慢请求 %s %s 耗时 %.0fms", trace.trace_id, trace.name, duration_ms)
+        asyncio.create_task(_save_slow(trace, status, duration_ms))
+    if OTLP_ENDPOINT:
+        asyncio.create_task(_export(trace, status, duration_ms))
+
+
+async def _save_slow(trace: Trace, status: str, duration_ms: float):
+    try:
+        await write_queue.submit([
+            ("INSERT OR REPLACE INTO slow_requests (trace_id, name, status, duration_ms, attributes, spans, created_at) "
+             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+             (trace.trace_id, trace.name, status, round(duration_ms, 2),
+              json.dumps(trace.attributes, ensure_ascii=False), json.dumps(trace.spans, ensure_ascii=False),
+              storage.now())),
+            # 只保留最近 SLOW_LOG_MAX_ROWS 条
+            ("DELETE FROM slow_requests WHERE created_at < "
+             "(SELECT created_at FROM slow_requests ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+             (SLOW_LOG_MAX_ROWS - 1,)),
+        ])
+    except Exception as e:
+        logger.warning("写入慢请求日志失败: %s", e)
+
+
+async def list_slow(limit: int = 50, min_duration_ms: float = 0) -> list:
+    rows = await storage.fetch_all(
+        "SELECT trace_id, name, status, duration_ms, attributes, spans, created_at FROM slow_requests "
+        "WHERE duration_ms >= ? ORDER BY created_at DESC LIMIT ?",
+        (min_duration_ms, limit)
+    )
+    for row in rows:
+        row["attributes"] = json.loads(row["attributes"])
+        row["spans"] = json.loads(row["spans"])
+    return rows
+
+
+async def get_slow(trace_id: str):
+    row = await storage.fetch_one(
+        "SELECT trace_id, name, status, duration_ms, attributes, spans, created_at FROM slow_requests WHERE trace_id = ?",
+        (trace_id,)
+    )
+    if row:
+        row["attributes"] = json.loads(row["attributes"])
+        row["spans"] = json.loads(row["spans"])
+    return row
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": {"stringValue": str(value)}} for key, value in attributes.items()]
+
+
+def _otlp_payload(trace: Trace, status: str, duration_ms: float) -> dict:
+    # OTLP/HTTP JSON：请求本身为根 span，各阶段为子 span
+    root = {
+        "traceId": trace.trace_id,
+        "spanId": trace.span_id,
+        "name": trace.name,
+        "kind": 2,      # SERVER
+        "startTimeUnixNano": str(trace.started_wall),
+        "endTimeUnixNano": str(trace.started_wall + int(duration_ms * 1e6)),
+        "attributes": _otlp_attributes(trace.attributes),
+        "status": {"code": 1 if status == "ok" else 2},
+    }
+    children = [
+        {
+            "traceId": trace.trace_id,
+            "spanId": uuid.uuid4().hex[:16],
+            "parentSpanId": trace.span_id,
+            "name": span["name"],
+            "kind": 1,  # INTERNAL
+            "startTimeUnixNano": str(trace.started_wall + int(span["start_ms"] * 1e6)),
+            "endTimeUnixNano": str(trace.started_wall + int((span["start_ms"] + span["duration_ms"]) * 1e6)),
+            "attributes": _otlp_attributes(span.get("attributes", {})),
+        }
+        for span in trace.spans
+    ]
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otlp_attributes({"service.name": OTLP_SERVICE_NAME})},
+        "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [root] + children}],
+    }]}
+
+
+async def _export(trace: Trace, status: str, duration_ms: float):
+    import requests
+
+    try:
+        response = await asyncio.to_thread(
+            requests.post,
+            OTLP_ENDPOINT.rstrip("/") + "/v1/traces",
+            json=_otlp_payload(trace, status, duration_ms),
+            timeout=OTLP_TIMEOUT,
+        )
+        if response.status_code >= 300:
+            logger.warning("OTLP 导出失败，状态码: %s", response.status_code)
+    except Exception as e:
+        logger.warning("OTLP 导出失败: %s", e)
@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from file_tree import file_sha256
+
+
+# 分片上传配置（可通过环境变量覆盖）
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR", "./upload_tmp")                            # 上传中的临时文件目录，不能放在文档目录下
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))               # 默认分片大小（字节）
+UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", 2 * 1024 * 1024 * 1024))            # 单个文件上限（字节）
+UPLOAD_SESSION_TTL = float(os.getenv("UPLOAD_SESSION_TTL", 24 * 3600))                 # 未完成的上传保留多久（秒）
+
+
+class UploadError(Exception):
+    """上传会话的错误，status_code 对应返回给前端的 HTTP 状态码"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class UploadSession:
+    """
+    一次分片上传：数据直接按偏移写入预分配的临时文件，已收到的分片记录在同目录的 JSON 中，
+    服务重启后仍可继续上传。
+    """
+
+    def __init__(self, upload_id: str, meta: dict):
+        self.id = upload_id
+        self.meta = meta
+        self.received = set(meta["received"])
+        self.lock = asyncio.Lock()          # 串行化元数据写入、完成和取消操作
+        self.closed = False                 # 已完成或已取消，临时文件已移走或删除
+
+    @property
+    def data_path(self) -> str:
+        return os.path.join(UPLOAD_TMP_DIR, f"{self.id}.data")
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(UPLOAD_TMP_DIR, f"{self.id}.json")
+
+    @property
+    def total_chunks(self) -> int:
+        return max(1, -(-self.meta["size"] // self.meta["chunk_size"]))
+
+    def chunk_length(self, index: int) -> int:
+        if self.meta["size"] == 0:
+            return 0
+        return min(self.meta["chunk_size"], self.meta["size"] - index * self.meta["chunk_size"])
+
+    def save_meta(self):
+        self.meta["received"] = sorted(self.received)
+        self.meta["updated_at"] = time.time()
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(tmp_path, self.meta_path)
+
+    def status(self) -> dict:
+        return {
+            "upload_id": self.id,
+            "name": self.meta["name"],
+            "path": self.meta["path"],
+            "size": self.meta["size"],
+            "chunk_size": self.meta["chunk_size"],
+            "total_chunks": self.total_chunks,
+            "received": sorted(self.received),
+            "missing": [i for i in range(self.total_chunks) if i not in self.received],
+        }
+
+
+_sessions = {}
+
+
+def _load(upload_id: str):
+    session = _sessions.get(upload_id)
+    if session is None:
+        meta_path = os.path.join(UPLOAD_TMP_DIR, f"{upload_id}.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            session = _sessions[upload_id] = UploadSession(upload_id, json.load(f))
+    return session
+
+
+def get(upload_id: str) -> UploadSession:
+    # upload_id 直接拼进路径，只接受 uuid 格式
+    try:
+        uuid.UUID(hex=upload_id)
+    except ValueError:
+        raise UploadError(404, "上传会话不存在")
+    session = _load(upload_id)
+    if session is None:
+        raise UploadError(404, "上传会话不存在或已过期")
+    return session
+
+
+def _remove_files(upload_id: str):
+    for suffix in (".data", ".json", ".json.tmp"):
+        try:
+            os.remove(os.path.join(UPLOAD_TMP_DIR, upload_id + suffix))
+        except FileNotFoundError:
+            pass
+
+
+def _close(upload_id: str):
+    session = _sessions.pop(upload_id, None)
+    if session is not None:
+        session.closed = True
+
+
+def _check_open(session: UploadSession):
+    # 需持有 session.lock：与 complete / abort 并发的请求不会再访问已移走或删除的临时文件
+    if session.closed:
+        raise UploadError(404, "上传会话已完成或已取消")
+
+
+def cleanup_expired():
+    """删除超过 UPLOAD_SESSION_TTL 未更新的上传"""
+    if not os.path.isdir(UPLOAD_TMP_DIR):
+        return
+    deadline = time.time() - UPLOAD_SESSION_TTL
+    for name in os.listdir(UPLOAD_TMP_DIR):
+        upload_id = name.split(".")[0]
+        path = os.path.join(UPLOAD_TMP_DIR, name)
+        try:
+            if os.path.getmtime(path) < deadline:
+                _close(upload_id)
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def create(name: str, path: str, size: int, chunk_size: int = None, sha256: str = None) -> UploadSession:
+    """新建上传会话并预分配临时文件，name / path 由调用方校验"""
+    chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+    if size < 0 or size > UPLOAD_MAX_SIZE:
+        raise UploadError(413, f"文件大小超过上限 {UPLOAD_MAX_SIZE} 字节")
+    if not 0 < chunk_size <= UPLOAD_MAX_CHUNK_SIZE:
+        raise UploadError(400, "分片大小无效")
+    cleanup_expired()
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    session = UploadSession(upload_id, {
+        "name": name,
+        "path": path,
+        "size": size,
+        "chunk_size": chunk_size,
+        "sha256": sha256.lower() if sha256 else None,
+        "received": [],
+        "created_at": time.time(),
+    })
+    with open(session.data_path, "wb") as f:
+        f.truncate(size)
+    session.save_meta()
+    _sessions[upload_id] = session
+    return session
+
+
+async def write_chunk(session: UploadSession, index: int, stream, sha256: str = None) -> dict:
+    """
+    按偏移写入一个分片（边接收边写，不在内存中缓存整个分片），校验长度和 SHA-256。
+    重复上传同一分片会覆盖原数据，可安全重试；写入前先把该分片标记为未收到，
+    重试失败时分片需要重新上传，不会带着被覆盖的数据进入 complete。
+    """
+    if not 0 <= index < session.total_chunks:
+        raise UploadError(400, "分片序号超出范围")
+    async with session.lock:
+        _check_open(session)
+        if index in session.received:
+            session.received.discard(index)
+            await asyncio.to_thread(session.save_meta)
+        # 在锁内打开文件：complete 要求全部分片已收到，正在写入的分片不在 received 中，
+        # 因此写入期间临时文件不会被移走；被取消时文件已打开，写入不受影响，结束时再报错
+        try:
+            fd = os.open(session.data_path, os.O_WRONLY)
+        except FileNotFoundError:
+            # 临时文件已被过期清理删除
+            raise UploadError(404, "上传会话不存在或已过期")
+    expected = session.chunk_length(index)
+    offset = index * session.meta["chunk_size"]
+    digest = hashlib.sha256()
+    written = 0
+    try:
+        async for piece in stream:
+            if written + len(piece) > expected:
+                raise UploadError(400, "分片长度超出预期")
+            # 多个分片并行上传时各自按偏移写入，互不影响
+            await asyncio.to_thread(os.pwrite, fd, piece, offset + written)
+            digest.update(piece)
+            written += len(piece)
+    finally:
+        os.close(fd)
+    if written != expected:
+        raise UploadError(400, f"分片长度不符：期望 {expected} 字节，收到 {written} 字节")
+    if sha256 and digest.hexdigest() != sha256.lower():
+        raise UploadError(422, "分片校验失败，请重新上传该分片")
+    async with session.lock:
+        _check_open(session)
+        session.received.add(index)
+        await asyncio.to_thread(session.save_meta)
+    return {"index": index, "received": len(session.received), "total_chunks": session.total_chunks}
+
+
+def _move(src: str, dest: str):
+    try:
+        os.replace(src, dest)
+    except OSError:
+        # 临时目录和文档目录不在同一文件系统（例如 Docker 挂载卷），
+        # 先复制到目标目录下的隐藏临时文件，再原子替换
+        part_path = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.part")
+        shutil.copyfile(src, part_path)
+        os.replace(part_path, dest)
+        os.remove(src)
+
+
+async def complete(session: UploadSession, dest_path: str) -> str:
+    """校验全部分片和整体 SHA-256 后原子移动到 dest_path，返回文件的 SHA-256"""
+    async with session.lock:
+        _check_open(session)
+        missing = [i for i in range(session.total_chunks) if i not in session.received]
+        if missing:
+            raise UploadError(409, f"还有 {len(missing)} 个分片未上传")
+        checksum = await asyncio.to_thread(file_sha256, session.data_path)
+        if session.meta["sha256"] and checksum != session.meta["sha256"]:
+            raise UploadError(422, "文件校验失败，请重新上传")
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        await asyncio.to_thread(_move, session.data_path, dest_path)
+        _remove_files(session.id)
+        _close(session.id)
+        session.closed = True
+        return checksum
+
+
+async def abort(session: UploadSession):
+    async with session.lock:
+        _check_open(session)
+        _remove_files(session.id)
+        _close(session.id)
+        session.closed = True
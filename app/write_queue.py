@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+# 写入队列配置（可通过环境变量覆盖）
+WRITE_QUEUE_MAX_SIZE = int(os.getenv("WRITE_QUEUE_MAX_SIZE", 1000))        # 队列上限，满了之后提交方等待
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 100))                 # 单次提交最多合并多少个写入单元
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", 0.05))      # 收到第一个写入后最多等待多久再提交（秒）
+
+
+class WriteBehindQueue:
+    """
+    后台单写线程的批量提交队列。
+    各请求把一组写语句（一个写入单元）放入队列，后台任务把一段时间内收集到的
+    写入单元合并到一个事务里提交，每个单元用 SAVEPOINT 隔离，单元失败不影响同批其他单元。
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.queue = asyncio.Queue(maxsize=WRITE_QUEUE_MAX_SIZE)
+            self.task = asyncio.create_task(self._run())
+
+    async def submit(self, statements: list, wait: bool = False):
+        """
+        提交一个写入单元 [(sql, params), ...]。
+        wait=True 时等待该单元真正提交到数据库后才返回（失败时抛出异常）。
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((statements, future))
+        if wait:
+            await future
+        return future
+
+    async def stop(self):
+        # 关闭前把队列里剩余的写入全部提交
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + WRITE_FLUSH_INTERVAL
+            while len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit(batch)
+
+    async def _commit(self, batch: list):
+        try:
+            errors = await storage.run(_write_batch, [statements for statements, _ in batch])
+        except Exception as e:
+            errors = [e] * len(batch)
+            logger.exception("批量写入失败: %s", e)
+        for (_, future), error in zip(batch, errors):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+                # 没有调用方等待结果时，避免 "exception was never retrieved" 警告
+                future.exception()
+
+
+def _write_batch(conn, units: list) -> list:
+    errors = []
+    metrics.sqlite_write_statements.inc(sum(len(statements) for statements in units))
+    with metrics.sqlite_write_seconds.time(), storage.transaction(conn):
+        for statements in units:
+            conn.execute("SAVEPOINT write_unit")
+            try:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+            except Exception as e:
+                conn.execute("ROLLBACK TO write_unit")
+                conn.execute("RELEASE write_unit")
+                logger.warning("写入单元失败: %s", e)
+                errors.append(e)
+                continue
+            conn.execute("RELEASE write_unit")
+            errors.append(None)
+    return errors
+
+
+write_queue = WriteBehindQueue()